@@ -92,19 +92,31 @@ const unsigned int HEAD_MOVE_INTERVAL = 10;
 
 // --- Simplified Serial Handling ---
 unsigned long lastHeartbeat = 0;
+
+// Text commands are collected in a fixed buffer (no String reallocation); longer lines are discarded
+char serialBuffer[32];
+uint8_t serialLength = 0;
+bool serialOverflow = false;
+
+// Binary commands: 2 bytes, [0x80 | press bit 0x40 | key index] then the inverted low 7 bits as checksum.
+// Enabled by the "proto:binary,<baud>" text command; text commands keep working either way.
+const char BINARY_KEYS[] = "wasdqerty";
+int16_t pendingBinaryCommand = -1;
 #pragma endregion GLOBAL VARIABLES
 
 #pragma region FUNCTION PROTOTYPES
 void processSerialCommand();
 void handleMovement();
 void handleHeadControl();
-void parseCommand(String command);
+void parseCommand(char *command);
+void handleKey(char keyChar, bool isKeyDown);
+void handleProtocolRequest(char *request);
+void handleBinaryCommand(uint8_t command, uint8_t checksum);
 #pragma endregion FUNCTION PROTOTYPES
 
 //********************************************************************************************************
 // SETUP
 //********************************************************************************************************
-String serialBuffer = "";
 void setup() {
   // Start serial
   Serial.begin(9600);  
@@ -151,36 +163,79 @@ void loop() {
 #pragma region FUNCTION DEFINITIONS
 
 /**
- * @brief Parse and execute command
- * Expected format: "keydown:w" or "keyup:s"
+ * @brief Parse and execute a text command
+ * Expected format: "keydown:w" or "keyup:s", or "proto:binary,115200" to switch protocol/baud
  */
-void parseCommand(String command) {
-  command.trim();
-  command.toLowerCase();
-  
-  if (command.length() < 7) return; // Minimum: "keyup:x"
-  
-  int colonPos = command.indexOf(':');
-  if (colonPos == -1) return;
-  
-  String action = command.substring(0, colonPos);
-  String key = command.substring(colonPos + 1);
-  
+void parseCommand(char *command) {
+  // Trim and lowercase in place
+  while (*command == ' ' || *command == '\r') command++;
+  size_t length = strlen(command);
+  while (length > 0 && (command[length - 1] == ' ' || command[length - 1] == '\r')) command[--length] = '\0';
+  for (size_t i = 0; i < length; i++) command[i] = tolower(command[i]);
+
+  char *colon = strchr(command, ':');
+  if (colon == NULL) return;
+  *colon = '\0';
+  char *key = colon + 1;
+
+  if (strcmp(command, "proto") == 0) {
+    handleProtocolRequest(key);
+    return;
+  }
+
+  if (length < 7) return; // Minimum: "keyup:x"
+
   // Validate action
   bool isKeyDown;
-  if (action == "keydown") {
+  if (strcmp(command, "keydown") == 0) {
     isKeyDown = true;
-  } else if (action == "keyup") {
+  } else if (strcmp(command, "keyup") == 0) {
     isKeyDown = false;
   } else {
     return; // Invalid action
   }
-  
+
   // Process key commands
-  if (key.length() != 1) return; // Only single character keys
-  
-  char keyChar = key.charAt(0);
-  
+  if (strlen(key) != 1) return; // Only single character keys
+  handleKey(key[0], isKeyDown);
+}
+
+/**
+ * @brief Answer "proto:<binary|text>,<baud>" with "PROTO <binary|text> <baud>", then switch baud rate
+ */
+void handleProtocolRequest(char *request) {
+  char *comma = strchr(request, ',');
+  if (comma == NULL) return;
+  *comma = '\0';
+  long baud = atol(comma + 1);
+  if (baud != 9600 && baud != 19200 && baud != 38400 && baud != 57600 && baud != 115200) return;
+
+  // Binary commands are always understood; the mode only tells the sender which form to use
+  Serial.print("PROTO ");
+  Serial.print(strcmp(request, "binary") == 0 ? "binary" : "text");
+  Serial.print(" ");
+  Serial.println(baud);
+  Serial.flush();  // Finish sending the reply at the old rate
+  Serial.begin(baud);
+}
+
+/**
+ * @brief Validate and execute a two-byte binary command
+ */
+void handleBinaryCommand(uint8_t command, uint8_t checksum) {
+  if (checksum != (uint8_t)(~command & 0x7F)) {
+    DEBUG_PRINTLN("Bad checksum");
+    return;
+  }
+  uint8_t index = command & 0x3F;
+  if (index >= sizeof(BINARY_KEYS) - 1) return;
+  handleKey(BINARY_KEYS[index], command & 0x40);
+}
+
+/**
+ * @brief Apply a key state change
+ */
+void handleKey(char keyChar, bool isKeyDown) {
   switch (keyChar) {
     case 'w':
       keyW_pressed = isKeyDown;
@@ -235,27 +290,37 @@ void parseCommand(String command) {
 }
 
 void processSerialCommand() {
-  // Read all available characters
+  // Read all available bytes
   while (Serial.available() > 0) {
-    char incomingByte = Serial.read();
-    serialBuffer += incomingByte;
-  }
-  
-  // Process complete commands (lines ending with \n)
-  int newlinePos;
-  while ((newlinePos = serialBuffer.indexOf('\n')) != -1) {
-    // Extract the command
-    String command = serialBuffer.substring(0, newlinePos);
-    command.trim();
-    
-    // Remove processed command from buffer
-    serialBuffer = serialBuffer.substring(newlinePos + 1);
-    
-    // Process the command if it's not empty
-    if (command.length() > 0) {
-      DEBUG_PRINT("Incoming command: ");
-      DEBUG_PRINTLN(command);
-      parseCommand(command);
+    uint8_t incomingByte = Serial.read();
+
+    // Second byte of a binary command
+    if (pendingBinaryCommand >= 0) {
+      handleBinaryCommand(pendingBinaryCommand, incomingByte);
+      pendingBinaryCommand = -1;
+      continue;
+    }
+
+    // Text is plain ASCII, so a set high bit starts a binary command
+    if (incomingByte & 0x80) {
+      pendingBinaryCommand = incomingByte;
+      continue;
+    }
+
+    // Process complete text commands (lines ending with \n)
+    if (incomingByte == '\n') {
+      serialBuffer[serialLength] = '\0';
+      if (serialLength > 0 && !serialOverflow) {
+        DEBUG_PRINT("Incoming command: ");
+        DEBUG_PRINTLN(serialBuffer);
+        parseCommand(serialBuffer);
+      }
+      serialLength = 0;
+      serialOverflow = false;
+    } else if (serialLength < sizeof(serialBuffer) - 1) {
+      serialBuffer[serialLength++] = incomingByte;
+    } else {
+      serialOverflow = true;
     }
   }
 }
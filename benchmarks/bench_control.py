@@ -0,0 +1,104 @@
+"""Benchmark: control command bursts, legacy unframed JSON vs the framed control protocol.
+
+Sends bursts of keydown/keyup pairs over loopback TCP (as fast key repeat would) and reports how
+many commands the server side parsed, the burst throughput and per-command latency percentiles.
+
+    python benchmarks/bench_control.py [--bursts 200] [--burst-size 10]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream import ControlDecoder, encode_control_frame
+
+
+def legacy_reader(conn, received):
+    # The original handle_control_client: recv(1024) then json.loads on whatever arrived
+    while True:
+        data = conn.recv(1024)
+        if not data:
+            return
+        try:
+            json.loads(data.decode('utf-8'))
+            received.append(time.perf_counter())
+        except json.JSONDecodeError:
+            pass  # Coalesced sends: every command in this read is lost
+
+
+def framed_reader(conn, received):
+    decoder = ControlDecoder()
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            return
+        for _ in decoder.feed(data):
+            received.append(time.perf_counter())
+
+
+def run(name, reader, encode, nodelay, args):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+    received = []
+    thread = threading.Thread(target=reader, args=(conn, received), daemon=True)
+    thread.start()
+
+    hello = encode.get('hello')
+    if hello:
+        client.sendall(hello)
+        received_before = 1
+    else:
+        received_before = 0
+
+    sent = []
+    start = time.perf_counter()
+    for _ in range(args.bursts):
+        for i in range(args.burst_size):
+            message = {"type": "keydown" if i % 2 == 0 else "keyup", "key": "w"}
+            sent.append(time.perf_counter())
+            client.send(encode['message'](message))
+        time.sleep(args.gap)
+    client.shutdown(socket.SHUT_WR)
+    thread.join(timeout=5)
+    elapsed = time.perf_counter() - start - args.bursts * args.gap
+    client.close()
+    conn.close()
+    server.close()
+
+    received = received[received_before:]
+    total = len(sent)
+    # Latency is only meaningful when every command arrived in order
+    if len(received) == total:
+        latencies = sorted((r - s) * 1e6 for s, r in zip(sent, received))
+        percentiles = (f"p50={statistics.median(latencies):7.1f} us  "
+                       f"p99={latencies[int(len(latencies) * 0.99) - 1]:7.1f} us")
+    else:
+        percentiles = "latency n/a (commands lost)"
+    print(f"{name:<26} parsed {len(received):>6}/{total:<6} {total / elapsed:9.0f} cmd/s  {percentiles}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bursts', type=int, default=200)
+    parser.add_argument('--burst-size', type=int, default=10)
+    parser.add_argument('--gap', type=float, default=0.002, help="Seconds between bursts")
+    args = parser.parse_args()
+
+    hello = (json.dumps({"hello": "tank-control", "version": 2, "encodings": ["binary", "json"]}) + "\n").encode()
+    legacy = {'message': lambda m: json.dumps(m).encode('utf-8')}
+    framed_json = {'hello': hello, 'message': lambda m: encode_control_frame(m)}
+    framed_binary = {'hello': hello, 'message': lambda m: encode_control_frame(m, binary=True)}
+
+    run("legacy JSON", legacy_reader, legacy, False, args)
+    run("framed JSON + NODELAY", framed_reader, framed_json, True, args)
+    run("framed binary + NODELAY", framed_reader, framed_binary, True, args)
@@ -0,0 +1,328 @@
+"""End-to-end benchmark: VideoStreamServer on a synthetic camera and a pty fake Arduino, driven by a headless client.
+
+For each configuration (server mode x codec x key transport) a server process is started with the fakes
+from fakes.py. A headless client does what TankPlantController does without Tk: negotiates video with
+timestamps, receives, decodes, scales and enhances frames through LatestSlot stages, and taps 'w' over
+the control channel or UDP while subscribed to Arduino replies. Reports displayed FPS, video and key
+latency percentiles, and CPU and memory for both processes. Results can be saved and compared against a
+previous run to catch regressions.
+
+    python benchmarks/bench_end_to_end.py [--seconds 5] [--modes threaded async] [--codecs mjpeg h264]
+    python benchmarks/bench_end_to_end.py --json before.json            # save results
+    python benchmarks/bench_end_to_end.py --compare before.json         # exit 1 if anything got worse
+    python benchmarks/bench_end_to_end.py --replay drive.mp4            # recorded footage instead of test frames
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import (FRAME_TIMESTAMPS, KEY_SPANS, VIDEO_SPANS, ClockSync, ControlChannel, DisplayScaler,
+                  EnhancementParams, FrameEnhancer, FrameReceiver, LatencyStats, LatestSlot, UdpKeySender)
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def serve(config):
+    from fakes import FakeArduino, SyntheticCamera
+    from stream import AsyncVideoStreamServer, VideoStreamServer
+    arduino = FakeArduino(9600)  # Paced like the real link; the server negotiates its own rate
+    server_class = AsyncVideoStreamServer if config['mode'] == 'async' else VideoStreamServer
+    server = server_class(video_port=config['port'], control_port=config['port'] + 1, arduino_port=arduino.port,
+                          max_fps=config['fps'], h264=config['codec'] == 'h264',
+                          udp_control=config['transport'] == 'udp', metrics_port=0,
+                          camera=SyntheticCamera(source=config['replay']),
+                          serial_binary=config['serial'] == 'binary')
+    server.start_server()
+
+
+class HeadlessClient:
+    """TankPlantController's network and video pipeline without the GUI; displaying a frame just counts it"""
+    def __init__(self, port, codec, transport):
+        self.running = True
+        self.latency = LatencyStats(window=100000)
+        self.clock = ClockSync()
+        self.frames_displayed = 0
+        self.counting = False
+        self.scaler = DisplayScaler((640, 480))
+        self.enhancer = FrameEnhancer()
+        self.params = EnhancementParams(1.0, 1.2, 1.5)
+        self.encoded_frames, self.decoded_frames = LatestSlot(), LatestSlot()
+
+        self.video_socket = socket.create_connection(('127.0.0.1', port))
+        self.video_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.codec = self.negotiate_video([codec])
+
+        self.control_socket = socket.create_connection(('127.0.0.1', port + 1), timeout=2.0)
+        self.control = ControlChannel(self.control_socket)
+        reply = self.control.handshake(transports=['udp'] if transport == 'udp' else [])
+        self.control_socket.settimeout(None)
+        self.control.send({"type": "subscribe", "topics": ["arduino"]})
+        self.udp_sender = None
+        if transport == 'udp':
+            if not reply or not reply.get('udp_port'):
+                raise ConnectionError("Server did not offer UDP control")
+            self.udp_sender = UdpKeySender(('127.0.0.1', reply['udp_port']))
+
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in (self.receive_video, self.process_video, self.receive_control)]
+        for thread in self.threads:
+            thread.start()
+
+    def negotiate_video(self, codecs):
+        self.video_socket.sendall((json.dumps({"codecs": codecs, "timestamps": True}) + "\n").encode('utf-8'))
+        reply = b""
+        while not reply.endswith(b"\n"):
+            byte = self.video_socket.recv(1)
+            if not byte:
+                raise ConnectionError("Video socket closed during negotiation")
+            reply += byte
+        reply = json.loads(reply.decode('utf-8'))
+        if not reply.get('timestamps'):
+            raise ConnectionError("Server did not agree to frame timestamps")
+        return reply.get('codec', 'mjpeg')
+
+    def receive_video(self):
+        receiver = self.receiver = FrameReceiver(self.video_socket)
+        decoder = av.CodecContext.create('h264', 'r') if self.codec == 'h264' else None
+        while self.running:
+            try:
+                frame_data = receiver.recv_frame()
+            except (OSError, ValueError):
+                break
+            if frame_data is None:
+                break
+            stamps = {'received': time.time()}
+            stamps['capture'], stamps['encoded'], stamps['sent'] = FRAME_TIMESTAMPS.unpack_from(frame_data)
+            frame_data = frame_data[FRAME_TIMESTAMPS.size:]
+            if decoder:
+                frame = None
+                for video_frame in decoder.decode(av.Packet(frame_data)):
+                    frame = video_frame.to_ndarray(format='bgr24')
+                receiver.release(frame_data)
+                if frame is not None:
+                    stamps['decoded'] = time.time()
+                    self.decoded_frames.put((frame, stamps))
+            else:
+                replaced = self.encoded_frames.put((frame_data, stamps))
+                if replaced:
+                    receiver.release(replaced[0])
+        self.encoded_frames.close()
+        self.decoded_frames.close()
+
+    def process_video(self):
+        # Decode and enhance stages folded into one thread; H.264 arrives already decoded
+        source = self.decoded_frames if self.codec == 'h264' else self.encoded_frames
+        while self.running and not source.closed:
+            item = source.get()
+            if item is None:
+                continue
+            if source is self.encoded_frames:
+                frame_data, stamps = item
+                flag, factor = self.scaler.decode_mode()
+                frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), flag)
+                self.receiver.release(frame_data)
+                if frame is None:
+                    continue
+                self.scaler.source_size = (frame.shape[1] * factor, frame.shape[0] * factor)
+                stamps['decoded'] = time.time()
+            else:
+                frame, stamps = item
+            self.enhancer.enhance(self.scaler.resize(frame), self.params)
+            stamps['enhanced'] = stamps['displayed'] = time.time()
+            if self.counting:
+                self.frames_displayed += 1
+                self.latency.record_spans(VIDEO_SPANS, stamps, self.clock.offset)
+
+    def receive_control(self):
+        while self.running:
+            try:
+                messages = self.control.receive()
+            except OSError:
+                break
+            if messages is None:
+                break
+            for message in messages:
+                if message.get('type') == 'pong':
+                    self.clock.update(message['client_time'], message['server_time'], time.time())
+                elif message.get('type') == 'arduino' and message.get('timing') and self.counting:
+                    stamps = dict(message['timing'], client_received=time.time())
+                    self.latency.record_spans(KEY_SPANS, stamps, self.clock.offset)
+
+    def sync_clock(self, pings=8):
+        for _ in range(pings):
+            self.control.send({"type": "ping", "client_time": time.time()})
+            time.sleep(0.05)
+
+    def tap(self, down):
+        if self.udp_sender:
+            self.udp_sender.send({'w'} if down else set())
+        else:
+            self.control.send({"type": 'keydown' if down else 'keyup', "key": 'w', "sent": time.time()})
+
+    def close(self):
+        self.running = False
+        if self.udp_sender:
+            self.udp_sender.close()
+        for sock in (self.video_socket, self.control_socket):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        for thread in self.threads:
+            thread.join(timeout=2.0)
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def process_usage(pid):
+    # CPU seconds (utime + stime) and resident memory in MB
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS')) / 1024
+    return cpu, rss
+
+
+def run(config, args):
+    name = f"{config['mode']}/{config['codec']}/{config['transport']}"
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', json.dumps(config)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    client = None
+    try:
+        if not wait_for_port(config['port']) or not wait_for_port(config['port'] + 1):
+            print(f"{name}: server did not start")
+            return None
+        time.sleep(0.5)  # Serial negotiation happens before the servers listen, but give the camera a moment
+        client = HeadlessClient(config['port'], config['codec'], config['transport'])
+        client.sync_clock()
+        time.sleep(1.0)  # Warm up: encoder, adaptive quality and decoder settle
+
+        server_before, client_before = process_usage(server.pid), process_usage(os.getpid())
+        started = time.monotonic()
+        client.counting = True
+        down = False
+        while time.monotonic() - started < args.seconds:
+            down = not down
+            client.tap(down)
+            time.sleep(1.0 / args.key_rate)
+        if down:
+            client.tap(False)
+        time.sleep(0.2)  # Let the last replies arrive
+        client.counting = False
+        elapsed = time.monotonic() - started
+        server_after, client_after = process_usage(server.pid), process_usage(os.getpid())
+    finally:
+        if client:
+            client.close()
+        server.terminate()
+        server.wait()
+
+    summary = client.latency.summary()
+
+    def percentile(stage, key):
+        return round(float(summary[stage][key]), 2) if summary[stage]['count'] else None
+
+    result = {
+        "config": name,
+        "codec": client.codec,
+        "fps": round(client.frames_displayed / elapsed, 1),
+        "video_p50_ms": percentile('video_total', 'p50'), "video_p99_ms": percentile('video_total', 'p99'),
+        "key_p50_ms": percentile('key_total', 'p50'), "key_p99_ms": percentile('key_total', 'p99'),
+        "key_replies": summary['key_total']['count'],
+        "server_cpu_percent": round(100 * (server_after[0] - server_before[0]) / elapsed, 1),
+        "server_rss_mb": round(server_after[1], 1),
+        "client_cpu_percent": round(100 * (client_after[0] - client_before[0]) / elapsed, 1),
+        "client_rss_mb": round(client_after[1], 1),
+    }
+    print(f"{name:<22} {result['fps']:5.1f} fps  video p50 {result['video_p50_ms']} p99 {result['video_p99_ms']} ms  "
+          f"key p50 {result['key_p50_ms']} p99 {result['key_p99_ms']} ms ({result['key_replies']})  "
+          f"server {result['server_cpu_percent']:5.1f}% {result['server_rss_mb']:.0f} MB  "
+          f"client {result['client_cpu_percent']:5.1f}% {result['client_rss_mb']:.0f} MB")
+    return result
+
+
+# Metric -> True when bigger is better
+COMPARED = {"fps": True, "video_p50_ms": False, "video_p99_ms": False, "key_p50_ms": False, "key_p99_ms": False,
+            "server_cpu_percent": False, "client_cpu_percent": False, "server_rss_mb": False}
+
+def compare(results, baseline_path, tolerance):
+    """Print metrics that got worse than the baseline by more than `tolerance`; returns how many did"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result['config']: result for result in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        before = baseline.get(result['config'])
+        if before is None:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions += 1
+                print(f"REGRESSION {result['config']} {metric}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    parser.add_argument('--codecs', nargs='+', choices=['mjpeg', 'h264'],
+                        default=['mjpeg', 'h264'] if av is not None else ['mjpeg'])
+    parser.add_argument('--transports', nargs='+', choices=['tcp', 'udp'], default=['tcp', 'udp'])
+    parser.add_argument('--serial', choices=['binary', 'text'], default='binary', help="Serial protocol to negotiate")
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--fps', type=int, default=20, help="Server capture frame rate")
+    parser.add_argument('--key-rate', type=float, default=10, help="Key presses and releases per second")
+    parser.add_argument('--replay', default=None, metavar='VIDEO', help="Loop frames from this video file")
+    parser.add_argument('--port', type=int, default=18988, help="Video port; control uses the next one")
+    parser.add_argument('--json', default=None, metavar='PATH', help="Save results here")
+    parser.add_argument('--compare', default=None, metavar='PATH', help="Baseline saved with --json")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative change before flagging")
+    parser.add_argument('--serve', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(json.loads(args.serve))
+        sys.exit(0)
+
+    results = []
+    for mode in args.modes:
+        for codec in args.codecs:
+            for transport in args.transports:
+                config = {"mode": mode, "codec": codec, "transport": transport, "port": args.port, "fps": args.fps,
+                          "serial": args.serial, "replay": args.replay}
+                result = run(config, args)
+                if result:
+                    results.append(result)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"recorded": time.strftime('%Y-%m-%d %H:%M:%S'), "seconds": args.seconds,
+                       "results": results}, f, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
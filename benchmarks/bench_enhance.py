@@ -0,0 +1,96 @@
+"""Benchmark: PIL ImageEnhance chain vs FrameEnhancer (cv2.LUT + filter2D) at 640x480.
+
+Reports ms/frame for each path and the mean absolute per-pixel difference between their outputs.
+--sweep instead compares the outputs over a grid covering the GUI slider ranges and reports the worst setting.
+
+    python benchmarks/bench_enhance.py [--frames 200] [--brightness 1.0] [--contrast 1.2] [--sharpness 1.5]
+    python benchmarks/bench_enhance.py --sweep
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import EnhancementParams, FrameEnhancer
+
+
+def enhance_pil(frame, brightness, contrast, sharpness):
+    # The original enhance_frame chain
+    pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    pil_image = ImageEnhance.Brightness(pil_image).enhance(brightness)
+    pil_image = ImageEnhance.Contrast(pil_image).enhance(contrast)
+    pil_image = ImageEnhance.Sharpness(pil_image).enhance(sharpness)
+    if sharpness > 1.5:
+        pil_image = pil_image.filter(ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3))
+    return np.asarray(pil_image)
+
+
+def synthetic_frame(width=640, height=480):
+    # Gradients, edges and noise so both sharpening paths have something to do
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                       np.full((height, width), 128, np.float32)])
+    frame = np.clip(frame + rng.normal(0, 12, frame.shape), 0, 255).astype(np.uint8)
+    cv2.putText(frame, "TANK", (120, 300), cv2.FONT_HERSHEY_SIMPLEX, 5, (255, 255, 255), 12)
+    return frame
+
+
+def time_path(name, enhance, frame, args):
+    enhance(frame, args.brightness, args.contrast, args.sharpness)  # Warm up
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        result = enhance(frame, args.brightness, args.contrast, args.sharpness)
+    elapsed = (time.perf_counter() - start) / args.frames
+    print(f"{name:<14} {elapsed * 1000:7.2f} ms/frame")
+    return result
+
+
+def compare(frame, enhancer, brightness, contrast, sharpness):
+    reference = enhance_pil(frame, brightness, contrast, sharpness)
+    fused = enhancer.enhance(frame, EnhancementParams(brightness, contrast, sharpness))
+    return np.abs(reference.astype(np.int16) - fused.astype(np.int16))
+
+
+def sweep(frame):
+    # Slider ranges from the Video tab: brightness 0.5-2.0, contrast 0.5-3.0, sharpness 0.5-3.0
+    enhancer = FrameEnhancer()
+    grid = itertools.product(np.linspace(0.5, 2.0, 7), np.linspace(0.5, 3.0, 6), np.linspace(0.5, 3.0, 11))
+    results = []
+    for brightness, contrast, sharpness in grid:
+        diff = compare(frame, enhancer, round(brightness, 2), round(contrast, 2), round(sharpness, 2))
+        results.append((diff.mean(), np.percentile(diff, 99), brightness, contrast, sharpness))
+    worst_mean = max(results)
+    worst_p99 = max(results, key=lambda result: result[1])
+    print(f"{len(results)} settings: mean abs difference {np.mean([r[0] for r in results]):.2f} / 255 on average")
+    for label, (mean, p99, brightness, contrast, sharpness) in (("worst mean", worst_mean), ("worst p99", worst_p99)):
+        print(f"{label:<11} {mean:.2f} / 255, 99th percentile {p99:.0f} at brightness {brightness:.2f} "
+              f"contrast {contrast:.2f} sharpness {sharpness:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--brightness', type=float, default=1.0)
+    parser.add_argument('--contrast', type=float, default=1.2)
+    parser.add_argument('--sharpness', type=float, default=1.5)
+    parser.add_argument('--sweep', action='store_true', help="Compare outputs across the slider ranges instead")
+    args = parser.parse_args()
+
+    frame = synthetic_frame()
+    if args.sweep:
+        sweep(frame)
+        sys.exit()
+    reference = time_path("PIL", enhance_pil, frame, args)
+    enhancer = FrameEnhancer()
+    fused = time_path("FrameEnhancer", lambda frame, *params: enhancer.enhance(frame, EnhancementParams(*params)),
+                      frame, args)
+    difference = np.abs(reference.astype(np.int16) - fused.astype(np.int16))
+    print(f"mean abs difference {difference.mean():.2f} / 255, 99th percentile {np.percentile(difference, 99):.0f}")
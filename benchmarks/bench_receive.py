@@ -0,0 +1,129 @@
+"""Micro-benchmark: client video receive path, bytes-concatenation vs FrameReceiver (recv_into).
+
+Streams length-prefixed frames over a local socket pair and reports, per frame, the CPU time
+spent in the receiving thread and the bytes copied in user space after leaving the kernel.
+Each path includes the handoff to a decode thread through a LatestSlot, as in receive_video:
+"recv_into+copy" hands over bytes(payload), "recv_into" hands over the pooled buffer itself,
+which the decode thread views with np.frombuffer and then releases.
+
+    python benchmarks/bench_receive.py [--frames 2000] [--size 60000]
+"""
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import FrameReceiver, LatestSlot
+
+
+def send_frames(sock, count, size):
+    payload = os.urandom(size)
+    frame = struct.pack("!I", size) + payload
+    for _ in range(count):
+        sock.sendall(frame)
+    sock.shutdown(socket.SHUT_WR)
+
+
+def consume(slot, stats):
+    # Stand-in for decode_video: view the payload as numpy without copying, then give a pooled buffer back
+    while not slot.closed:
+        item = slot.get()
+        if item is None:
+            continue
+        np.frombuffer(item, dtype=np.uint8)[::4096].sum()
+        if 'receiver' in stats:
+            stats['receiver'].release(item)
+
+
+def receive_legacy(sock, stats, slot):
+    # The original receive_video loop: 4096-byte recv, data += packet, then slicing
+    data = b""
+    payload_size = struct.calcsize("!I")
+    while True:
+        while len(data) < payload_size:
+            packet = sock.recv(4096)
+            if not packet:
+                return
+            stats['copied'] += len(data) + len(packet)
+            data += packet
+        msg_size = struct.unpack("!I", data[:payload_size])[0]
+        stats['copied'] += len(data)
+        data = data[payload_size:]
+        while len(data) < msg_size:
+            chunk = sock.recv(min(4096, msg_size - len(data)))
+            if not chunk:
+                return
+            stats['copied'] += len(data) + len(chunk)
+            data += chunk
+        stats['copied'] += len(data)  # frame slice plus leftover slice
+        frame_data = data[:msg_size]
+        data = data[msg_size:]
+        slot.put(frame_data)
+        stats['frames'] += 1
+
+
+def receive_recv_into_copy(sock, stats, slot):
+    # receive_video before buffers were pooled: copy each payload out of the reused receive buffer
+    receiver = FrameReceiver(sock)
+    while True:
+        payload = receiver.recv_frame()
+        if payload is None:
+            return
+        stats['copied'] += len(payload)
+        slot.put(bytes(payload))
+        receiver.release(payload)
+        stats['frames'] += 1
+
+
+def receive_recv_into(sock, stats, slot):
+    receiver = stats['receiver'] = FrameReceiver(sock)
+    while True:
+        payload = receiver.recv_frame()
+        if payload is None:
+            return
+        replaced = slot.put(payload)
+        if replaced is not None:
+            receiver.release(replaced)
+        stats['frames'] += 1
+
+
+def run(name, receive, frames, size):
+    sender, receiver = socket.socketpair()
+    stats = {'frames': 0, 'copied': 0}
+    slot = LatestSlot()
+    thread = threading.Thread(target=send_frames, args=(sender, frames, size), daemon=True)
+    thread.start()
+    consumer = threading.Thread(target=consume, args=(slot, stats), daemon=True)
+    consumer.start()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    receive(receiver, stats, slot)
+    cpu = time.thread_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    slot.close()
+    consumer.join()
+    thread.join()
+    sender.close()
+    receiver.close()
+
+    count = max(stats['frames'], 1)
+    print(f"{name:<15} frames={stats['frames']:<6} cpu/frame={cpu / count * 1e6:8.1f} us  "
+          f"copied/frame={stats['copied'] / count / 1024:8.1f} KiB  wall={wall:.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=60000, help="JPEG payload bytes per frame")
+    args = parser.parse_args()
+
+    run("bytes +=", receive_legacy, args.frames, args.size)
+    run("recv_into+copy", receive_recv_into_copy, args.frames, args.size)
+    run("recv_into", receive_recv_into, args.frames, args.size)
@@ -0,0 +1,56 @@
+"""Benchmark: display path decode + resize, always-LANCZOS (original) vs DisplayScaler.
+
+For a 640x480 JPEG shown at several label sizes, reports ms/frame for the original path
+(full decode, PIL LANCZOS resize to the label) and for DisplayScaler in Fast and Quality modes.
+
+    python benchmarks/bench_resize.py [--frames 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import DisplayScaler
+from bench_enhance import synthetic_frame
+
+
+def original_path(jpeg, box):
+    frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return Image.fromarray(frame).resize(box, Image.Resampling.LANCZOS)
+
+
+def scaler_path(scaler):
+    def run(jpeg, box):
+        flag, factor = scaler.decode_mode()
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), flag)
+        scaler.source_size = (frame.shape[1] * factor, frame.shape[0] * factor)
+        return scaler.resize(frame)
+    return run
+
+
+def time_path(path, jpeg, box, frames):
+    path(jpeg, box)  # Warm up (also lets the scaler learn the source size)
+    start = time.perf_counter()
+    for _ in range(frames):
+        path(jpeg, box)
+    return (time.perf_counter() - start) / frames * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=200)
+    args = parser.parse_args()
+
+    jpeg = cv2.imencode('.jpg', synthetic_frame(), [int(cv2.IMWRITE_JPEG_QUALITY), 70])[1].tobytes()
+    print(f"{'label':<10} {'original':>10} {'fast':>10} {'quality':>10}   (ms/frame)")
+    for box in ((640, 480), (480, 360), (320, 240), (960, 720)):
+        fast, quality = DisplayScaler(box), DisplayScaler(box)
+        quality.quality = True
+        timings = [time_path(path, jpeg, box, args.frames)
+                   for path in (original_path, scaler_path(fast), scaler_path(quality))]
+        print(f"{box[0]}x{box[1]:<6} " + " ".join(f"{t:10.2f}" for t in timings))
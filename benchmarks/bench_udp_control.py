@@ -0,0 +1,87 @@
+"""Loopback harness for the UDP key-state control transport.
+
+A sender changes the pressed-key set at a fixed rate and sends sequence-numbered snapshots through a
+lossy, reordering shim; a KeySnapshotReceiver applies them. Reports command latency percentiles, how
+many packets were discarded as stale, and whether the receiver ended on the sender's final state.
+
+    python benchmarks/bench_udp_control.py [--packets 5000] [--loss 0.05] [--reorder 0.05]
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stream import KeySnapshotReceiver
+from tank_protocol import decode_key_snapshot, encode_key_snapshot
+
+
+def receiver_loop(sock, receiver, latencies, state, stop):
+    while not stop.is_set():
+        try:
+            data, addr = sock.recvfrom(2048)
+        except socket.timeout:
+            continue
+        now = time.time()
+        accepted_before = receiver.accepted
+        for message in receiver.receive(data, addr, time.monotonic()):
+            if message['type'] == 'keydown':
+                state.add(message['key'])
+            else:
+                state.discard(message['key'])
+        if receiver.accepted > accepted_before:
+            latencies.append((now - decode_key_snapshot(data)[2]) * 1e6)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--packets', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=1000, help="Snapshots per second")
+    parser.add_argument('--loss', type=float, default=0.05, help="Fraction of packets dropped")
+    parser.add_argument('--reorder', type=float, default=0.05, help="Fraction of packets delayed past the next")
+    args = parser.parse_args()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(0.1)
+    receiver, latencies, state, stop = KeySnapshotReceiver(), [], set(), threading.Event()
+    thread = threading.Thread(target=receiver_loop, args=(server, receiver, latencies, state, stop), daemon=True)
+    thread.start()
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rng = random.Random(1)
+    session, keys, held, dropped = rng.getrandbits(32), set(), None, 0
+    for seq in range(1, args.packets + 1):
+        key = rng.choice("wasdqe")
+        keys.symmetric_difference_update({key})
+        packet = encode_key_snapshot(session, seq, keys, time.time())
+        if rng.random() < args.loss:
+            dropped += 1
+        elif held is None and rng.random() < args.reorder:
+            held = packet  # Delivered after the next packet, i.e. out of order
+        else:
+            client.sendto(packet, server.getsockname())
+            if held is not None:
+                client.sendto(held, server.getsockname())
+                held = None
+        time.sleep(1 / args.rate)
+
+    # The heartbeat a real client keeps sending heals any loss of the final snapshot
+    client.sendto(encode_key_snapshot(session, args.packets + 1, keys, time.time()), server.getsockname())
+    time.sleep(0.2)
+    stop.set()
+    thread.join()
+
+    latencies.sort()
+    print(f"sent {args.packets}, dropped by shim {dropped}, accepted {receiver.accepted}, "
+          f"discarded stale {receiver.stale}")
+    print(f"latency p50={percentile(latencies, 0.5):.0f} us  p90={percentile(latencies, 0.9):.0f} us  "
+          f"p99={percentile(latencies, 0.99):.0f} us  max={latencies[-1]:.0f} us")
+    print(f"final state {'matches' if state == keys else 'DIFFERS from'} sender ({sorted(keys)})")
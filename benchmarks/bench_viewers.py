@@ -0,0 +1,130 @@
+"""Load test for the video server: threaded vs asyncio mode with 1, 5 and 20 concurrent viewers.
+
+Each mode runs in its own server process fed by a synthetic camera (no webcam or Arduino needed).
+Viewers connect over loopback, negotiate MJPEG and read frames for a fixed time. Reports per-viewer
+frame rate plus the server process's CPU use, thread count and context switches.
+
+    python benchmarks/bench_viewers.py [--viewers 1 5 20] [--seconds 5] [--modes threaded async]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fakes import SyntheticCamera
+from main import FrameReceiver
+
+
+def serve(mode, port, fps):
+    from stream import AsyncVideoStreamServer, VideoStreamServer
+    server_class = AsyncVideoStreamServer if mode == 'async' else VideoStreamServer
+    server = server_class(video_port=port, control_port=port + 1, arduino_port=None, max_fps=fps,
+                          h264=False, udp_control=False, camera=SyntheticCamera(), metrics_port=0)
+    server.start_server()
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def viewer(port, seconds, counts, index, start):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'{"codecs": ["mjpeg"]}\n')
+    reply = b""
+    while not reply.endswith(b"\n"):
+        reply += sock.recv(1)
+    receiver = FrameReceiver(sock)
+    # Keep reading while the others connect so no backlog is counted once timing starts
+    deadline = None
+    while deadline is None or time.monotonic() < deadline:
+        payload = receiver.recv_frame()
+        if payload is None:
+            break
+        receiver.release(payload)
+        if deadline is None and start.is_set():
+            deadline = time.monotonic() + seconds
+        elif deadline is not None:
+            counts[index] += 1
+    sock.close()
+
+
+def process_stats(pid):
+    # CPU seconds (utime + stime), thread count and context switches summed over all threads
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    switches = 0
+    tasks = os.listdir(f"/proc/{pid}/task")
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/status") as f:
+                for line in f:
+                    if line.startswith(('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches')):
+                        switches += int(line.split()[1])
+        except FileNotFoundError:
+            pass  # Thread exited while we looked
+    return cpu, len(tasks), switches
+
+
+def run(mode, viewers, args):
+    port = args.port
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode,
+                               '--port', str(port), '--fps', str(args.fps)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(port):
+            print(f"{mode}: server did not start")
+            return
+        counts, start = [0] * viewers, threading.Event()
+        threads = [threading.Thread(target=viewer, args=(port, args.seconds, counts, i, start), daemon=True)
+                   for i in range(viewers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)  # Let every viewer finish negotiating
+
+        cpu_before, _, switches_before = process_stats(server.pid)
+        start.set()
+        time.sleep(args.seconds / 2)
+        _, thread_count, _ = process_stats(server.pid)
+        for thread in threads:
+            thread.join()
+        cpu_after, _, switches_after = process_stats(server.pid)
+
+        fps = np.array(counts) / args.seconds
+        print(f"{mode:>8} {viewers:>3} viewers: fps min {fps.min():5.1f} mean {fps.mean():5.1f}  "
+              f"server cpu {100 * (cpu_after - cpu_before) / args.seconds:5.1f}%  "
+              f"threads {thread_count:>3}  ctx switches/s {(switches_after - switches_before) / args.seconds:7.0f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--viewers', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--modes', nargs='+', choices=['threaded', 'async'], default=['threaded', 'async'])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--fps', type=int, default=20, help="Server capture frame rate")
+    parser.add_argument('--port', type=int, default=18888, help="Video port; control uses the next one")
+    parser.add_argument('--serve', choices=['threaded', 'async'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.fps)
+    else:
+        for mode in args.modes:
+            for viewers in args.viewers:
+                run(mode, viewers, args)
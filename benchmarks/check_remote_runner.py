@@ -0,0 +1,126 @@
+"""Checks main.py's RemoteRunner against FakeSSHServer (a local paramiko SSH server).
+
+Covers streamed output (lines are logged while the command is still running, stderr is tagged, bare \\r
+splits progress lines), how quickly output reaches the log now that the runner blocks on the channel
+instead of sleeping between polls, large output, and that a timeout or cancel() also kills the remote
+command rather than leaving it running on the Pi. Exits 1 if any check fails.
+
+    python benchmarks/check_remote_runner.py
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fakes import FakeSSHServer
+from main import RemoteRunner
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{f'  ({detail})' if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+class Log:
+    """RemoteRunner's log callback: keeps each line with its arrival time"""
+    def __init__(self):
+        self.lines = []
+
+    def __call__(self, message):
+        self.lines.append((time.time(), message))
+
+    def messages(self):
+        return [message for _, message in self.lines]
+
+
+def process_gone(pid, within=2.0):
+    deadline = time.monotonic() + within
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def read_pid(home):
+    with open(os.path.join(home, 'sleep.pid')) as f:
+        return int(f.read())
+
+
+def main(args):
+    home = tempfile.mkdtemp(prefix='fake-pi-')
+    server = FakeSSHServer(home)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', server.port, username='pi', password='raspberry')
+    try:
+        # Streaming: each line is logged as it is printed, not when the command exits
+        log = Log()
+        runner = RemoteRunner(client, log, threading.Event())
+        started = time.time()
+        status, output = runner.run('for i in 1 2 3 4 5; do echo line $i; echo warn $i >&2; sleep 0.2; done; '
+                                    'printf "10%%\\r50%%\\r100%%\\n"; exit 3')
+        first = next(at for at, message in log.lines if message == 'line 1')
+        check("exit status", status == 3, status)
+        check("stdout lines returned", output == [f"line {i}" for i in range(1, 6)] + ['10%', '50%', '100%'], output)
+        check("stderr logged with prefix", 'STDERR: warn 5' in log.messages())
+        check("first line logged while running", first - started < 0.5, f"after {first - started:.2f} s")
+
+        # Wake-up latency: remote timestamps against arrival in the log (same machine, same clock)
+        log = Log()
+        runner = RemoteRunner(client, log, threading.Event())
+        runner.run(f'for i in $(seq {args.samples}); do date +%s.%N; sleep 0.05; done')
+        delays = sorted((at - float(message)) * 1000 for at, message in log.lines)
+        p50, worst = delays[len(delays) // 2], delays[-1]
+        check("output wakes the runner", p50 < 10, f"p50 {p50:.1f} ms, max {worst:.1f} ms over {len(delays)} lines")
+
+        # A chatty command can't stall on a full channel window
+        started = time.monotonic()
+        status, output = runner.run(f'yes abcdefghij | head -n {args.lines}', timeout=30, echo=False)
+        check("large output", status == 0 and len(output) == args.lines,
+              f"{len(output)} lines in {time.monotonic() - started:.2f} s")
+
+        # Timeout returns promptly and kills the remote command
+        log = Log()
+        runner = RemoteRunner(client, log, threading.Event())
+        started = time.monotonic()
+        status, _ = runner.run('sleep 30 & echo $! > sleep.pid; wait', timeout=0.5)
+        elapsed = time.monotonic() - started
+        check("timeout returns", status is None and elapsed < 1.0, f"{elapsed:.2f} s")
+        check("timeout kills the remote command", process_gone(read_pid(home)))
+
+        # cancel() from another thread, as the Cancel button does
+        log = Log()
+        runner = RemoteRunner(client, log, threading.Event())
+        threading.Timer(0.3, runner.cancel).start()
+        started = time.monotonic()
+        status, _ = runner.run('sleep 30 & echo $! > sleep.pid; wait', timeout=60)
+        elapsed = time.monotonic() - started
+        check("cancel returns", status is None and elapsed < 0.3 + 2 * RemoteRunner.WAKE_INTERVAL, f"{elapsed:.2f} s")
+        check("cancel kills the remote command", process_gone(read_pid(home)))
+        check("no commands after cancel", runner.run('echo late') == (None, []))
+    finally:
+        client.close()
+        server.close()
+        shutil.rmtree(home, ignore_errors=True)
+
+    print(f"{len(failures)} check(s) failed" if failures else "all checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=40, help="Timestamped lines for the wake-up latency check")
+    parser.add_argument('--lines', type=int, default=200000, help="Lines for the large output check")
+    sys.exit(main(parser.parse_args()))
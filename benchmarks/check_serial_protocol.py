@@ -0,0 +1,85 @@
+"""Checks stream.py's two-byte binary serial commands (encode_binary_command / decode_binary_command).
+
+Round trips every key in SERIAL_KEYS with both actions, then checks that corrupted input is refused:
+a bad checksum, a text byte (top bit clear) and a key index past the end of SERIAL_KEYS. Finally sends
+every command to FakeArduino over its pty, which decodes them the way the sketch does. Exits 1 if any
+check fails.
+
+    python benchmarks/check_serial_protocol.py
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fakes import FakeArduino
+from stream import SERIAL_KEYS, decode_binary_command, encode_binary_command
+
+failures = []
+
+
+def check(name, ok, detail=""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{f'  ({detail})' if detail else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def rejects(data, reason):
+    try:
+        decoded = decode_binary_command(data)
+    except ValueError as e:
+        return reason in str(e), str(e)
+    return False, f"decoded as {decoded}"
+
+
+def main(args):
+    commands = [(action, key) for key in SERIAL_KEYS for action in ('keydown', 'keyup')]
+    encoded = {command: encode_binary_command(*command) for command in commands}
+
+    bad = [command for command, data in encoded.items() if data is None or decode_binary_command(data) != command]
+    check(f"round trip, {len(commands)} commands", not bad, bad)
+    check("first byte marks binary, second is its checksum",
+          all(data[0] & 0x80 and data[1] == ~data[0] & 0x7F for data in encoded.values()))
+    check("commands are distinct", len(set(encoded.values())) == len(commands))
+    check("no binary form for other keys or actions",
+          [encode_binary_command(*command) for command in (('keydown', 'x'), ('keydown', 'wa'), ('press', 'w'))]
+          == [None, None, None])
+
+    # Every single-bit error in the checksum byte is caught
+    caught = [rejects(bytes((data[0], data[1] ^ (1 << bit))), "bad checksum")[0]
+              for data in encoded.values() for bit in range(7)]
+    check("bad checksum rejected", all(caught), f"{caught.count(True)}/{len(caught)} corruptions")
+
+    ok, detail = rejects(b"w\n", "not a binary command")
+    check("text byte rejected", ok, detail)
+
+    command = 0x80 | 0x40 | len(SERIAL_KEYS)  # One past the last key, with a valid checksum
+    ok, detail = rejects(bytes((command, ~command & 0x7F)), "unknown key index")
+    check("unknown key index rejected", ok, detail)
+
+    # The same bytes through FakeArduino's pty, which also answers a corrupted command
+    arduino = FakeArduino()
+    try:
+        with open(arduino.port, 'r+b', buffering=0) as port:
+            for data in encoded.values():
+                port.write(data)
+            port.write(bytes((encoded[commands[0]][0], encoded[commands[0]][1] ^ 1)))
+            deadline = time.monotonic() + args.timeout
+            reply = b""
+            while b"Bad checksum" not in reply and time.monotonic() < deadline:
+                reply += os.read(port.fileno(), 4096)
+        received = [f"{action}:{key}" for action, key in commands]
+        check("FakeArduino decodes every command", arduino.commands == received, arduino.commands)
+        check("FakeArduino answers a bad checksum", b"Bad checksum" in reply)
+    finally:
+        arduino.close()
+
+    print(f"{len(failures)} check(s) failed" if failures else "all checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--timeout', type=float, default=2.0, help="Seconds to wait for FakeArduino's replies")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,124 @@
+"""Serial benchmarks against the pty FakeArduino from fakes.py: command latency and key-repeat storms.
+
+The fake answers like ArduinoTankController.ino, optionally pacing bytes at the current baud rate.
+
+    python benchmarks/fake_arduino.py              # measure SerialLink command -> response latency
+    python benchmarks/fake_arduino.py --storm 3    # key-repeat storm at 9600 baud: merging and release latency
+    python benchmarks/fake_arduino.py --baud 9600 --negotiate 115200   # text at 9600 vs binary at 115200
+    python benchmarks/fake_arduino.py --serve      # print a port for stream.py --arduino-port and keep running
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fakes import FakeArduino
+from stream import SerialLink
+
+
+def measure(args):
+    """One-way latency from SerialLink.send() until the Arduino has the whole command"""
+    arrived, received = [], threading.Condition()
+
+    def on_command(command):
+        with received:
+            arrived.append(time.perf_counter())
+            received.notify_all()
+
+    arduino = FakeArduino(args.baud, on_command=on_command)
+    link = SerialLink(arduino.port, args.baud or 115200)  # The byte budget follows the baud rate
+    if args.negotiate and not link.negotiate(args.negotiate, binary=not args.text):
+        print("negotiation failed")
+    arrived.clear()  # The protocol request itself
+    link.start()
+
+    latencies = []
+    for i in range(args.commands):
+        sent = time.perf_counter()
+        link.send('keydown' if i % 2 == 0 else 'keyup', 'w')  # Alternating, so nothing is merged
+        with received:
+            if not received.wait_for(lambda: len(arrived) > i, timeout=2.0):
+                print(f"command {i} never arrived")
+                break
+        latencies.append((arrived[i] - sent) * 1000)
+
+    stats = link.stats()
+    link.close()
+    arduino.close()
+
+    latencies.sort()
+    if latencies:
+        pacing = f"{stats['baudrate']} baud" if args.baud else "unpaced pty"
+        print(f"{len(latencies)} {stats['protocol']} commands ({pacing}): "
+              f"{stats['bytes_written'] / len(latencies):.1f} bytes each  "
+              f"p50 {latencies[len(latencies) // 2]:.2f} ms  "
+              f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]:.2f} ms  "
+              f"max {latencies[-1]:.2f} ms")
+
+
+def storm(args):
+    """Several clients hammer the link with key repeats while one key is released; how long does the stop take?"""
+    baud = args.baud or 9600
+    released = threading.Event()
+    arduino = FakeArduino(baud, on_command=lambda command: command == "keyup:w" and released.set())
+    link = SerialLink(arduino.port, baud)
+    link.start()
+
+    stop = threading.Event()
+
+    def client(keys):
+        i = 0
+        while not stop.is_set():
+            key = keys[i % len(keys)]
+            link.send('keydown', key)  # Auto-repeat: the same press over and over
+            if i % 5 == 4:
+                link.send('keyup', key)
+            i += 1
+            time.sleep(0.002)
+
+    link.send('keydown', 'w')
+    threads = [threading.Thread(target=client, args=(keys,), daemon=True) for keys in ("asd", "qe", "rty")]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.storm)
+
+    sent = time.perf_counter()
+    link.send('keyup', 'w')
+    released.wait(5.0)
+    release_ms = (time.perf_counter() - sent) * 1000
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"{args.storm:.0f} s storm at {baud} baud: {link.stats()}")
+    print(f"keyup:w reached the Arduino in {release_ms:.1f} ms" if released.is_set() else "keyup:w was lost")
+    link.close()
+    arduino.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--serve', action='store_true', help="Only run the fake Arduino and print its port")
+    parser.add_argument('--baud', type=int, default=None, help="Pace bytes like a real link at this baud rate")
+    parser.add_argument('--commands', type=int, default=500)
+    parser.add_argument('--negotiate', type=int, default=None, metavar='BAUD',
+                        help="Request the binary protocol at this baud rate first, like stream.py does")
+    parser.add_argument('--text', action='store_true', help="With --negotiate, only change the baud rate")
+    parser.add_argument('--storm', type=float, default=None, metavar='SECONDS',
+                        help="Run a multi-client key-repeat storm instead of the round-trip measurement")
+    args = parser.parse_args()
+
+    if args.storm:
+        storm(args)
+    elif args.serve:
+        arduino = FakeArduino(args.baud)
+        print(f"Fake Arduino on {arduino.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            arduino.close()
+    else:
+        measure(args)
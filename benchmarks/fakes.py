@@ -0,0 +1,269 @@
+"""Stand-ins for the tank's hardware, so the server can run on any Linux machine.
+
+SyntheticCamera replaces cv2.VideoCapture with generated frames, or loops frames from a recorded
+video file. FakeArduino opens a pseudo-terminal and answers on it the way ArduinoTankController.ino does
+("Incoming command: keydown:w", "Forward ON", ...), including the two-byte binary commands and the
+"proto:" baud/protocol request, optionally pacing bytes at the current baud rate.
+Its `port` path can be passed anywhere a serial device is expected.
+FakeSSHServer is an SSH server on localhost that runs commands in a scratch home directory the way sshd
+on the Pi would, for exercising main.py's deploy steps (needs paramiko).
+"""
+import os
+import pty
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tty
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_enhance import synthetic_frame
+from stream import SKETCH_FACES, SKETCH_KEY_NAMES, decode_binary_command
+
+
+class SyntheticCamera:
+    """Stands in for cv2.VideoCapture at the camera's frame rate: a moving bar over a fixed test image,
+    or the frames of a recorded video (`source`), looped"""
+    def __init__(self, fps=30, source=None):
+        self.interval = 1.0 / fps
+        self.count = 0
+        self.frames = None
+        if source:
+            self.frames = self.load(source)
+        else:
+            self.frame = synthetic_frame()
+
+    @staticmethod
+    def load(source, limit=300):
+        # Decoded up front so replay costs the server nothing beyond a copy
+        capture = cv2.VideoCapture(source)
+        frames = []
+        while len(frames) < limit:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frames.append(cv2.resize(frame, (640, 480)) if frame.shape[:2] != (480, 640) else frame)
+        capture.release()
+        if not frames:
+            raise ValueError(f"No frames in {source}")
+        return frames
+
+    def set(self, prop, value):
+        return True
+
+    def read(self):
+        time.sleep(self.interval)
+        self.count += 1
+        if self.frames:
+            return True, self.frames[self.count % len(self.frames)].copy()
+        frame = self.frame.copy()
+        x = (self.count * 8) % (frame.shape[1] - 32)
+        frame[:, x:x + 32] = 255
+        return True, frame
+
+    def release(self):
+        pass
+
+
+class FakeArduino:
+    """Speaks the sketch's text protocol on the master side of a pty; `port` is the slave device path"""
+    def __init__(self, baudrate=None, on_command=None):
+        self.on_command = on_command
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)  # No echo or newline translation, like a real serial line
+        self.port = os.ttyname(self.slave)
+        self.paced = bool(baudrate)
+        self.set_baudrate(baudrate or 9600)
+        self.commands = []
+        self.replies = queue.Queue()  # Transmit runs on its own thread: a UART is full duplex
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        threading.Thread(target=self.transmit, daemon=True).start()
+
+    def set_baudrate(self, baudrate):
+        self.baudrate = baudrate
+        self.byte_time = 10.0 / baudrate if self.paced else 0.0  # 8N1: ten bit times per byte
+
+    def run(self):
+        line, pending_binary = bytearray(), None
+        while self.running:
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                break
+            if self.byte_time:
+                time.sleep(len(data) * self.byte_time)
+            for byte in data:
+                if pending_binary is not None:
+                    self.binary_command(pending_binary, byte)
+                    pending_binary = None
+                elif byte & 0x80:
+                    pending_binary = byte
+                elif byte == ord("\n"):
+                    command = line.decode('utf-8', errors='replace').strip()
+                    line.clear()
+                    if command:
+                        self.text_command(command)
+                else:
+                    line.append(byte)
+
+    def text_command(self, command):
+        self.received(command)
+        lines = [f"Incoming command: {command}"]
+        action, _, key = command.lower().partition(':')
+        if action == 'proto':
+            mode, _, baud = key.partition(',')
+            lines.append(f"PROTO {'binary' if mode == 'binary' else 'text'} {baud}")
+            self.send("".join(line + "\r\n" for line in lines).encode('utf-8'))
+            self.replies.join()  # Like Serial.flush(): the reply leaves at the old rate
+            self.set_baudrate(int(baud))
+            return
+        if action in ('keydown', 'keyup') and len(key) == 1:
+            lines += self.key_lines(action == 'keydown', key)
+        self.send("".join(line + "\r\n" for line in lines).encode('utf-8'))
+
+    def binary_command(self, command, checksum):
+        try:
+            action, key = decode_binary_command(bytes((command, checksum)))
+        except ValueError:
+            self.send(b"Bad checksum\r\n")
+            return
+        self.received(f"{action}:{key}")
+        self.send("".join(line + "\r\n" for line in self.key_lines(action == 'keydown', key)).encode('utf-8'))
+
+    def received(self, command):
+        self.commands.append(command)
+        if self.on_command:
+            self.on_command(command)
+
+    @staticmethod
+    def key_lines(down, key):
+        if key in SKETCH_KEY_NAMES:
+            return [f"{SKETCH_KEY_NAMES[key]} {'ON' if down else 'OFF'}"]
+        if key in SKETCH_FACES:
+            return [f"Face: {SKETCH_FACES[key]}"] if down else []
+        return [f"Unknown key: {key}"]
+
+    def send(self, data):
+        self.replies.put(data)
+
+    def transmit(self):
+        while self.running:
+            data = self.replies.get()
+            if data is None:
+                self.replies.task_done()
+                break
+            if self.byte_time:
+                time.sleep(len(data) * self.byte_time)
+            try:
+                os.write(self.master, data)
+            except OSError:
+                break
+            finally:
+                self.replies.task_done()
+
+    def close(self):
+        self.running = False
+        self.replies.put(None)
+        for fd in (self.slave, self.master):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class FakeSSHServer:
+    """SSH on localhost: any password is accepted, and exec requests run under `sh -c` in `home`.
+    Like sshd, each command's shell leads its own session (so its PID is the process group), and a
+    closed channel is only noticed by the command when it next writes output."""
+    def __init__(self, home, port=0):
+        import paramiko  # Only the deploy checks need it, not the Pi-side benchmarks
+        self.home = home
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+
+        fake = self
+
+        class Interface(paramiko.ServerInterface):
+            def get_allowed_auths(self, username):
+                return 'password'
+
+            def check_auth_password(self, username, password):
+                return paramiko.AUTH_SUCCESSFUL
+
+            def check_channel_request(self, kind, chanid):
+                return paramiko.OPEN_SUCCEEDED
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(target=fake.run_command, args=(channel, command.decode('utf-8')),
+                                 daemon=True).start()
+                return True
+
+        self.interface = Interface
+        self.transport_class = paramiko.Transport
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                break
+            transport = self.transport_class(connection)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=self.interface())
+            self.transports.append(transport)
+
+    def run_command(self, channel, command):
+        process = subprocess.Popen(['sh', '-c', command], cwd=self.home, env={**os.environ, 'HOME': self.home},
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+
+        def pump(source, send):
+            for chunk in iter(lambda: os.read(source.fileno(), 32768), b''):
+                try:
+                    send(chunk)
+                except (EOFError, OSError):
+                    break  # Channel gone: the command gets SIGPIPE on its next write, as under sshd
+            source.close()
+
+        def feed():
+            # scp sends the file over stdin
+            try:
+                for chunk in iter(lambda: channel.recv(32768), b''):
+                    process.stdin.write(chunk)
+                    process.stdin.flush()
+            except (EOFError, OSError):
+                pass
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+        threading.Thread(target=feed, daemon=True).start()
+        stderr = threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))
+        stderr.start()
+        pump(process.stdout, channel.sendall)
+        stderr.join()
+        status = process.wait()
+        try:
+            channel.send_exit_status(status if status >= 0 else 128 - status)  # Killed by a signal, as a shell reports it
+            channel.shutdown_write()
+            channel.close()
+        except (EOFError, OSError):
+            pass
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
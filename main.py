@@ -6,16 +6,714 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import numpy as np
 import json
-from PIL import Image, ImageTk, ImageEnhance, ImageFilter
+import logging
+import logging.handlers
+from PIL import Image, ImageTk
 import time
 import paramiko
 import shutil
 import scp
 from scp import SCPClient
 import os
+import random
+import re
+import select
 import tempfile
+import csv
+import hashlib
+import io
+import tarfile
+from collections import deque, namedtuple
+from functools import lru_cache
 from pathlib import Path
 
+try:
+    import av  # PyAV, optional: enables H.264 video
+except ImportError:
+    av = None
+
+# Control protocol, UDP key snapshots and frame timestamps, shared with stream.py
+from tank_protocol import (CONTROL_VERSION, FRAME_TIMESTAMPS, decode_control_payload, encode_control_frame,
+                           encode_key_snapshot)
+
+class UdpKeySender:
+    """Sends the full set of pressed keys as sequence-numbered UDP snapshots; the server keeps only the newest"""
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.session = random.getrandbits(32)
+        self.seq = 0
+
+    def send(self, keys):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.sock.sendto(encode_key_snapshot(self.session, self.seq, keys, time.time()), self.address)
+
+    def close(self):
+        self.sock.close()
+
+class ControlChannel:
+    """Client end of the control protocol: a versioned hello line, then length-prefixed frames both ways.
+    Falls back to the legacy unframed JSON/text protocol if the server never answers the hello."""
+    def __init__(self, sock, binary=True):
+        self.sock = sock
+        self.binary = binary
+        self.framed = False
+        self.version = 1
+        self.buffer = bytearray()
+        self.errors = []
+        self.send_lock = threading.Lock()
+
+    def handshake(self, transports=()):
+        """Send our hello and read the reply line; uses the socket's current timeout"""
+        encodings = ['binary', 'json'] if self.binary else ['json']
+        hello = {"hello": "tank-control", "version": CONTROL_VERSION, "encodings": encodings,
+                 "transports": list(transports)}
+        self.sock.sendall((json.dumps(hello) + "\n").encode('utf-8'))
+
+        reply = b""
+        try:
+            while not reply.endswith(b"\n"):
+                byte = self.sock.recv(1)
+                if not byte:
+                    raise ConnectionError("Control socket closed during handshake")
+                reply += byte
+        except socket.timeout:
+            self.binary = False
+            return None  # Legacy server
+
+        reply = json.loads(reply.decode('utf-8'))
+        self.version = reply.get('version', 1)
+        self.binary = reply.get('encoding') == 'binary'
+        self.framed = True
+        return reply
+
+    def send(self, message):
+        if self.framed:
+            data = encode_control_frame(message, self.binary)
+        else:
+            data = json.dumps(message).encode('utf-8')
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        """Block for the next batch of server messages; returns None once the socket closes"""
+        data = self.sock.recv(4096)
+        if not data:
+            return None
+        if not self.framed:
+            return [self.legacy_message(data.decode('utf-8', errors='replace'))]
+
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 2:
+            size = struct.unpack_from("!H", self.buffer)[0]
+            if len(self.buffer) < 2 + size:
+                break
+            payload = self.buffer[2:2 + size]
+            del self.buffer[:2 + size]
+            try:
+                messages.append(decode_control_payload(payload))
+            except (ValueError, IndexError) as e:
+                # Skip frames we can't decode (e.g. a kind added by a newer server) rather than dropping the channel
+                self.errors.append(f"{e}: {bytes(payload)!r}")
+        return messages
+
+    def drain_errors(self):
+        errors, self.errors = self.errors, []
+        return errors
+
+    @staticmethod
+    def legacy_message(text):
+        # Legacy servers send tagged text
+        if text.startswith("ARDUINO_MSG:"):
+            return {"type": "arduino", "message": text.replace("ARDUINO_MSG:", "").strip()}
+        if text.startswith("PACING_MSG:"):
+            return {"type": "pacing", **json.loads(text.replace("PACING_MSG:", "", 1))}
+        return {"type": "text", "message": text}
+
+class FrameReceiver:
+    """Reads length-prefixed frames straight into pooled buffers with recv_into (no intermediate copies).
+    A payload can be handed to another thread as is; its consumer gives the buffer back with release()."""
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, sock, max_frame_size=1024 * 1024, initial_size=128 * 1024):
+        self.sock = sock
+        self.max_frame_size = max_frame_size
+        self.initial_size = initial_size
+        self.header = bytearray(self.HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.free = []  # Released buffers; one that is never released is simply garbage collected
+        self.free_lock = threading.Lock()
+        self.bytes_received = 0
+
+    def recv_exact(self, view):
+        # Fill the whole view; only ever asks the socket for bytes belonging to the current frame
+        received = 0
+        while received < len(view):
+            count = self.sock.recv_into(view[received:], len(view) - received)
+            if count == 0:
+                return False
+            received += count
+        self.bytes_received += received
+        return True
+
+    def recv_frame(self):
+        """Return a memoryview of the next payload, or None once the socket closes.
+        Its buffer is never reused until passed to release()."""
+        if not self.recv_exact(self.header_view):
+            return None
+        size = self.HEADER.unpack_from(self.header)[0]
+        if size > self.max_frame_size:
+            raise ValueError(f"Invalid frame size: {size}")
+
+        with self.free_lock:
+            buffer = self.free.pop() if self.free else None
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(max(size, self.initial_size))
+        payload = memoryview(buffer)[:size]
+        if not self.recv_exact(payload):
+            return None
+        return payload
+
+    def release(self, payload):
+        # payload is a view returned by recv_frame (or a slice of one); its buffer may be refilled from now on
+        with self.free_lock:
+            self.free.append(payload.obj)
+
+class LatestSlot:
+    """Single-slot handoff between pipeline stages: put() replaces an unconsumed item, so readers only see the newest"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.has_item = False
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """Store item; returns the unconsumed item it replaced, or None"""
+        with self.condition:
+            replaced = None
+            if self.has_item:
+                self.dropped += 1
+                replaced = self.item
+            self.item = item
+            self.has_item = True
+            self.condition.notify()
+            return replaced
+
+    def get(self, timeout=0.5):
+        # Wait for an item; returns None on timeout or once closed
+        with self.condition:
+            self.condition.wait_for(lambda: self.has_item or self.closed, timeout)
+            return self.take_locked()
+
+    def take(self):
+        # Non-blocking get
+        with self.condition:
+            return self.take_locked()
+
+    def take_locked(self):
+        if not self.has_item:
+            return None
+        item = self.item
+        self.item = None
+        self.has_item = False
+        return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class EnhancementParams(namedtuple('EnhancementParams', 'brightness contrast sharpness')):
+    """Immutable snapshot of the enhancement sliders, rebuilt only when a slider moves"""
+    __slots__ = ()
+
+    @property
+    def adjusts_tone(self):
+        return self.brightness != 1.0 or self.contrast != 1.0
+
+    @property
+    def unsharp(self):
+        return self.sharpness > 1.5
+
+    @property
+    def sharpens(self):
+        return self.sharpness != 1.0
+
+class FrameEnhancer:
+    """Brightness, contrast and sharpness applied to the decoded uint8 BGR array: one LUT pass for the tone,
+    one filter2D pass for Sharpness and, above 1.5, an UnsharpMask pass, reproducing the ImageEnhance chain.
+    Intermediate buffers are reused across frames."""
+    # ImageFilter.SMOOTH, the degenerate image ImageEnhance.Sharpness blends against
+    SMOOTH = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+    IDENTITY = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]], dtype=np.float32)
+    # ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3)
+    UNSHARP_SIGMA = 1.0
+    UNSHARP_AMOUNT = 1.5
+    UNSHARP_THRESHOLD = 3
+
+    def __init__(self):
+        self.buffers = {}
+
+    def buffer(self, name, shape):
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self.buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buf
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def brightness_lut(brightness):
+        # ImageEnhance.Brightness: blend towards black, truncated to uint8
+        return np.clip(np.arange(256, dtype=np.float32) * brightness, 0, 255).astype(np.uint8)
+
+    @classmethod
+    @lru_cache(maxsize=512)
+    def tone_lut(cls, brightness, contrast, mean):
+        # ImageEnhance.Brightness then ImageEnhance.Contrast (blend towards black, then towards the mean grey)
+        values = mean + contrast * (cls.brightness_lut(brightness).astype(np.float32) - mean)
+        return np.clip(values, 0, 255).astype(np.uint8)
+
+    @classmethod
+    @lru_cache(maxsize=64)
+    def sharpen_kernel(cls, sharpness):
+        # ImageEnhance.Sharpness blends the image with its SMOOTH-filtered copy: a single linear kernel
+        return sharpness * cls.IDENTITY + (1 - sharpness) * cls.SMOOTH
+
+    def contrast_mean(self, frame, brightness):
+        # ImageEnhance.Contrast takes the mean grey of the already brightened image, so clipped highlights count
+        # as clipped; scaling the original mean by brightness overshoots whenever anything saturates
+        if brightness != 1.0:
+            frame = cv2.LUT(frame, self.brightness_lut(brightness), dst=self.buffer('brightened', frame.shape))
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer('gray', frame.shape[:2]))
+        return int(cv2.mean(gray)[0] + 0.5)
+
+    def unsharp_mask(self, frame):
+        # A separate pass on the clipped uint8 Sharpness output, as in PIL; pixels within the threshold of
+        # their blurred value are left alone, so faint noise isn't amplified. Modifies frame in place.
+        blurred = cv2.GaussianBlur(frame, (5, 5), self.UNSHARP_SIGMA, dst=self.buffer('blurred', frame.shape),
+                                   borderType=cv2.BORDER_REPLICATE)
+        difference = cv2.absdiff(frame, blurred, dst=self.buffer('difference', frame.shape))
+        mask = cv2.compare(difference, self.UNSHARP_THRESHOLD, cv2.CMP_GE)
+        sharpened = cv2.addWeighted(frame, 1 + self.UNSHARP_AMOUNT, blurred, -self.UNSHARP_AMOUNT, 0,
+                                    dst=self.buffer('unsharp', frame.shape))
+        return cv2.copyTo(sharpened, mask, frame)
+
+    def enhance(self, frame, params):
+        """Return the enhanced frame as a new RGB array; stages that are identities for params are skipped"""
+        if params.adjusts_tone:
+            # The contrast mean only matters when contrast isn't 1
+            mean = self.contrast_mean(frame, params.brightness) if params.contrast != 1.0 else 0
+            lut = self.tone_lut(params.brightness, params.contrast, mean)
+            frame = cv2.LUT(frame, lut, dst=self.buffer('toned', frame.shape))
+
+        if params.sharpens:
+            frame = cv2.filter2D(frame, -1, self.sharpen_kernel(params.sharpness),
+                                 dst=self.buffer('sharpened', frame.shape), borderType=cv2.BORDER_REPLICATE)
+            if params.unsharp:
+                frame = self.unsharp_mask(frame)
+
+        # Fresh output array: it is handed to another thread while the buffers above get reused
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+class DisplayScaler:
+    """Fits frames to the video label: no resize when sizes already match, cheap interpolation otherwise,
+    and JPEG decode-time downscaling when the label is at most half the source size"""
+    REDUCED_DECODE = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+    def __init__(self, box=(640, 480)):
+        self.box = box
+        self.quality = False
+        self.source_size = None  # Full-resolution size of the last decoded frame
+
+    def target_size(self, width, height):
+        # Largest size that fits the label while keeping the aspect ratio
+        scale = min(self.box[0] / width, self.box[1] / height)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    def decode_mode(self):
+        """(imdecode flag, reduction factor) for the next JPEG"""
+        if self.quality or self.source_size is None:
+            return cv2.IMREAD_COLOR, 1
+        width, height = self.source_size
+        target_width, target_height = self.target_size(width, height)
+        for factor, flag in self.REDUCED_DECODE:
+            if width // factor >= target_width and height // factor >= target_height:
+                return flag, factor
+        return cv2.IMREAD_COLOR, 1
+
+    def resize(self, frame):
+        height, width = frame.shape[:2]
+        target = self.target_size(width, height)
+        if target == (width, height):
+            return frame
+        if self.quality:
+            interpolation = cv2.INTER_LANCZOS4
+        elif target[0] < width:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = cv2.INTER_LINEAR
+        return cv2.resize(frame, target, interpolation=interpolation)
+
+# Latency telemetry. Each span is (stage, start stamp, end stamp); stamps are wall-clock seconds, and the
+# ones taken on the Pi are moved onto our clock with ClockSync's offset where a span crosses machines.
+VIDEO_SPANS = (('encode', 'capture', 'encoded'), ('server_queue', 'encoded', 'sent'),
+               ('network', 'sent', 'received'), ('decode', 'received', 'decoded'),
+               ('enhance', 'decoded', 'enhanced'), ('display', 'enhanced', 'displayed'),
+               ('video_total', 'capture', 'displayed'))
+KEY_SPANS = (('key_to_server', 'key_sent', 'server_received'), ('server_to_serial', 'server_received', 'serial_written'),
+             ('serial_to_ack', 'serial_written', 'arduino_ack'), ('ack_to_client', 'arduino_ack', 'client_received'),
+             ('key_total', 'key_sent', 'client_received'))
+SERVER_STAMPS = {'capture', 'encoded', 'sent', 'server_received', 'serial_written', 'arduino_ack'}
+
+class ClockSync:
+    """Estimates (server clock - our clock) from ping/pong round trips, trusting the fastest recent one"""
+    def __init__(self, samples=8):
+        self.samples = deque(maxlen=samples)  # (round trip, offset)
+
+    def update(self, client_sent, server_time, client_received):
+        self.samples.append((client_received - client_sent, server_time - (client_sent + client_received) / 2))
+
+    @property
+    def offset(self):
+        return min(self.samples)[1] if self.samples else None
+
+class LatencyStats:
+    """Rolling latency samples (ms) per pipeline stage, with percentiles, histograms and JSON/CSV export"""
+    STAGES = tuple(stage for stage, _, _ in VIDEO_SPANS + KEY_SPANS)
+
+    def __init__(self, window=500):
+        self.lock = threading.Lock()
+        self.samples = {stage: deque(maxlen=window) for stage in self.STAGES}
+
+    def record_spans(self, spans, stamps, offset):
+        for stage, start, end in spans:
+            if stamps.get(start) is None or stamps.get(end) is None:
+                continue
+            crosses = (start in SERVER_STAMPS) != (end in SERVER_STAMPS)
+            if crosses and offset is None:
+                continue  # No clock estimate yet
+            begin = stamps[start] - (offset if crosses and start in SERVER_STAMPS else 0)
+            finish = stamps[end] - (offset if crosses and end in SERVER_STAMPS else 0)
+            with self.lock:
+                self.samples[stage].append((finish - begin) * 1000)
+
+    def values(self, stage):
+        with self.lock:
+            return np.array(self.samples[stage])
+
+    def summary(self):
+        summary = {}
+        for stage in self.STAGES:
+            values = self.values(stage)
+            if len(values):
+                p50, p90, p99 = np.percentile(values, (50, 90, 99))
+                summary[stage] = {"count": len(values), "p50": p50, "p90": p90, "p99": p99, "max": values.max()}
+            else:
+                summary[stage] = {"count": 0}
+        return summary
+
+    def histogram(self, stage, bins=20):
+        values = self.values(stage)
+        return np.histogram(values, bins=bins) if len(values) else (np.zeros(0), np.zeros(0))
+
+    def clear(self):
+        with self.lock:
+            for samples in self.samples.values():
+                samples.clear()
+
+    def export_json(self, path, **extra):
+        summary = {stage: {k: int(v) if k == "count" else float(v) for k, v in stats.items()}
+                   for stage, stats in self.summary().items()}
+        samples = {stage: self.values(stage).round(3).tolist() for stage in self.STAGES}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({**extra, "summary": summary, "samples_ms": samples}, f, indent=2)
+
+    def export_csv(self, path):
+        # One row per sample, oldest first within each stage
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "latency_ms"])
+            for stage in self.STAGES:
+                writer.writerows((stage, f"{value:.3f}") for value in self.values(stage))
+
+class LogSink(logging.Handler):
+    """Status console handler. emit() only queues the formatted line, so any thread can log; the Tk thread
+    inserts everything queued in one batch per interval and evicts the oldest lines beyond max_lines."""
+    def __init__(self, root, max_lines=2000, interval_ms=100, max_queued=10000):
+        super().__init__()
+        self.setFormatter(logging.Formatter('%(asctime)s - %(message)s', '%H:%M:%S'))
+        self.root = root
+        self.widget = None  # Lines queue up until the console exists
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.lines = deque(maxlen=max_queued)  # If the Tk thread stalls, the oldest lines go first
+        self.dropped = 0
+        self.root.after(self.interval_ms, self.drain)
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def attach(self, widget):
+        self.widget = widget
+
+    def drain(self):
+        # Tk thread only
+        if self.widget is not None and self.lines:
+            batch = []
+            while self.lines:
+                batch.append(self.lines.popleft())
+            if self.dropped:
+                batch.append(f"({self.dropped} log lines dropped)")
+                self.dropped = 0
+
+            # Only follow new lines if the user hasn't scrolled up to read something
+            following = self.widget.yview()[1] >= 1.0
+            self.widget.config(state=tk.NORMAL)
+            self.widget.insert(tk.END, "\n".join(batch[-self.max_lines:]) + "\n")
+            excess = int(self.widget.index('end-1c').split('.')[0]) - 1 - self.max_lines
+            if excess > 0:
+                self.widget.delete('1.0', f'{excess + 1}.0')
+            self.widget.config(state=tk.DISABLED)
+            if following:
+                self.widget.see(tk.END)
+        self.root.after(self.interval_ms, self.drain)
+
+class RemoteRunner:
+    """Runs shell commands on the Pi, streaming stdout/stderr into the log line by line as it arrives.
+    Output is drained continuously, so a chatty command can't stall on a full channel window.
+    Every command has a timeout; on timeout or cancel() the remote process group is killed, and after
+    cancel() new commands are refused."""
+    LINE_BREAK = re.compile(rb'\r\n|\r|\n')  # Progress output redraws with bare \r
+    WAKE_INTERVAL = 0.1  # Longest wait for output before checking timeout and cancel again
+
+    def __init__(self, ssh_client, log, cancelled):
+        self.ssh_client = ssh_client
+        self.log = log
+        self.cancelled = cancelled  # threading.Event shared with the rest of the deployment
+
+    def run(self, command, timeout=60, echo=True):
+        """Returns (exit status, stdout lines); the status is None if the command timed out or was cancelled.
+        With echo, every line is logged as it arrives."""
+        if self.cancelled.is_set():
+            return None, []
+        channel = self.ssh_client.get_transport().open_session()
+        output, partial = [], {False: b"", True: b""}
+        pid = None  # sshd starts the command's shell as a session leader, so its PID is also the process group
+        deadline = time.monotonic() + timeout
+        try:
+            channel.exec_command(f'echo $$; {command}')
+            while True:
+                received = False
+                for is_stderr, ready, recv in ((False, channel.recv_ready, channel.recv),
+                                               (True, channel.recv_stderr_ready, channel.recv_stderr)):
+                    if ready():
+                        received = True
+                        *lines, partial[is_stderr] = self.LINE_BREAK.split(partial[is_stderr] + recv(32768))
+                        if not is_stderr and pid is None and lines:
+                            pid = lines.pop(0).decode('ascii', errors='replace').strip()
+                        for line in lines:
+                            self.emit(line, is_stderr, output, echo)
+                if received:
+                    continue
+                if channel.eof_received and channel.exit_status_ready():
+                    break
+                if self.cancelled.is_set():
+                    self.log(f"Cancelled: {command}")
+                    self.kill(pid)
+                    return None, output
+                if time.monotonic() > deadline:
+                    self.log(f"Timed out after {timeout} s: {command}")
+                    self.kill(pid)
+                    return None, output
+                # Sleep until output arrives (the channel's fileno wakes on stdout and stderr) or the exit status does
+                if channel.eof_received:
+                    channel.status_event.wait(self.WAKE_INTERVAL)
+                else:
+                    select.select([channel], [], [], self.WAKE_INTERVAL)
+            for is_stderr, line in partial.items():
+                self.emit(line, is_stderr, output, echo)
+            return channel.recv_exit_status(), output
+        finally:
+            channel.close()
+
+    def kill(self, pid):
+        # Closing the channel alone leaves the command running on the Pi until it next writes output
+        if not pid or not pid.isdigit():
+            return
+        try:
+            channel = self.ssh_client.get_transport().open_session()
+            channel.exec_command(f'kill -TERM -{pid}')  # No '--': dash's kill rejects it
+            channel.status_event.wait(5)
+            channel.close()
+        except Exception as e:
+            self.log(f"Could not stop remote process group {pid}: {e}")
+
+    def emit(self, line, is_stderr, output, echo):
+        line = line.decode('utf-8', errors='replace').rstrip()
+        if not line:
+            return
+        if not is_stderr:
+            output.append(line)
+        if echo:
+            self.log(f"STDERR: {line}" if is_stderr else line)
+
+    def cancel(self):
+        # run() notices within WAKE_INTERVAL and kills the remote command; no new commands start after this
+        self.cancelled.set()
+
+class DeployManifest:
+    """Content hashes of what is deployed on the Pi, cached there, so unchanged uploads and flashes can be skipped.
+    Also remembers how long each step took, to report the time saved when it is skipped."""
+    REMOTE_PATH = '.tank_deploy_manifest.json'  # In the SSH user's home directory
+    STEP_NAMES = {'python_upload': "Python upload", 'arduino_upload': "Arduino project upload",
+                  'arduino_flash': "Arduino compile + flash", 'python_deps': "Python dependency install"}
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.files = data.get('files', {})  # Remote path relative to ~ -> sha256
+        self.flashed = data.get('flashed')  # {"sketch": hash, "port": port} last flashed to the board
+        self.timings = data.get('timings', {})  # Step -> seconds it took when last run
+        self.skipped = []
+        self.lock = threading.Lock()  # Deploy steps update and save it from parallel threads
+
+    @staticmethod
+    def hash_bytes(data):
+        return hashlib.sha256(data).hexdigest()
+
+    @classmethod
+    def hash_tree(cls, root, prefix):
+        """{prefix/relative path: sha256} for every file under root"""
+        hashes = {}
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    hashes[f"{prefix}/{os.path.relpath(path, root).replace(os.sep, '/')}"] = cls.hash_bytes(f.read())
+        return hashes
+
+    @classmethod
+    def load(cls, runner):
+        # A missing or unreadable manifest just means everything is deployed from scratch
+        status, lines = runner.run(f'cat {cls.REMOTE_PATH}', timeout=15, echo=False)
+        if status != 0:
+            return cls()
+        try:
+            return cls(json.loads("\n".join(lines)))
+        except ValueError:
+            return cls()
+
+    def save(self, ssh_client):
+        # Held through the upload, so an older copy can never land after a newer one
+        with self.lock:
+            data = json.dumps({"files": self.files, "flashed": self.flashed, "timings": self.timings}, indent=2)
+            with SCPClient(ssh_client.get_transport()) as scp_client:
+                scp_client.putfo(io.BytesIO(data.encode('utf-8')), self.REMOTE_PATH)
+
+    def changed(self, hashes):
+        return sorted(path for path, digest in hashes.items() if self.files.get(path) != digest)
+
+    def removed(self, hashes, prefix):
+        # Deployed files under prefix that no longer exist locally
+        return sorted(path for path in self.files if path.startswith(prefix + '/') and path not in hashes)
+
+    def has_tree(self, prefix):
+        return any(path.startswith(prefix + '/') for path in self.files)
+
+    def update_files(self, hashes, removed=()):
+        with self.lock:
+            self.files.update(hashes)
+            for path in removed:
+                self.files.pop(path, None)
+
+    def set_flashed(self, flash):
+        with self.lock:
+            self.flashed = flash
+
+    def record(self, step, seconds):
+        with self.lock:
+            self.timings[step] = round(seconds, 1)
+
+    def skip(self, step):
+        with self.lock:
+            self.skipped.append(step)
+
+    def report(self):
+        if not self.skipped:
+            return "No deployment steps skipped"
+        names = ", ".join(self.STEP_NAMES[step] for step in self.skipped)
+        saved = sum(self.timings.get(step, 0) for step in self.skipped)
+        unknown = any(step not in self.timings for step in self.skipped)
+        return f"Skipped unchanged: {names} (saved {'at least ' if unknown else '~'}{saved:.1f} s)"
+
+class DeployGraph:
+    """Deployment steps with dependencies. Each step starts as soon as everything it depends on has succeeded,
+    so independent steps run at the same time; SSH work in each goes over its own channel of the one transport."""
+    def __init__(self, log, cancelled):
+        self.log = log
+        self.cancelled = cancelled  # Once set, no further step starts
+        self.steps = {}  # Name -> (function returning success, names it runs after)
+        self.results = {}  # Name -> True, False, or None if never run because a dependency failed
+        self.timings = {}  # Name -> (start, seconds), relative to the start of run()
+
+    def add(self, name, function, after=()):
+        self.steps[name] = (function, after)
+
+    def run(self):
+        # Dependencies on steps that weren't added (disabled in the GUI) are simply satisfied
+        done = {name: threading.Event() for name in self.steps}
+        started = time.monotonic()
+
+        def run_step(name):
+            function, after = self.steps[name]
+            after = [dependency for dependency in after if dependency in self.steps]
+            for dependency in after:
+                done[dependency].wait()
+            if all(self.results[dependency] for dependency in after) and not self.cancelled.is_set():
+                begin = time.monotonic()
+                try:
+                    self.results[name] = bool(function())
+                except Exception as e:
+                    self.log(f"Step {name} failed: {e}")
+                    self.results[name] = False
+                if self.cancelled.is_set():
+                    self.results[name] = False  # Whatever it returned, it was cut short
+                self.timings[name] = (begin - started, time.monotonic() - begin)
+            else:
+                self.results[name] = None
+            done[name].set()
+
+        threads = [threading.Thread(target=run_step, args=(name,), daemon=True) for name in self.steps]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - started
+        return all(self.results.values())
+
+    def timing_report(self):
+        lines = [f"Deployment took {self.elapsed:.1f} s "
+                 f"(steps add up to {sum(seconds for _, seconds in self.timings.values()):.1f} s):"]
+        for name, (start, seconds) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            status = "ok" if self.results[name] else "FAILED"
+            lines.append(f"  {name:<16} at {start:5.1f} s  took {seconds:5.1f} s  {status}")
+        lines += [f"  {name:<16} not run" for name, result in self.results.items() if result is None]
+        return "\n".join(lines)
+
+# Server-side Python environment on the Pi (paths relative to the SSH user's home)
+PI_VENV = 'tank-venv'
+PI_WHEELHOUSE = 'tank-wheelhouse'
+PI_REQUIREMENTS = ('opencv-python', 'pyserial')
+PI_OPTIONAL_REQUIREMENTS = ('av',)  # Installed separately: a failure only costs H.264
+
 class TankPlantController:
     def __init__(self):
         # --- FIX STARTS HERE ---
@@ -34,20 +732,80 @@ class TankPlantController:
         self.install_arduino_libraries = tk.BooleanVar(value=True)
         self.install_python = tk.BooleanVar(value=True)
         self.install_python_libraries = tk.BooleanVar(value=True)
+        self.adaptive_video = tk.BooleanVar(value=False)
+        self.prefer_h264 = tk.BooleanVar(value=av is not None)
+        self.udp_control = tk.BooleanVar(value=True)
+        self.force_full_deploy = tk.BooleanVar(value=False)
+        self.use_venv = tk.BooleanVar(value=True)
+        self.use_wheelhouse = tk.BooleanVar(value=False)
         
         # Socket connections
         self.video_socket = None
+        self.video_codec = 'mjpeg'
+
+        # Video pipeline: receiver -> decoder -> enhancer -> Tk display, newest frame wins at each handoff
+        self.frame_receiver = None
+        self.encoded_frames = LatestSlot()
+        self.decoded_frames = LatestSlot()
+        self.display_frames = LatestSlot()
+        self.display_pending = False
         self.control_socket = None
+        self.control = None
+        self.udp_sender = None
         self.running = False
         
         # SSH connection
         self.ssh_client = None
+        self.runner = None
+        self.deploy_cancelled = threading.Event()
+        self.manifest = DeployManifest()
+        self.server_pid = None  # Set by start_python_server so the readiness probe checks the new server
         self.deployment_status = "Disconnected"
 
         # Video enhancement parameters
         self.brightness = tk.DoubleVar(value=1.0)
         self.contrast = tk.DoubleVar(value=1.2)
         self.sharpness = tk.DoubleVar(value=1.5)
+        self.enhancer = FrameEnhancer()
+        self.scaler = DisplayScaler()
+        self.scaling_mode = tk.StringVar(value="Fast")
+        self.scaling_mode.trace_add('write', lambda *args: setattr(self.scaler, 'quality',
+                                                                   self.scaling_mode.get() == "Quality"))
+
+        # Worker threads read this snapshot instead of the Tk variables
+        self.enhancement_params = self.snapshot_enhancement_params()
+        for variable in (self.brightness, self.contrast, self.sharpness):
+            variable.trace_add('write', self.on_enhancement_changed)
+
+        # Server capture pacing
+        self.target_fps = tk.IntVar(value=20)
+        self.pacing_status = tk.StringVar(value="Achieved FPS: -")
+
+        # Latency telemetry: per-frame and per-key timestamps, summarised in the Telemetry tab
+        self.telemetry_enabled = tk.BooleanVar(value=True)
+        # Mirrored for the receive, video and heartbeat threads, which must not touch Tk variables
+        self.telemetry_on = self.telemetry_enabled.get()
+        self.telemetry_enabled.trace_add('write', lambda *args: setattr(self, 'telemetry_on',
+                                                                        self.telemetry_enabled.get()))
+        self.latency = LatencyStats()
+        self.clock = ClockSync()
+        self.video_timestamps = False
+        self.clock_status = tk.StringVar(value="Clock offset: -")
+        self.histogram_stage = tk.StringVar(value='video_total')
+        self.server_stats = tk.StringVar(value="No server stats yet")
+
+        # Logging: worker threads queue records, the console shows them in batches; key presses and
+        # per-frame errors are DEBUG so they can be muted
+        self.logger = logging.getLogger('tank_controller')
+        self.logger.propagate = False
+        self.log_sink = LogSink(self.root)
+        self.logger.addHandler(self.log_sink)
+        self.log_file_handler = None
+        self.log_level = tk.StringVar(value='INFO')
+        self.log_level.trace_add('write', lambda *args: self.apply_log_level())
+        self.log_to_file = tk.BooleanVar(value=False)
+        self.log_to_file.trace_add('write', lambda *args: self.toggle_log_file())
+        self.apply_log_level()
 
         # --- FIX ENDS HERE ---
 
@@ -58,10 +816,12 @@ class TankPlantController:
         self.pressed_keys = set()
 
         # Embedded code content
-        # Read python_server_code from file
-        python_server_path = Path(__file__).parent / "stream.py"
-        with open(python_server_path, "r", encoding="utf-8") as f:
-            self.python_server_code = f.read()
+        # Read the server (deployed as tank_server.py) and the wire protocol module it shares with this client
+        here = Path(__file__).parent
+        self.python_server_files = {}
+        for remote_name, local_name in (('tank_server.py', 'stream.py'), ('tank_protocol.py', 'tank_protocol.py')):
+            with open(here / local_name, "r", encoding="utf-8") as f:
+                self.python_server_files[remote_name] = f.read()
 
     def setup_gui(self):
         # Create notebook for tabs
@@ -74,6 +834,9 @@ class TankPlantController:
         # Video Control Tab
         self.setup_video_tab(notebook)
 
+        # Telemetry Tab
+        self.setup_telemetry_tab(notebook)
+
     def setup_connection_tab(self, notebook):
         conn_frame = ttk.Frame(notebook)
         notebook.add(conn_frame, text="Connection & Deployment")
@@ -119,6 +882,30 @@ class TankPlantController:
                                     variable=self.install_python_libraries)
         upload_check.grid(row=8, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
 
+        upload_check = ttk.Checkbutton(settings_frame, text="Adaptive Video Quality",
+                                    variable=self.adaptive_video)
+        upload_check.grid(row=9, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        upload_check = ttk.Checkbutton(settings_frame, text="Prefer H.264 Video (needs PyAV)",
+                                    variable=self.prefer_h264)
+        upload_check.grid(row=10, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        upload_check = ttk.Checkbutton(settings_frame, text="UDP Key Control",
+                                    variable=self.udp_control)
+        upload_check.grid(row=11, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        upload_check = ttk.Checkbutton(settings_frame, text="Force Full Deploy (ignore deployed hashes)",
+                                    variable=self.force_full_deploy)
+        upload_check.grid(row=12, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        upload_check = ttk.Checkbutton(settings_frame, text=f"Python Virtualenv on Pi (~/{PI_VENV})",
+                                    variable=self.use_venv)
+        upload_check.grid(row=13, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
+        upload_check = ttk.Checkbutton(settings_frame, text="Install From Local Wheelhouse (./wheelhouse)",
+                                    variable=self.use_wheelhouse)
+        upload_check.grid(row=14, column=0, columnspan=2, sticky=tk.W, padx=5, pady=5)
+
         # Deployment controls
         deploy_frame = ttk.LabelFrame(conn_frame, text="Deployment")
         deploy_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -127,6 +914,10 @@ class TankPlantController:
                                    command=self.deploy_and_connect, width=20)
         self.deploy_btn.pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.cancel_btn = ttk.Button(deploy_frame, text="Cancel Deploy",
+                                   command=self.cancel_deploy, state=tk.DISABLED, width=20)
+        self.cancel_btn.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.disconnect_btn = ttk.Button(deploy_frame, text="Disconnect", 
                                        command=self.disconnect_all, state=tk.DISABLED, width=20)
         self.disconnect_btn.pack(side=tk.LEFT, padx=5, pady=5)
@@ -135,12 +926,21 @@ class TankPlantController:
         status_frame = ttk.LabelFrame(conn_frame, text="Deployment Status")
         status_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
+        log_controls = ttk.Frame(status_frame)
+        log_controls.pack(side=tk.TOP, fill=tk.X, padx=5, pady=2)
+        ttk.Label(log_controls, text="Log level:").pack(side=tk.LEFT)
+        ttk.Combobox(log_controls, textvariable=self.log_level, values=("DEBUG", "INFO", "WARNING", "ERROR"),
+                     state="readonly", width=10).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(log_controls, text="Also log to tank_controller.log",
+                        variable=self.log_to_file).pack(side=tk.LEFT, padx=10)
+
         self.status_text = tk.Text(status_frame, height=15, wrap=tk.WORD, state=tk.DISABLED)
         status_scrollbar = ttk.Scrollbar(status_frame, orient=tk.VERTICAL, command=self.status_text.yview)
         self.status_text.configure(yscrollcommand=status_scrollbar.set)
 
         self.status_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         status_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.log_sink.attach(self.status_text)
 
     def setup_video_tab(self, notebook):
         video_frame = ttk.Frame(notebook)
@@ -153,6 +953,7 @@ class TankPlantController:
         self.video_label = ttk.Label(video_display_frame, text="Connect to start video feed", 
                                    background="black", foreground="white")
         self.video_label.pack(expand=True, fill=tk.BOTH)
+        self.video_label.bind('<Configure>', self.on_video_label_resized)
 
         # Enhancement controls
         controls_frame = ttk.LabelFrame(video_frame, text="Video Enhancement")
@@ -173,13 +974,151 @@ class TankPlantController:
                                   variable=self.sharpness, orient=tk.HORIZONTAL, length=200)
         sharpness_scale.grid(row=2, column=1, padx=10)
 
+        ttk.Label(controls_frame, text="Target FPS:").grid(row=3, column=0, sticky=tk.W)
+        fps_frame = ttk.Frame(controls_frame)
+        fps_frame.grid(row=3, column=1, padx=10, sticky=tk.W)
+        ttk.Spinbox(fps_frame, from_=1, to=60, textvariable=self.target_fps, width=5).pack(side=tk.LEFT)
+        ttk.Button(fps_frame, text="Apply", command=self.send_target_fps).pack(side=tk.LEFT, padx=5)
+        ttk.Label(fps_frame, textvariable=self.pacing_status).pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(controls_frame, text="Scaling:").grid(row=4, column=0, sticky=tk.W)
+        ttk.Combobox(controls_frame, textvariable=self.scaling_mode, values=("Fast", "Quality"),
+                     state="readonly", width=10).grid(row=4, column=1, padx=10, sticky=tk.W)
+
         # Control instructions
         instr_frame = ttk.LabelFrame(controls_frame, text="Controls")
-        instr_frame.grid(row=0, column=2, rowspan=3, padx=20, sticky=tk.N)
+        instr_frame.grid(row=0, column=2, rowspan=5, padx=20, sticky=tk.N)
 
         instructions = "WASD or Arrow Keys:\nW/↑ - Forward\nS/↓ - Backward\nA/← - Turn Left\nD/→ - Turn Right"
         ttk.Label(instr_frame, text=instructions, justify=tk.LEFT).pack(padx=10, pady=10)
 
+    def setup_telemetry_tab(self, notebook):
+        telemetry_frame = ttk.Frame(notebook)
+        notebook.add(telemetry_frame, text="Telemetry")
+
+        controls_frame = ttk.Frame(telemetry_frame)
+        controls_frame.pack(fill=tk.X, padx=10, pady=10)
+        ttk.Checkbutton(controls_frame, text="Record Latency Telemetry",
+                        variable=self.telemetry_enabled).pack(side=tk.LEFT, padx=5)
+        ttk.Label(controls_frame, textvariable=self.clock_status).pack(side=tk.LEFT, padx=10)
+        ttk.Button(controls_frame, text="Export CSV", command=lambda: self.export_telemetry('csv')).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(controls_frame, text="Export JSON", command=lambda: self.export_telemetry('json')).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(controls_frame, text="Clear", command=self.latency.clear).pack(side=tk.RIGHT, padx=5)
+
+        # Live server counters from the get_stats control message
+        stats_frame = ttk.LabelFrame(telemetry_frame, text="Server Stats")
+        stats_frame.pack(fill=tk.X, padx=10, pady=10)
+        ttk.Label(stats_frame, textvariable=self.server_stats, justify=tk.LEFT,
+                  font=("Courier", 9)).pack(anchor=tk.W, padx=5, pady=5)
+
+        # Per-stage percentiles over the rolling window
+        table_frame = ttk.LabelFrame(telemetry_frame, text="Latency by Stage (ms)")
+        table_frame.pack(fill=tk.X, padx=10, pady=10)
+        columns = ("count", "p50", "p90", "p99", "max")
+        self.telemetry_table = ttk.Treeview(table_frame, columns=columns, height=len(LatencyStats.STAGES))
+        self.telemetry_table.heading('#0', text="Stage")
+        for column in columns:
+            self.telemetry_table.heading(column, text=column)
+            self.telemetry_table.column(column, width=90, anchor=tk.E)
+        for stage in LatencyStats.STAGES:
+            self.telemetry_table.insert('', tk.END, iid=stage, text=stage)
+        self.telemetry_table.pack(fill=tk.X, padx=5, pady=5)
+        self.telemetry_table.bind('<<TreeviewSelect>>',
+                                  lambda event: self.histogram_stage.set(self.telemetry_table.selection()[0]))
+
+        # Histogram of the selected stage
+        histogram_frame = ttk.LabelFrame(telemetry_frame, text="Histogram")
+        histogram_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        ttk.Label(histogram_frame, textvariable=self.histogram_stage).pack(anchor=tk.W, padx=5)
+        self.histogram_canvas = tk.Canvas(histogram_frame, background="white", height=200)
+        self.histogram_canvas.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        self.root.after(1000, self.refresh_telemetry)
+
+    def refresh_telemetry(self):
+        """Redraw the telemetry table and histogram once a second"""
+        for stage, stats in self.latency.summary().items():
+            if stats["count"]:
+                values = [stats["count"]] + [f"{stats[k]:.1f}" for k in ("p50", "p90", "p99", "max")]
+            else:
+                values = [0, "-", "-", "-", "-"]
+            self.telemetry_table.item(stage, values=values)
+
+        offset = self.clock.offset
+        self.clock_status.set("Clock offset: -" if offset is None else f"Clock offset: {offset * 1000:+.1f} ms")
+        self.draw_histogram()
+        self.root.after(1000, self.refresh_telemetry)
+
+    def draw_histogram(self):
+        canvas = self.histogram_canvas
+        canvas.delete('all')
+        counts, edges = self.latency.histogram(self.histogram_stage.get())
+        width, height = canvas.winfo_width(), canvas.winfo_height()
+        if not len(counts) or width < 50 or height < 50:
+            return
+        bar_width = (width - 20) / len(counts)
+        scale = (height - 40) / max(counts.max(), 1)
+        for i, count in enumerate(counts):
+            x = 10 + i * bar_width
+            canvas.create_rectangle(x, height - 25 - count * scale, x + bar_width - 2, height - 25,
+                                    fill="steelblue", outline="")
+        canvas.create_text(10, height - 12, text=f"{edges[0]:.1f} ms", anchor=tk.W)
+        canvas.create_text(width - 10, height - 12, text=f"{edges[-1]:.1f} ms", anchor=tk.E)
+        canvas.create_text(10, 10, text=f"max bin {int(counts.max())}", anchor=tk.W)
+
+    def export_telemetry(self, kind):
+        path = filedialog.asksaveasfilename(defaultextension=f".{kind}",
+                                            filetypes=[(kind.upper(), f"*.{kind}")],
+                                            initialfile=f"tank_latency.{kind}")
+        if not path:
+            return
+        try:
+            if kind == 'json':
+                offset = self.clock.offset
+                self.latency.export_json(path, exported=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                         clock_offset_ms=None if offset is None else offset * 1000)
+            else:
+                self.latency.export_csv(path)
+            self.log_message(f"Telemetry exported to {path}")
+        except OSError as e:
+            self.log_message(f"Telemetry export failed: {e}")
+
+    @staticmethod
+    def format_server_stats(stats):
+        """Turn a 'stats' message into the lines shown in the Server Stats panel"""
+        def number(value, fmt):
+            return "-" if value is None else format(value, fmt)
+
+        capture, system = stats['capture'], stats['system']
+        lines = [f"Capture {capture['achieved_fps']:.1f} fps (target {capture['target_fps']:g})  "
+                 f"encode {number(stats['encode_ms'], '.1f')} ms  up {stats['uptime_s']:.0f} s"]
+
+        throttled = system['throttled']
+        if throttled is None:
+            throttle_text = "n/a"
+        else:
+            throttle_text = ", ".join(throttled['now']) or "no"
+            if throttled['since_boot'] and not throttled['now']:
+                throttle_text += " (earlier: " + ", ".join(throttled['since_boot']) + ")"
+        lines.append(f"CPU {system['cpu_percent']:.0f}%  temp {number(system['cpu_temp_c'], '.1f')} C  "
+                     f"load {system['load_avg'][0]:.2f}  throttled: {throttle_text}")
+
+        serial = stats['serial']
+        if serial:
+            lines.append(f"Serial queue {serial['queue_depth']}  sent {serial['sent']}  "
+                         f"merged {serial['merged']}  dropped {serial['dropped']}  "
+                         f"({serial['protocol']} @ {serial['baudrate']})")
+        else:
+            lines.append("Serial: no Arduino")
+
+        lines.append(f"Control clients {stats['control_clients']}")
+        for client in stats['video_clients']:
+            kbytes = None if client['bytes_per_s'] is None else client['bytes_per_s'] / 1024
+            lines.append(f"  {client['addr']:<21} {client['codec']:<5} {number(client['fps'], '5.1f')} fps  "
+                         f"{number(kbytes, '7.1f')} kB/s  dropped {client['frames_dropped']}  "
+                         f"queued {client['queued']}")
+        return "\n".join(lines)
+
     def setup_key_bindings(self):
         self.root.bind('<KeyPress>', self.on_key_press)
         self.root.bind('<KeyRelease>', self.on_key_release)
@@ -196,16 +1135,36 @@ class TankPlantController:
 
         bind_keys_recursive(self.root)
 
-    def log_message(self, message):
-        self.status_text.config(state=tk.NORMAL)
-        self.status_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} - {message}\n")
-        self.status_text.see(tk.END)
-        self.status_text.config(state=tk.DISABLED)
-        self.root.update_idletasks()
+    def log_message(self, message, level=logging.INFO):
+        # Safe from any thread: the record is only queued here
+        self.logger.log(level, message)
+
+    def apply_log_level(self):
+        level = getattr(logging, self.log_level.get())
+        self.log_sink.setLevel(level)
+        if self.log_file_handler:
+            self.log_file_handler.setLevel(level)
+        self.logger.setLevel(level)  # Muted records are dropped before any handler sees them
+
+    def toggle_log_file(self):
+        if self.log_to_file.get() and not self.log_file_handler:
+            path = Path(__file__).parent / "tank_controller.log"
+            self.log_file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=3,
+                                                                         encoding='utf-8')
+            self.log_file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            self.log_file_handler.setLevel(self.log_sink.level)
+            self.logger.addHandler(self.log_file_handler)
+            self.log_message(f"Logging to {path}")
+        elif not self.log_to_file.get() and self.log_file_handler:
+            self.logger.removeHandler(self.log_file_handler)
+            self.log_file_handler.close()
+            self.log_file_handler = None
 
     def deploy_and_connect(self):
         """Main deployment function"""
         self.deploy_btn.config(state=tk.DISABLED)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.deploy_cancelled = threading.Event()
         
         # Run deployment in a separate thread to avoid blocking GUI
         deploy_thread = threading.Thread(target=self._deploy_and_connect_thread, daemon=True)
@@ -214,54 +1173,95 @@ class TankPlantController:
     def _deploy_and_connect_thread(self):
         try:
             self.log_message("Starting deployment process...")
-            
-            # Step 1: Establish SSH connection
-            if not self.connect_ssh():
-                self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
-                return
-
-            # Step 2: Upload Python server code
+            auto_start = self.auto_start_python.get()
+            self.server_pid = None
+
+            graph = DeployGraph(self.log_message, self.deploy_cancelled)
+            graph.add('ssh', self.connect_ssh)
+            graph.add('manifest', self.load_manifest, after=['ssh'])
+            if auto_start:
+                # The old server holds the serial port, so it goes before flashing
+                graph.add('stop_server', self.stop_python_server, after=['ssh'])
             if self.should_upload_python_code.get():
-                self.log_message("Uploading Python server code...")
-                if not self.upload_python_code():
-                    self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
-                    return
-
-            # Step 3: Upload and flash Arduino code (if enabled)
+                graph.add('python_upload', self.upload_python_code, after=['manifest'])
             if self.upload_arduino_code.get():
-                self.log_message("Uploading Arduino code...")
-                if not self.upload_and_flash_arduino():
-                    self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
-                    return
-
-            # Step 4: Start Python server
-            if self.auto_start_python.get():
-                self.log_message("Starting Python server on Pi...")
-                if not self.start_python_server():
-                    self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
-                    return
-            else:
-                self.log_message("START SERVER MANUALLY IN THE NEXT 2 SECONDS")
-                time.sleep(2)
-
-            # Step 5: Connect video and control streams
-            self.log_message("Connecting to video and control streams...")
-            time.sleep(3)  # Give server time to start
-            
-            if self.connect_streams():
+                graph.add('arduino', self.upload_and_flash_arduino, after=['manifest', 'stop_server'])
+            if auto_start and self.install_python.get():
+                graph.add('python_install', self.provision_python, after=['ssh'])
+            if auto_start and self.install_python_libraries.get():
+                graph.add('python_deps', self.install_python_dependencies, after=['manifest', 'python_install'])
+            if auto_start:
+                graph.add('start_server', self.start_python_server,
+                          after=['ssh', 'python_upload', 'arduino', 'python_deps', 'stop_server'])
+            # Readiness probe instead of a fixed sleep; someone starting the server by hand gets longer
+            graph.add('server_ready', lambda: self.wait_for_server(20 if auto_start else 60),
+                      after=['ssh', 'start_server', 'python_upload', 'arduino'])
+            graph.add('connect', self.connect_streams, after=['server_ready'])
+
+            if not auto_start:
+                self.log_message("START SERVER MANUALLY NOW")
+            success = graph.run()
+            self.log_message(graph.timing_report())
+            self.log_message(self.manifest.report())
+
+            if success:
                 self.log_message("Deployment successful! Ready for control.")
                 self.root.after(0, lambda: (
                     self.disconnect_btn.config(state=tk.NORMAL),
                     self.deploy_btn.config(state=tk.DISABLED)
                 ))
             else:
-                self.log_message("Failed to connect to streams")
+                self.log_message("Deployment failed")
                 self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
 
         except Exception as e:
             self.log_message(f"Deployment failed: {e}")
             self.root.after(0, lambda: self.deploy_btn.config(state=tk.NORMAL))
 
+        finally:
+            self.root.after(0, lambda: self.cancel_btn.config(state=tk.DISABLED))
+
+    def cancel_deploy(self):
+        self.log_message("Cancelling deployment...")
+        self.deploy_cancelled.set()
+        if self.runner:
+            self.runner.cancel()
+
+    def load_manifest(self):
+        # What is already on the Pi, so unchanged steps can be skipped
+        if self.force_full_deploy.get():
+            self.manifest = DeployManifest()
+        else:
+            self.manifest = DeployManifest.load(self.runner)
+        return True
+
+    def wait_for_server(self, timeout):
+        """Readiness probe: wait until the video and control ports are listening on the Pi.
+        Checked over SSH rather than by connecting, which the server would take for a viewer; when we
+        started the server ourselves, its PID must own both ports and must not have exited."""
+        self.log_message("Waiting for the server to listen...")
+        deadline = time.monotonic() + timeout
+        owner = f'.*pid={self.server_pid},' if self.server_pid else ''
+        check = ' && '.join(f"ss -ltnpH | grep -q ':{port} {owner}'" for port in (8888, 8889))
+        if self.server_pid:
+            check = f'kill -0 {self.server_pid} 2>/dev/null || exit 2; {check}'
+        while True:
+            status, _ = self.runner.run(check, timeout=10, echo=False)
+            if status == 0:
+                break
+            if status == 2:
+                self.log_message("Python server exited during startup, last lines of server.log:")
+                self.runner.run('tail -n 20 ~/server.log', timeout=10)
+                return False
+            if self.deploy_cancelled.is_set():
+                return False
+            if time.monotonic() > deadline:
+                self.log_message(f"Server not listening on ports 8888/8889 after {timeout} s")
+                return False
+            time.sleep(0.2)
+        self.log_message("Server is listening")
+        return True
+
     def connect_ssh(self):
         try:
             self.ssh_client = paramiko.SSHClient()
@@ -275,6 +1275,7 @@ class TankPlantController:
                 timeout=10
             )
             
+            self.runner = RemoteRunner(self.ssh_client, self.log_message, self.deploy_cancelled)
             self.log_message("SSH connection established")
             return True
             
@@ -283,18 +1284,26 @@ class TankPlantController:
             return False
 
     def upload_python_code(self):
+        hashes = {name: DeployManifest.hash_bytes(code.encode('utf-8'))
+                  for name, code in self.python_server_files.items()}
+        changed = self.manifest.changed(hashes)
+        if not changed:
+            self.log_message("Python server code unchanged on the Pi, skipping upload")
+            self.manifest.skip('python_upload')
+            return True
+
         try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-                f.write(self.python_server_code)
-                temp_python_path = f.name
+            self.log_message(f"Uploading Python server code ({', '.join(changed)})...")
+            started = time.monotonic()
 
-            # Upload using SCP
+            # Upload using SCP, straight from memory
             with scp.SCPClient(self.ssh_client.get_transport()) as scp_client:
-                scp_client.put(temp_python_path, '~/tank_server.py')
+                for name in changed:
+                    scp_client.putfo(io.BytesIO(self.python_server_files[name].encode('utf-8')), name)
 
-            # Clean up temp file
-            os.unlink(temp_python_path)
+            self.manifest.update_files(hashes)
+            self.manifest.record('python_upload', time.monotonic() - started)
+            self.manifest.save(self.ssh_client)
             
             self.log_message("Python server code uploaded successfully")
             return True
@@ -304,25 +1313,18 @@ class TankPlantController:
             return False
 
     def upload_and_flash_arduino(self):
+        temp_dir = None
         try:
-            # Step 1: Copy the full Arduino project to a temp directory
+            # Step 1: Hash the local Arduino project and compare with what the Pi already has
             local_project_path = os.path.abspath('./ArduinoTankController')
-            temp_dir = tempfile.mkdtemp()
-            temp_project_path = os.path.join(temp_dir, 'ArduinoTankController')
-            shutil.copytree(local_project_path, temp_project_path)
-
-            # Step 2: Create a tarball for transfer
-            tar_path = os.path.join(temp_dir, 'ArduinoTankController.tar.gz')
-            shutil.make_archive(base_name=tar_path.replace('.tar.gz', ''), format='gztar', root_dir=temp_dir, base_dir='ArduinoTankController')
+            hashes = DeployManifest.hash_tree(local_project_path, 'ArduinoTankController')
+            changed = self.manifest.changed(hashes)
+            removed = self.manifest.removed(hashes, 'ArduinoTankController')
 
-            # Step 3: Upload tarball
-            with SCPClient(self.ssh_client.get_transport()) as scp_client:
-                scp_client.put(tar_path, '~/ArduinoTankController.tar.gz')
-
-            # Step 4: Install Arduino CLI if not present
+            # Step 2: Install Arduino CLI if not present
             self.log_message("Checking Arduino CLI installation...")
-            stdin, stdout, stderr = self.ssh_client.exec_command('which arduino-cli')
-            if stdout.channel.recv_exit_status() != 0:
+            status, _ = self.runner.run('which arduino-cli', timeout=30, echo=False)
+            if status != 0:
                 self.log_message("Installing Arduino CLI...")
                 commands = [
                     'curl -fsSL https://raw.githubusercontent.com/arduino/arduino-cli/master/install.sh | sh',
@@ -330,61 +1332,53 @@ class TankPlantController:
                     'arduino-cli core update-index',
                     'arduino-cli core install arduino:avr'
                 ]
-                for cmd in commands:
-                    stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
-                    stdout.channel.recv_exit_status()
-                    
-            # Step 5: Extract on remote host
-            self.log_message("Extracting Arduino project on remote host...")
-            cmds = [
-                'rm -rf ~/ArduinoTankController',
-                'mkdir -p ~/ArduinoTankController',
-                'tar -xzf ~/ArduinoTankController.tar.gz -C ~/',
-                'rm ~/ArduinoTankController.tar.gz'
-            ]
-            
-            if self.install_arduino_libraries.get():
-                cmds.append('arduino-cli lib install "elapsedMillis"')    
-                cmds.append('arduino-cli lib install "Adafruit IS31FL3731 Library"')    
-                cmds.append('arduino-cli lib install "Servo"')    
-            
-            # for cmd in cmds:
-            #     stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
-            #     stdout.channel.recv_exit_status()
-
-            for cmd in cmds:
-                self.log_message(f"Executing: {cmd}")
-                stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
-                exit_status = stdout.channel.recv_exit_status()
-                output = stdout.read().decode().strip()
-                error = stderr.read().decode().strip()
-
-                if exit_status != 0:
-                    # self.log_message(f"Command failed: {cmd}")
-                    if output:
-                        self.log_message(f"{output}")
-                    if error:
-                        self.log_message(f"STDERR: {error}")
-                    # You might want to raise an exception or return False here
-                else:
-                    self.log_message(f"Command successful: {cmd}")
-                    if output:
-                        self.log_message(f"{output}")
-
+                self.run_logged_commands(commands, timeout=900)
+
+            # Step 3: Upload only the changed files
+            if changed or removed:
+                started = time.monotonic()
+                fresh = not self.manifest.has_tree('ArduinoTankController')
+                self.log_message(f"Uploading {len(changed)} changed Arduino file(s)" +
+                                 (f", removing {len(removed)}" if removed else ""))
+                temp_dir = tempfile.mkdtemp()
+                tar_path = os.path.join(temp_dir, 'ArduinoTankController.tar.gz')
+                with tarfile.open(tar_path, 'w:gz') as tar:
+                    for path in changed:
+                        tar.add(os.path.join(os.path.dirname(local_project_path), path), arcname=path)
+
+                with SCPClient(self.ssh_client.get_transport()) as scp_client:
+                    scp_client.put(tar_path, '~/ArduinoTankController.tar.gz')
+
+                # A first deploy starts from a clean directory; later ones extract over it
+                cmds = ['rm -rf ~/ArduinoTankController', 'mkdir -p ~/ArduinoTankController'] if fresh else []
+                cmds += ['tar -xzf ~/ArduinoTankController.tar.gz -C ~/', 'rm ~/ArduinoTankController.tar.gz']
+                if removed:
+                    cmds.append('rm -f ' + ' '.join(f'~/{path}' for path in removed))
+                self.log_message("Extracting Arduino project on remote host...")
+                if not self.run_logged_commands(cmds):
+                    # Leave the manifest alone, so the next deploy uploads these files again
+                    self.log_message("Failed to extract the Arduino project on the Pi")
+                    return False
+
+                self.manifest.update_files({path: hashes[path] for path in changed}, removed)
+                self.manifest.record('arduino_upload', time.monotonic() - started)
+                self.manifest.save(self.ssh_client)
+            else:
+                self.log_message("Arduino project unchanged on the Pi, skipping upload")
+                self.manifest.skip('arduino_upload')
 
-            # Step 6: Find Arduino port
+            # Step 4: Find Arduino port
             self.log_message("Detecting Arduino port...")
-            stdin, stdout, stderr = self.ssh_client.exec_command('arduino-cli board list')
-            board_output = stdout.read().decode()
+            status, board_lines = self.runner.run('arduino-cli board list', timeout=60, echo=False)
             arduino_port = None
-            for line in board_output.split('\n'):
+            for line in board_lines:
                 if 'Arduino' in line or 'ttyUSB' in line or 'ttyACM' in line:
                     arduino_port = line.split()[0]
                     break
             if not arduino_port:
                 for port in ['/dev/ttyUSB0', '/dev/ttyACM0', '/dev/ttyUSB1', '/dev/ttyACM1']:
-                    stdin, stdout, stderr = self.ssh_client.exec_command(f'ls {port}')
-                    if stdout.channel.recv_exit_status() == 0:
+                    status, _ = self.runner.run(f'ls {port}', timeout=10, echo=False)
+                    if status == 0:
                         arduino_port = port
                         break
             if not arduino_port:
@@ -392,21 +1386,39 @@ class TankPlantController:
                 return True
             self.log_message(f"Arduino detected on {arduino_port}")
 
-            # Step 7: Compile and upload
+            # Step 5: Skip compile and flash when this exact sketch was last flashed on this port
+            flash = {"sketch": DeployManifest.hash_bytes(json.dumps(sorted(hashes.items())).encode('utf-8')),
+                     "port": arduino_port}
+            if self.manifest.flashed == flash:
+                self.log_message("Sketch already on the Arduino, skipping compile and flash")
+                self.manifest.skip('arduino_flash')
+                return True
+            started = time.monotonic()
+
+            if self.install_arduino_libraries.get():
+                self.run_logged_commands(['arduino-cli lib install "elapsedMillis"',
+                                          'arduino-cli lib install "Adafruit IS31FL3731 Library"',
+                                          'arduino-cli lib install "Servo"'], timeout=300)
+
+            # Step 6: Compile and upload
             self.log_message("Compiling and uploading Arduino code...")
             compile_cmd = 'arduino-cli compile --fqbn arduino:avr:nano ~/ArduinoTankController --libraries ./ArduinoTankController/libraries'
             upload_cmd = f'arduino-cli upload -p {arduino_port} --fqbn arduino:avr:uno ~/ArduinoTankController'
 
-            stdin, stdout, stderr = self.ssh_client.exec_command(compile_cmd)
-            if stdout.channel.recv_exit_status() != 0:
-                self.log_message(f"Arduino compile failed: {stderr.read().decode()}")
+            status, _ = self.runner.run(compile_cmd, timeout=600)
+            if status != 0:
+                self.log_message("Arduino compile failed")
                 return False
 
-            stdin, stdout, stderr = self.ssh_client.exec_command(upload_cmd)
-            if stdout.channel.recv_exit_status() != 0:
-                self.log_message(f"Arduino upload failed: {stderr.read().decode()}")
+            status, _ = self.runner.run(upload_cmd, timeout=120)
+            if status != 0:
+                self.log_message("Arduino upload failed")
                 return False
 
+            self.manifest.set_flashed(flash)
+            self.manifest.record('arduino_flash', time.monotonic() - started)
+            self.manifest.save(self.ssh_client)
+
             self.log_message("Arduino code uploaded successfully")
             return True
 
@@ -416,42 +1428,167 @@ class TankPlantController:
 
         finally:
             # Clean up local temp files
-            if os.path.exists(temp_dir):
+            if temp_dir and os.path.exists(temp_dir):
                 shutil.rmtree(temp_dir)
 
-    def start_python_server(self):
+    def run_logged_commands(self, cmds, timeout=60):
+        """Run each command in turn, streaming its output into the log; True only if every one exited 0"""
+        success = True
+        for cmd in cmds:
+            self.log_message(f"Executing: {cmd}")
+            status, _ = self.runner.run(cmd, timeout=timeout)
+            if status == 0:
+                self.log_message(f"Command successful: {cmd}")
+            else:
+                success = False
+                if status is not None:
+                    self.log_message(f"Command failed with exit status {status}: {cmd}")
+        return success
+
+    def stop_python_server(self):
+        # Kill any existing server and wait for it to exit (the [t] keeps pgrep from matching this shell);
+        # one that ignores SIGTERM gets SIGKILL, and one that survives that fails the deploy
+        status, _ = self.runner.run(
+            "for signal in TERM KILL; do pkill -$signal -f '[t]ank_server.py'; for i in $(seq 50); do "
+            "pgrep -f '[t]ank_server.py' > /dev/null || exit 0; sleep 0.1; done; done; exit 1",
+            timeout=20, echo=False)
+        if status != 0:
+            self.log_message("Old Python server is still running, not starting a new one over it")
+            return False
+        return True
+
+    def provision_python(self):
+        # Make sure python is installed
         try:
-            # Kill any existing server
-            self.ssh_client.exec_command('pkill -f tank_server.py')
-            time.sleep(1)
-            
-            # Make sure python is installed
-            if self.install_python.get():
-                self.log_message("Checking Python installation...")
-                stdin, stdout, stderr = self.ssh_client.exec_command('which python3')
-                if stdout.channel.recv_exit_status() != 0 and self.install_python.get():
-                    self.log_message("Installing Python 3...")
-                    commands = [
-                        'sudo apt-get update -y',
-                        'sudo apt-get install -y python3 python3-pip'
-                    ]
-                    for cmd in commands:
-                        self.log_message(f"Executing: {cmd}")
-                        stdin, stdout, stderr = self.ssh_client.exec_command(cmd)
-                        stdout.channel.recv_exit_status()
-
-            # Install required Python packages
-            if self.install_python_libraries.get():
-                self.log_message("Installing Python dependencies...")
-                install_cmd = 'pip3 install opencv-python pyserial --break-system-packages'
-                stdin, stdout, stderr = self.ssh_client.exec_command(install_cmd)
-                stdout.channel.recv_exit_status()  # Wait for completion
+            self.log_message("Checking Python installation...")
+            status, _ = self.runner.run('which python3', timeout=30, echo=False)
+            if status != 0:
+                self.log_message("Installing Python 3...")
+                commands = [
+                    'sudo apt-get update -y',
+                    'sudo apt-get install -y python3 python3-pip python3-venv'
+                ]
+                self.run_logged_commands(commands, timeout=900)
+            return True
 
+        except Exception as e:
+            self.log_message(f"Failed to install Python: {e}")
+            return False
+
+    def install_python_dependencies(self):
+        if not self.use_venv.get():
+            return self.install_system_python_dependencies()
+        try:
+            requirements = "".join(f"{name}\n" for name in PI_REQUIREMENTS)
+            optional = PI_OPTIONAL_REQUIREMENTS if self.prefer_h264.get() else ()
+            wheels = self.local_wheels() if self.use_wheelhouse.get() else {}
+
+            # Skip everything when the virtualenv exists and was built from these exact requirements and wheels
+            hashes = {f'{PI_VENV}/requirements.txt': DeployManifest.hash_bytes(
+                json.dumps([requirements, optional, sorted(wheels.values())]).encode('utf-8'))}
+            status, _ = self.runner.run(f'test -x ~/{PI_VENV}/bin/python', timeout=15, echo=False)
+            if status == 0 and not self.manifest.changed(hashes):
+                self.log_message("Python dependencies unchanged on the Pi, skipping install")
+                self.manifest.skip('python_deps')
+                return True
+            started = time.monotonic()
+
+            if status != 0:
+                # System site packages keep apt-installed modules (e.g. python3-opencv) usable
+                self.log_message(f"Creating virtualenv ~/{PI_VENV}...")
+                status, _ = self.runner.run(f'python3 -m venv --system-site-packages ~/{PI_VENV}', timeout=300)
+                if status != 0:
+                    self.log_message("Could not create a virtualenv (is python3-venv installed?); using system pip")
+                    return self.install_system_python_dependencies()
+
+            pip_args = ''
+            if wheels:
+                self.upload_wheels(wheels)
+                pip_args = f' --no-index --find-links ~/{PI_WHEELHOUSE}'
+            with SCPClient(self.ssh_client.get_transport()) as scp_client:
+                scp_client.putfo(io.BytesIO(requirements.encode('utf-8')), f'{PI_VENV}/requirements.txt')
+
+            self.log_message("Installing Python dependencies...")
+            status, _ = self.runner.run(f'~/{PI_VENV}/bin/pip install{pip_args} -r ~/{PI_VENV}/requirements.txt',
+                                        timeout=1800)
+            if status != 0:
+                self.log_message("Installing Python dependencies failed; starting with what is installed")
+                return True
+            complete = True
+            for name in optional:
+                status, _ = self.runner.run(f'~/{PI_VENV}/bin/pip install{pip_args} {name}', timeout=1800)
+                if status != 0:
+                    self.log_message(f"Optional package {name} failed to install; video will fall back to MJPEG")
+                    complete = False
+            if complete:
+                # A failed optional package is retried next time rather than recorded as installed
+                self.manifest.update_files(hashes)
+            self.manifest.record('python_deps', time.monotonic() - started)
+            self.manifest.save(self.ssh_client)
+            return True
+
+        except Exception as e:
+            self.log_message(f"Failed to install Python dependencies: {e}")
+            return False
+
+    def local_wheels(self):
+        """{file name: sha256} of the wheels in ./wheelhouse"""
+        wheelhouse = Path(__file__).parent / "wheelhouse"
+        if not wheelhouse.is_dir():
+            self.log_message(f"No wheelhouse at {wheelhouse}; installing from the package index")
+            return {}
+        return {path.name: DeployManifest.hash_bytes(path.read_bytes()) for path in sorted(wheelhouse.glob('*.whl'))}
+
+    def upload_wheels(self, wheels):
+        # Only wheels the Pi doesn't already have
+        hashes = {f'{PI_WHEELHOUSE}/{name}': digest for name, digest in wheels.items()}
+        changed = self.manifest.changed(hashes)
+        if not changed:
+            return
+        self.log_message(f"Uploading {len(changed)} wheel(s) to ~/{PI_WHEELHOUSE}...")
+        self.runner.run(f'mkdir -p ~/{PI_WHEELHOUSE}', timeout=15, echo=False)
+        wheelhouse = Path(__file__).parent / "wheelhouse"
+        with SCPClient(self.ssh_client.get_transport()) as scp_client:
+            scp_client.put([str(wheelhouse / path.split('/', 1)[1]) for path in changed], f'{PI_WHEELHOUSE}/')
+        self.manifest.update_files({path: hashes[path] for path in changed})
+
+    def install_system_python_dependencies(self):
+        # Install required Python packages
+        try:
+            self.log_message("Installing Python dependencies...")
+            install_cmd = f'pip3 install {" ".join(PI_REQUIREMENTS)} --break-system-packages'
+            status, _ = self.runner.run(install_cmd, timeout=1800)
+            if status != 0:
+                self.log_message("Installing Python dependencies failed; starting with what is installed")
+
+            # PyAV is optional; installed separately so a failure doesn't block the required packages
+            if self.prefer_h264.get():
+                status, _ = self.runner.run('pip3 install av --break-system-packages', timeout=1800)
+                if status != 0:
+                    self.log_message("PyAV install failed; video will fall back to MJPEG")
+            return True
+
+        except Exception as e:
+            self.log_message(f"Failed to install Python dependencies: {e}")
+            return False
+
+    def start_python_server(self):
+        try:
             # Start server in background
-            start_cmd = 'cd ~ && python3 tank_server.py > server.log 2>&1 &'
-            stdin, stdout, stderr = self.ssh_client.exec_command(start_cmd)
-            
-            self.log_message("Python server started")
+            self.log_message("Starting Python server on Pi...")
+            server_args = ' --adaptive' if self.adaptive_video.get() else ''
+            python = 'python3'
+            if self.use_venv.get():
+                python = f'$([ -x ~/{PI_VENV}/bin/python ] && echo ~/{PI_VENV}/bin/python || echo python3)'
+            # $! is the server itself, which the readiness probe checks on
+            start_cmd = f'cd ~ || exit 1; {python} tank_server.py{server_args} < /dev/null > server.log 2>&1 & echo $!'
+            status, lines = self.runner.run(start_cmd, timeout=15, echo=False)
+            if status != 0 or not lines or not lines[-1].strip().isdigit():
+                self.log_message("Failed to start Python server")
+                return False
+            self.server_pid = int(lines[-1])
+
+            self.log_message(f"Python server started (pid {self.server_pid})")
             return True
 
         except Exception as e:
@@ -464,11 +1601,31 @@ class TankPlantController:
             self.video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.video_socket.settimeout(10)
             self.video_socket.connect((self.server_host.get(), 8888))
+            self.video_codec = self.negotiate_video_codec()
+            self.log_message(f"Video codec: {self.video_codec}")
 
             # Connect control socket
             self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.control_socket.settimeout(10)
             self.control_socket.connect((self.server_host.get(), 8889))
+            self.control_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.control_socket.settimeout(2)
+            self.control = ControlChannel(self.control_socket)
+            reply = self.control.handshake(transports=['udp'] if self.udp_control.get() else [])
+            if reply:
+                self.log_message(f"Control protocol v{self.control.version} "
+                                 f"({'binary' if self.control.binary else 'json'})")
+            else:
+                self.log_message("Server did not answer the control handshake; using the legacy protocol")
+
+            # Replies to our own commands always come back; also ask for Arduino lines nobody asked for
+            self.control.send({"type": "subscribe", "topics": ["arduino"]})
+            self.send_ping()
+
+            # Key state goes over UDP when the server offers it; everything else stays on TCP
+            if reply and reply.get('udp_port'):
+                self.udp_sender = UdpKeySender((self.server_host.get(), reply['udp_port']))
+                self.log_message(f"Sending key state over UDP port {reply['udp_port']}")
 
             # Remove timeout after successful connection
             self.video_socket.settimeout(None)
@@ -476,23 +1633,64 @@ class TankPlantController:
 
             self.running = True
 
-            # Start video and message threads
+            # Start video and message threads; the decode stage hands MJPEG buffers back to the receiver
+            self.frame_receiver = FrameReceiver(self.video_socket)
+            self.encoded_frames = LatestSlot()
+            self.decoded_frames = LatestSlot()
+            self.display_frames = LatestSlot()
+            self.display_pending = False
+
             self.video_thread = threading.Thread(target=self.receive_video, daemon=True)
             self.video_thread.start()
 
+            self.decode_thread = threading.Thread(target=self.decode_video, daemon=True)
+            self.decode_thread.start()
+
+            self.enhance_thread = threading.Thread(target=self.enhance_video, daemon=True)
+            self.enhance_thread.start()
+
             self.message_thread = threading.Thread(target=self.receive_messages, daemon=True)
             self.message_thread.start()
 
             self.log_message("Connected to video and control streams")
+            self.root.after(2000, self.poll_pacing)
+            if self.udp_sender:
+                self.root.after(100, self.send_key_heartbeat)
             return True
 
         except Exception as e:
             self.log_message(f"Stream connection failed: {e}")
             return False
 
+    def negotiate_video_codec(self):
+        """Offer our codecs to the server and read back its choice"""
+        codecs = ['h264', 'mjpeg'] if av is not None and self.prefer_h264.get() else ['mjpeg']
+        hello = {"codecs": codecs, "timestamps": self.telemetry_on}
+        self.video_socket.sendall((json.dumps(hello) + "\n").encode('utf-8'))
+
+        # A server without negotiation starts straight away with a length prefix, never with '{'
+        self.video_timestamps = False
+        first = self.video_socket.recv(1, socket.MSG_PEEK)
+        if first != b"{":
+            return 'mjpeg'
+        reply = b""
+        while not reply.endswith(b"\n"):
+            byte = self.video_socket.recv(1)
+            if not byte:
+                raise ConnectionError("Video socket closed during negotiation")
+            reply += byte
+        reply = json.loads(reply.decode('utf-8'))
+        self.video_timestamps = bool(reply.get('timestamps'))
+        return reply.get('codec', 'mjpeg')
+
     def disconnect_all(self):
         """Disconnect all connections and stop server"""
         self.running = False
+        if self.udp_sender:
+            self.udp_sender.close()
+            self.udp_sender = None
+        for slot in (self.encoded_frames, self.decoded_frames, self.display_frames):
+            slot.close()
 
         # Close sockets
         if self.video_socket:
@@ -521,143 +1719,242 @@ class TankPlantController:
 
         self.log_message("Disconnected from all services")
 
+    def snapshot_enhancement_params(self):
+        # Rounded so dragging a slider doesn't flood the LUT/kernel caches with near-identical values
+        return EnhancementParams(round(self.brightness.get(), 2), round(self.contrast.get(), 2),
+                                 round(self.sharpness.get(), 2))
+
+    def on_enhancement_changed(self, *args):
+        try:
+            self.enhancement_params = self.snapshot_enhancement_params()
+        except tk.TclError:
+            pass  # Transient invalid value while the variable is being edited
+
     def enhance_frame(self, frame):
         """Apply enhancement to video frame for better readability"""
         try:
-            # Convert to PIL Image
-            pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-
-            # Apply enhancements
-            # Brightness
-            enhancer = ImageEnhance.Brightness(pil_image)
-            pil_image = enhancer.enhance(self.brightness.get())
-
-            # Contrast
-            enhancer = ImageEnhance.Contrast(pil_image)
-            pil_image = enhancer.enhance(self.contrast.get())
-
-            # Sharpness
-            enhancer = ImageEnhance.Sharpness(pil_image)
-            pil_image = enhancer.enhance(self.sharpness.get())
-
-            # Optional: Apply unsharp mask for better text readability
-            if self.sharpness.get() > 1.5:
-                pil_image = pil_image.filter(ImageFilter.UnsharpMask(radius=1, percent=150, threshold=3))
-
-            return pil_image
+            rgb = self.enhancer.enhance(frame, self.enhancement_params)
+            return Image.fromarray(rgb)
 
         except Exception as e:
-            self.log_message(f"Enhancement error: {e}")
+            self.log_message(f"Enhancement error: {e}", logging.DEBUG)
             return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
     def receive_video(self):
-        data = b""
-        payload_size = struct.calcsize("!I")
+        receiver = self.frame_receiver
 
         self.log_message("Starting video reception...")
 
+        # H.264 needs a stateful decoder; MJPEG frames decode independently
+        h264_decoder = av.CodecContext.create('h264', 'r') if self.video_codec == 'h264' else None
+
         while self.running:
             try:
-                # Retrieve message size
-                while len(data) < payload_size and self.running:
-                    try:
-                        packet = self.video_socket.recv(4096)
-                        if not packet:
-                            self.log_message("Video socket closed by server")
-                            return
-                        data += packet
-                    except socket.timeout:
-                        continue
-                    except Exception as e:
-                        if self.running:
-                            self.log_message(f"Error receiving video header: {e}")
-                        return
-
-                if len(data) < payload_size:
-                    self.log_message("Incomplete video header received")
-                    return
-
-                packed_msg_size = data[:payload_size]
-                data = data[payload_size:]
-                msg_size = struct.unpack("!I", packed_msg_size)[0]
-
-                # Sanity check for message size
-                if msg_size > 1024 * 1024:  # 1MB limit
-                    self.log_message(f"Invalid frame size: {msg_size}")
-                    data = b""
-                    continue
+                try:
+                    frame_data = receiver.recv_frame()
+                except ValueError as e:
+                    self.log_message(str(e))
+                    break
+                except Exception as e:
+                    if self.running:
+                        self.log_message(f"Error receiving video data: {e}")
+                    break
+                if frame_data is None:
+                    self.log_message("Video socket closed by server")
+                    break
+
+                # Latency stamps travel with the frame through every stage
+                stamps = {'received': time.time()}
+                if self.video_timestamps:
+                    stamps['capture'], stamps['encoded'], stamps['sent'] = FRAME_TIMESTAMPS.unpack_from(frame_data)
+                    frame_data = frame_data[FRAME_TIMESTAMPS.size:]
 
-                # Retrieve all data based on message size
-                while len(data) < msg_size and self.running:
-                    remaining = msg_size - len(data)
+                if h264_decoder:
+                    # Inter-frame packets can't be skipped, so H.264 is decoded here rather than in the decode stage
                     try:
-                        chunk = self.video_socket.recv(min(4096, remaining))
-                        if not chunk:
-                            self.log_message("Connection lost while receiving frame")
-                            return
-                        data += chunk
+                        frame = self.decode_h264(h264_decoder, frame_data)
                     except Exception as e:
-                        if self.running:
-                            self.log_message(f"Error receiving video data: {e}")
-                        return
-
-                frame_data = data[:msg_size]
-                data = data[msg_size:]
-
-                # Decode frame
-                try:
-                    frame_array = np.frombuffer(frame_data, dtype=np.uint8)
-                    frame = cv2.imdecode(frame_array, cv2.IMREAD_COLOR)
-
+                        self.log_message(f"Frame decode error: {e}", logging.DEBUG)
+                        continue
+                    finally:
+                        receiver.release(frame_data)
                     if frame is not None:
-                        # Enhance frame
-                        enhanced_frame = self.enhance_frame(frame)
-
-                        # Resize for display (maintain aspect ratio)
-                        display_width = 640
-                        display_height = 480
-                        enhanced_frame = enhanced_frame.resize((display_width, display_height), Image.Resampling.LANCZOS)
-
-                        # Convert to PhotoImage
-                        photo = ImageTk.PhotoImage(enhanced_frame)
-
-                        # Update GUI in main thread
-                        self.root.after(0, self.update_video_display, photo)
-                    else:
-                        self.log_message("Failed to decode video frame")
-
-                except Exception as e:
-                    self.log_message(f"Frame decode error: {e}")
+                        stamps['decoded'] = time.time()
+                        self.decoded_frames.put((frame, stamps))
+                else:
+                    # No copy: the decode stage releases the buffer once it has decoded it
+                    replaced = self.encoded_frames.put((frame_data, stamps))
+                    if replaced:
+                        receiver.release(replaced[0])
 
             except Exception as e:
                 if self.running:
                     self.log_message(f"Video receive error: {e}")
                 break
 
+        self.encoded_frames.close()
         self.log_message("Video reception stopped")
 
-    def update_video_display(self, photo):
+    def decode_video(self):
+        """Decode stage: JPEG-decode only the newest received frame"""
+        while self.running and not self.encoded_frames.closed:
+            item = self.encoded_frames.get()
+            if item is None:
+                continue
+            frame_data, stamps = item
+            try:
+                # Let libjpeg downscale while decoding when the label is much smaller than the stream
+                flag, factor = self.scaler.decode_mode()
+                frame = cv2.imdecode(np.frombuffer(frame_data, dtype=np.uint8), flag)
+                self.frame_receiver.release(frame_data)
+                if frame is not None:
+                    self.scaler.source_size = (frame.shape[1] * factor, frame.shape[0] * factor)
+                    stamps['decoded'] = time.time()
+                    self.decoded_frames.put((frame, stamps))
+                else:
+                    self.log_message("Failed to decode video frame", logging.DEBUG)
+            except Exception as e:
+                self.log_message(f"Frame decode error: {e}", logging.DEBUG)
+        self.decoded_frames.close()
+
+    def enhance_video(self):
+        """Enhance stage: enhance and resize only the newest decoded frame, then hand it to the Tk thread"""
+        while self.running and not self.decoded_frames.closed:
+            item = self.decoded_frames.get()
+            if item is None:
+                continue
+            frame, stamps = item
+            try:
+                # Resize for display first (maintain aspect ratio) so enhancement runs on the displayed pixels only
+                enhanced_frame = self.enhance_frame(self.scaler.resize(frame))
+                stamps['enhanced'] = time.time()
+
+                self.display_frames.put((enhanced_frame, stamps))
+                # At most one render queued in Tk; it always picks up the newest frame
+                if not self.display_pending:
+                    self.display_pending = True
+                    self.root.after(0, self.update_video_display)
+            except Exception as e:
+                self.log_message(f"Frame enhance error: {e}")
+
+        self.log_message(f"Video pipeline stopped (dropped: decode {self.encoded_frames.dropped}, "
+                         f"enhance {self.decoded_frames.dropped}, display {self.display_frames.dropped})")
+
+    def decode_h264(self, decoder, packet_data):
+        # Returns the newest decoded BGR frame in this packet, if any
+        frame = None
+        for video_frame in decoder.decode(av.Packet(packet_data)):
+            frame = video_frame.to_ndarray(format='bgr24')
+        return frame
+
+    def on_video_label_resized(self, event):
+        # Ignore the 1x1 size reported before the label is mapped; leave a small margin for the border
+        if event.width > 16 and event.height > 16:
+            self.scaler.box = (event.width - 4, event.height - 4)
+
+    def update_video_display(self):
+        self.display_pending = False
+        item = self.display_frames.take()
+        if item is None or not self.running:
+            return
+        image, stamps = item
+
+        # PhotoImage is created on the Tk thread
+        photo = ImageTk.PhotoImage(image)
         self.video_label.configure(image=photo, text='')
         self.video_label.image = photo  # Keep a reference
 
+        if self.telemetry_on:
+            stamps['displayed'] = time.time()
+            self.latency.record_spans(VIDEO_SPANS, stamps, self.clock.offset)
+
     def receive_messages(self):
         while self.running:
             try:
-                data = self.control_socket.recv(1024)
-                if data:
-                    message = data.decode('utf-8')
-                    # Check if the message is an Arduino message
-                    if message.startswith("ARDUINO_MSG:"):
-                        arduino_actual_message = message.replace("ARDUINO_MSG:", "").strip()
-                        self.log_message(f"Arduino: {arduino_actual_message}")
-                    else:
-                        # Log other control messages if any, or just ignore if they are not expected to be logged
-                        self.log_message(f"Control message: {message}")
+                messages = self.control.receive()
+                if messages is None:
+                    if self.running:
+                        self.log_message("Control socket closed by server")
+                    break
+                for error in self.control.drain_errors():
+                    self.log_message(f"Skipped malformed control frame: {error}", logging.WARNING)
+                for message in messages:
+                    self.handle_server_message(message)
             except Exception as e:
                 if self.running:
                     self.log_message(f"Message receive error: {e}")
                 break
 
+    def handle_server_message(self, message):
+        message_type = message.get('type')
+        if message_type == 'arduino':
+            self.log_message(f"Arduino: {message['message']}", logging.DEBUG)
+            if message.get('timing') and self.telemetry_on:
+                stamps = dict(message['timing'], client_received=time.time())
+                self.latency.record_spans(KEY_SPANS, stamps, self.clock.offset)
+        elif message_type == 'pong':
+            self.clock.update(message['client_time'], message['server_time'], time.time())
+        elif message_type == 'stats':
+            self.root.after(0, self.server_stats.set, self.format_server_stats(message))
+        elif message_type == 'pacing':
+            self.root.after(0, self.pacing_status.set,
+                            f"Achieved FPS: {message['achieved_fps']:.1f} "
+                            f"(target {message['target_fps']:g}, jitter {message['jitter_ms']:.1f} ms)")
+        else:
+            # Log other control messages if any, or just ignore if they are not expected to be logged
+            self.log_message(f"Control message: {message}")
+
+    def send_control(self, message):
+        try:
+            self.control.send(message)
+        except Exception as e:
+            self.log_message(f"Send error: {e}", logging.WARNING)
+
+    def send_target_fps(self):
+        if not self.running or not self.control_socket:
+            return
+        try:
+            fps = self.target_fps.get()
+        except tk.TclError:
+            self.log_message("Target FPS must be a number")
+            return
+        self.send_control({"type": "set_fps", "fps": fps})
+        self.log_message(f"Requested {fps} FPS")
+
+    def poll_pacing(self):
+        # Periodically ask the server for its achieved frame rate while connected
+        if not self.running or not self.control_socket:
+            return
+        self.send_control({"type": "get_pacing"})
+        self.send_control({"type": "get_stats"})
+        self.send_ping()
+        self.root.after(2000, self.poll_pacing)
+
+    def send_ping(self):
+        # Round trip for ClockSync, so server timestamps can be compared with ours
+        if self.telemetry_on:
+            self.send_control({"type": "ping", "client_time": time.time()})
+
+    def send_key_event(self, key_type, key_name):
+        # Over UDP the whole pressed set is sent, so a lost packet is healed by the next one
+        if self.udp_sender:
+            self.udp_sender.send(self.pressed_keys)
+        elif self.telemetry_on:
+            # Send time for latency telemetry (UDP snapshots always carry theirs)
+            self.control.send({"type": key_type, "key": key_name, "sent": time.time()})
+        else:
+            self.control.send({"type": key_type, "key": key_name})
+
+    def send_key_heartbeat(self):
+        # Repeat the current snapshot so the server can tell we're alive and recover from lost packets
+        if not self.running or not self.udp_sender:
+            return
+        try:
+            self.udp_sender.send(self.pressed_keys)
+        except OSError as e:
+            self.log_message(f"UDP send error: {e}", logging.WARNING)
+        self.root.after(100, self.send_key_heartbeat)
+
     def on_key_press(self, event):
         # FIX: Allow typing in Entry widgets
         if event.widget.winfo_class() in ('TEntry', 'Entry'):
@@ -675,11 +1972,10 @@ class TankPlantController:
         self.pressed_keys.add(key_name)
 
         try:
-            message = json.dumps({"type": "keydown", "key": key_name})
-            self.control_socket.send(message.encode('utf-8'))
-            self.log_message(f"Key down: {key_name}")
+            self.send_key_event("keydown", key_name)
+            self.log_message(f"Key down: {key_name}", logging.DEBUG)
         except Exception as e:
-            self.log_message(f"Send error: {e}")
+            self.log_message(f"Send error: {e}", logging.WARNING)
 
         return "break"
 
@@ -693,11 +1989,10 @@ class TankPlantController:
             self.pressed_keys.remove(key_name)
 
         try:
-            message = json.dumps({"type": "keyup", "key": key_name})
-            self.control_socket.send(message.encode('utf-8'))
-            self.log_message(f"Key up: {key_name}")
+            self.send_key_event("keyup", key_name)
+            self.log_message(f"Key up: {key_name}", logging.DEBUG)
         except Exception as e:
-            self.log_message(f"Send error: {e}")
+            self.log_message(f"Send error: {e}", logging.WARNING)
 
         return "break"
 
@@ -708,6 +2003,7 @@ class TankPlantController:
 
     def on_closing(self):
         self.disconnect_all()
+        self.log_to_file.set(False)  # Closes the log file
         self.root.destroy()
 
 if __name__ == "__main__":
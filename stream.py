@@ -1,29 +1,966 @@
+import argparse
+import asyncio
 import cv2
+import os
 import socket
+import subprocess
 import struct
 import threading
 import json
+import math
 import serial
 import time
-from queue import Queue
+from collections import OrderedDict, deque
+from fractions import Fraction
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import av  # PyAV, optional: enables the H.264 stream mode
+except ImportError:
+    av = None
+
+# Control protocol, UDP key snapshots and frame timestamps live in tank_protocol, shared with main.py
+from tank_protocol import (CONTROL_MAX_BUFFER, CONTROL_VERSION, FRAME_TIMESTAMPS, decode_control_payload,
+                           decode_key_snapshot, encode_control_frame)
+
+class ControlDecoder:
+    """Incremental control-stream parser: feed() it received bytes, get back the complete messages.
+
+    A first message of {"hello": ...} plus newline switches to length-prefixed frames; anything else
+    is the legacy stream of back-to-back flat JSON objects, split on '}' so coalesced sends still parse.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.framed = None  # Unknown until the first message arrives
+        self.errors = []
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        if self.framed is None:
+            end = self.buffer.find(b'}')
+            if end < 0:
+                return self.check_overflow(messages)
+            if b'"hello"' in self.buffer[:end + 1]:
+                message = self.parse_json(self.buffer[:end + 1])
+                if len(self.buffer) <= end + 1:
+                    return messages  # Wait for the newline that ends the hello line
+                del self.buffer[:end + 2]
+                self.framed = True
+                if isinstance(message, dict):
+                    messages.append(message)
+            else:
+                self.framed = False
+
+        messages.extend(self.read_frames() if self.framed else self.read_legacy())
+        return self.check_overflow(messages)
+
+    def read_frames(self):
+        messages = []
+        while len(self.buffer) >= 2:
+            size = struct.unpack_from("!H", self.buffer)[0]
+            if len(self.buffer) < 2 + size:
+                break
+            payload = self.buffer[2:2 + size]
+            del self.buffer[:2 + size]
+            try:
+                messages.append(decode_control_payload(payload))
+            except (ValueError, IndexError) as e:
+                self.errors.append(f"{e}: {bytes(payload)!r}")
+        return messages
+
+    def read_legacy(self):
+        messages = []
+        while True:
+            end = self.buffer.find(b'}')
+            if end < 0:
+                break
+            message = self.parse_json(self.buffer[:end + 1])
+            del self.buffer[:end + 1]
+            if isinstance(message, dict):
+                messages.append(message)
+        return messages
+
+    def parse_json(self, data):
+        try:
+            return json.loads(bytes(data).decode('utf-8'))
+        except ValueError:
+            self.errors.append(f"Invalid JSON: {bytes(data)!r}")
+            return None
+
+    def check_overflow(self, messages):
+        if len(self.buffer) > CONTROL_MAX_BUFFER:
+            self.errors.append(f"Discarding {len(self.buffer)} unparsed bytes")
+            self.buffer.clear()
+        return messages
+
+    def drain_errors(self):
+        errors, self.errors = self.errors, []
+        return errors
+
+def seq_newer(seq, last):
+    # Serial-number comparison so the 32-bit counter can wrap
+    return 0 < (seq - last) & 0xFFFFFFFF < 0x80000000
+
+class KeySnapshotReceiver:
+    """Turns key-state snapshots into keydown/keyup messages; stale, duplicate and reordered packets are dropped,
+    and a sender that goes quiet for longer than timeout has all its keys released"""
+    def __init__(self, timeout=0.5):
+        self.timeout = timeout
+        self.senders = {}  # addr -> {'session', 'seq', 'keys', 'last_seen'}
+        self.accepted = 0
+        self.stale = 0
+
+    def receive(self, data, addr, now):
+        session, seq, sent_time, keys = decode_key_snapshot(data)
+        sender = self.senders.get(addr)
+        if sender and sender['session'] == session and not seq_newer(seq, sender['seq']):
+            self.stale += 1
+            return []
+
+        previous = sender['keys'] if sender else frozenset()
+        self.senders[addr] = {'session': session, 'seq': seq, 'keys': keys, 'last_seen': now}
+        self.accepted += 1
+        # Carry the client's send time along for latency telemetry
+        return [dict(message, sent=sent_time) for message in self.changes(previous, keys)]
+
+    def expire(self, now):
+        messages = []
+        for addr, sender in self.senders.items():
+            if sender['keys'] and now - sender['last_seen'] > self.timeout:
+                print(f"UDP control sender {addr} went quiet; releasing {', '.join(sorted(sender['keys']))}")
+                messages += self.changes(sender['keys'], frozenset())
+                sender['keys'] = frozenset()
+        return messages
+
+    @staticmethod
+    def changes(previous, keys):
+        # Releases first, so a direction change never briefly drives both ways
+        return ([{"type": "keyup", "key": key} for key in sorted(previous - keys)] +
+                [{"type": "keydown", "key": key} for key in sorted(keys - previous)])
+
+class ControlClient:
+    """A connected control client: its stream decoder and a send path matching the protocol it speaks"""
+    def __init__(self, client_socket, addr):
+        self.socket = client_socket
+        self.addr = addr
+        self.decoder = ControlDecoder()
+        self.version = 1
+        self.binary = False
+        self.subscriptions = set()  # Broadcast topics this client opted into, e.g. "arduino"
+        self.send_lock = threading.Lock()
+
+    def send_line(self, message):
+        # Handshake replies are a plain JSON line, before framing starts
+        self.write((json.dumps(message) + "\n").encode('utf-8'))
+
+    def send(self, message):
+        if self.decoder.framed:
+            data = encode_control_frame(message, self.binary)
+        elif message.get('type') == 'arduino':
+            data = f"ARDUINO_MSG:{message['message']}".encode('utf-8')
+        elif message.get('type') == 'pacing':
+            data = f"PACING_MSG:{json.dumps({k: v for k, v in message.items() if k != 'type'})}".encode('utf-8')
+        else:
+            data = json.dumps(message).encode('utf-8')
+        self.write(data)
+
+    def write(self, data):
+        with self.send_lock:
+            self.socket.sendall(data)
+
+    def close(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+# Optional compact serial protocol: a key state change is two bytes instead of a "keydown:w\n" text line.
+# The first byte has its high bit set (text is plain ASCII), bit 6 set for a press, and the key's index in
+# SERIAL_KEYS; the second is its inverted low seven bits as a checksum. The sketch switches to it (and to a
+# faster baud rate) when asked with a "proto:binary,<baud>" line; older sketches ignore that and stay on text.
+SERIAL_KEYS = "wasdqerty"
+SERIAL_BAUD_RATES = (9600, 19200, 38400, 57600, 115200)
+
+def encode_binary_command(action, key):
+    """Two-byte form of a keydown/keyup, or None if it has none (the caller falls back to text)"""
+    if action not in ('keydown', 'keyup') or not isinstance(key, str) or len(key) != 1 or key not in SERIAL_KEYS:
+        return None
+    command = 0x80 | (0x40 if action == 'keydown' else 0) | SERIAL_KEYS.index(key)
+    return bytes((command, ~command & 0x7F))
+
+def decode_binary_command(data):
+    command, checksum = data[0], data[1]
+    if not command & 0x80:
+        raise ValueError("not a binary command")
+    if checksum != ~command & 0x7F:
+        raise ValueError("bad checksum")
+    index = command & 0x3F
+    if index >= len(SERIAL_KEYS):
+        raise ValueError(f"unknown key index {index}")
+    return ('keydown' if command & 0x40 else 'keyup'), SERIAL_KEYS[index]
+
+# What the sketch prints for each key state change (its DEBUG_PRINTLN lines), used to attribute replies
+SKETCH_KEY_NAMES = {'w': "Forward", 'a': "Left", 's': "Backward", 'd': "Right", 'q': "Head Left", 'e': "Head Right"}
+SKETCH_FACES = {'r': "SMILING", 't': "ANGRY", 'y': "CONFUSED"}
+SKETCH_RESPONSES = {
+    **{f"{name} {'ON' if down else 'OFF'}": ('keydown' if down else 'keyup', key)
+       for key, name in SKETCH_KEY_NAMES.items() for down in (True, False)},
+    **{f"Face: {face}": ('keydown', key) for key, face in SKETCH_FACES.items()},
+}
+
+def match_arduino_response(line):
+    """Return (command, final) for a sketch line that answers a command, else (None, False).
+    The text echo "Incoming command: ..." is not final; the key's effect line that follows it is."""
+    if line.startswith("Incoming command: "):
+        action, _, key = line[len("Incoming command: "):].strip().lower().partition(':')
+        return ((action, key), False) if key else (None, False)
+    command = SKETCH_RESPONSES.get(line)
+    return (command, True) if command else (None, False)
+
+class ArduinoResponseRouter:
+    """Routes Arduino replies to the client whose command caused them, matching commands in the order they were
+    written to the link. Unanswered commands are evicted after timeout or beyond max_outstanding."""
+    def __init__(self, max_outstanding=32, timeout=1.0, max_requesters=64):
+        self.lock = threading.Lock()
+        self.requesters = OrderedDict()  # (action, key) -> (client that last asked for it, timing)
+        self.outstanding = deque()  # ((action, key), client, sent time, timing), oldest first
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        self.max_requesters = max_requesters
+
+        # Counters
+        self.routed = 0
+        self.unmatched = 0
+        self.evicted = 0
+
+    def requested(self, action, key, client, timing=None):
+        # Merged duplicates share one command on the wire; its reply goes to the latest requester.
+        # timing is an optional dict of wall-clock stamps that travels with the command to its reply.
+        with self.lock:
+            self.requesters[(action, key)] = (client, timing)
+            self.requesters.move_to_end((action, key))
+            while len(self.requesters) > self.max_requesters:
+                self.requesters.popitem(last=False)
+
+    def sent(self, action, key, now=None):
+        with self.lock:
+            client, timing = self.requesters.get((action, key), (None, None))
+            if timing is not None:
+                timing = dict(timing, serial_written=time.time())
+            self.outstanding.append(((action, key), client, now or time.monotonic(), timing))
+            while len(self.outstanding) > self.max_outstanding:
+                self.outstanding.popleft()
+                self.evicted += 1
+
+    def route(self, line, now=None):
+        """Return (client, timing) for the command a reply line answers; client is None if it answers nothing
+        outstanding, and timing is only given with the final reply"""
+        now = now or time.monotonic()
+        with self.lock:
+            while self.outstanding and now - self.outstanding[0][2] > self.timeout:
+                self.outstanding.popleft()
+                self.evicted += 1
+
+            command, final = match_arduino_response(line)
+            for entry in self.outstanding:
+                if entry[0] == command:
+                    timing = None
+                    if final:
+                        self.outstanding.remove(entry)
+                        if entry[3] is not None:
+                            timing = dict(entry[3], arduino_ack=time.time())
+                    self.routed += 1
+                    return entry[1], timing
+            self.unmatched += 1
+            return None, None
+
+    def forget(self, client):
+        # A disconnected client's replies become unsolicited
+        with self.lock:
+            for command in [c for c, (requester, _) in self.requesters.items() if requester is client]:
+                del self.requesters[command]
+            self.outstanding = deque((c, None if r is client else r, t, timing)
+                                     for c, r, t, timing in self.outstanding)
+
+    def stats(self):
+        with self.lock:
+            return {"outstanding": len(self.outstanding), "routed": self.routed,
+                    "unmatched": self.unmatched, "evicted": self.evicted}
+
+class SerialCommandScheduler:
+    """Pending Arduino key commands: merges redundant states, sends releases first and paces output to the link's byte rate"""
+    URGENT_ACTIONS = ('keyup', 'stop')
+
+    def __init__(self, bytes_per_second, burst=64, max_pending=32):
+        self.condition = threading.Condition()
+        self.urgent = deque()
+        self.normal = deque()
+        self.max_pending = max_pending
+        self.last_sent = {}  # key -> action last written to the link
+        self.closed = False
+
+        # Token bucket; the default burst matches the Arduino's 64 byte receive buffer
+        self.rate = bytes_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+
+        # Counters
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.throttled = 0
+
+    def pending(self, key):
+        return [c for queue in (self.urgent, self.normal) for c in queue if c[1] == key]
+
+    def put(self, action, key):
+        """Queue a command; returns False if it was merged away because it changes nothing"""
+        with self.condition:
+            pending = self.pending(key)
+            current = self.last_sent.get(key)
+            latest = pending[-1][0] if pending else current
+            if latest == action:
+                self.merged += 1
+                return False
+
+            # Collapse everything pending for this key to at most one press and one release:
+            # the Arduino only needs the final state, plus the press of a tap that hasn't reached it yet
+            if action in self.URGENT_ACTIONS:
+                pressed = current != 'keydown' and any(a == 'keydown' for a, _ in pending)
+                commands = [('keydown', key), (action, key)] if pressed else [(action, key)]
+            else:
+                commands = [] if current == action else [(action, key)]
+            for command in pending:
+                (self.urgent if command in self.urgent else self.normal).remove(command)
+            self.merged += len(pending) + 1 - len(commands)
+
+            if action in self.URGENT_ACTIONS:
+                # Releases jump ahead of other traffic (a pending press of the same key still goes first)
+                self.urgent.extend(commands)
+            else:
+                if commands and len(self.normal) >= self.max_pending:
+                    self.normal.popleft()
+                    self.dropped += 1
+                self.normal.extend(commands)
+            self.condition.notify()
+            return bool(commands)
+
+    def take(self, encode):
+        """Block until the next command fits the byte budget; returns ((action, key), encoded bytes), or None once closed"""
+        with self.condition:
+            while not self.closed:
+                queue = self.urgent or self.normal
+                if not queue:
+                    self.condition.wait()
+                    continue
+
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                try:
+                    data = encode(*queue[0])
+                except Exception as e:
+                    # A command that can't be encoded would otherwise sit at the head of the queue forever
+                    print(f"Dropping unencodable Arduino command {queue[0]!r}: {e}")
+                    queue.popleft()
+                    self.dropped += 1
+                    continue
+                if self.tokens >= len(data):
+                    action, key = queue.popleft()
+                    self.tokens -= len(data)
+                    self.last_sent[key] = action
+                    self.sent += 1
+                    return (action, key), data
+
+                # Over budget: wait for tokens, re-checking if something more urgent arrives meanwhile
+                self.throttled += 1
+                self.condition.wait((len(data) - self.tokens) / self.rate)
+            return None
+
+    def stats(self):
+        with self.condition:
+            return {"queue_depth": len(self.urgent) + len(self.normal), "sent": self.sent,
+                    "merged": self.merged, "dropped": self.dropped, "throttled": self.throttled}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class SerialLink:
+    """Arduino serial port driven by a reader thread blocked in readline and a writer thread fed by a command scheduler"""
+    def __init__(self, port, baudrate=9600, on_line=None, on_sent=None, read_timeout=1.0, max_pending=32):
+        # read_timeout only bounds how long the reader takes to notice close(); lines are handled as they arrive
+        self.serial = serial.Serial(port, baudrate, timeout=read_timeout)
+        self.on_line = on_line
+        self.on_sent = on_sent
+        self.scheduler = SerialCommandScheduler(baudrate / 10, max_pending=max_pending)  # 8N1: ten bits per byte
+        self.binary = False
+        self.running = False
+
+        # Counters
+        self.lines_read = 0
+        self.bytes_written = 0
+
+    def start(self, read=True):
+        # read=False leaves reading to the caller (e.g. an event loop watching fileno())
+        self.running = True
+        threading.Thread(target=self.writer_loop, daemon=True).start()
+        if read:
+            threading.Thread(target=self.reader_loop, daemon=True).start()
+
+    def fileno(self):
+        return self.serial.fileno()
+
+    def negotiate(self, baudrate=115200, binary=True, timeout=1.0):
+        """Ask the sketch for the binary protocol and/or a faster baud rate; call before start().
+        Returns True if it agreed; otherwise the link stays on text at the current rate."""
+        if baudrate not in SERIAL_BAUD_RATES:
+            raise ValueError(f"Unsupported baud rate {baudrate}")
+        read_timeout = self.serial.timeout
+        self.serial.timeout = 0.1
+        try:
+            self.serial.reset_input_buffer()
+            self.serial.write(f"proto:{'binary' if binary else 'text'},{baudrate}\n".encode('utf-8'))
+            self.serial.flush()
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                # The sketch answers "PROTO <binary|text> <baud>" at the old rate, then switches
+                fields = self.serial.readline().decode('utf-8', errors='replace').split()
+                if len(fields) == 3 and fields[0] == 'PROTO':
+                    self.binary = fields[1] == 'binary'
+                    self.serial.baudrate = int(fields[2])
+                    self.scheduler.rate = self.serial.baudrate / 10
+                    return True
+            return False
+        finally:
+            self.serial.timeout = read_timeout
+
+    def send(self, action, key):
+        # Never blocks the caller; the writer thread owns the port's transmit side
+        return self.scheduler.put(action, key)
+
+    def encode_command(self, action, key):
+        if self.binary:
+            data = encode_binary_command(action, key)
+            if data:
+                return data
+        return f"{action}:{key}\n".encode('utf-8')
+
+    def stats(self):
+        return {**self.scheduler.stats(), "bytes_written": self.bytes_written, "lines_read": self.lines_read,
+                "protocol": 'binary' if self.binary else 'text', "baudrate": self.serial.baudrate}
+
+    def writer_loop(self):
+        while self.running:
+            taken = self.scheduler.take(self.encode_command)
+            if taken is None:
+                break
+            (action, key), data = taken
+            try:
+                self.serial.write(data)
+                self.bytes_written += len(data)
+                if self.on_sent:
+                    self.on_sent(action, key)
+            except Exception as e:
+                if self.running:
+                    print(f"Arduino write error: {e}")
+
+    def reader_loop(self):
+        while self.running:
+            try:
+                line = self.serial.readline()
+            except Exception as e:
+                if self.running:
+                    print(f"Arduino listener error: {e}")
+                    time.sleep(1)
+                continue
+            self.handle_line(line)
+
+    def handle_line(self, line):
+        response = line.decode('utf-8', errors='replace').strip()
+        if response:
+            self.lines_read += 1
+            if self.on_line:
+                self.on_line(response)
+
+    def close(self):
+        self.running = False
+        self.scheduler.close()
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+
+def tcp_rtt_ms(sock):
+    """Kernel-smoothed round-trip time of a TCP socket in ms, or None where TCP_INFO is unavailable"""
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+        # struct tcp_info: 8 single-byte fields, then u32s; tcpi_rtt (microseconds) is the 16th u32
+        return struct.unpack_from("8B24I", info)[8 + 15] / 1000.0
+    except (AttributeError, OSError, struct.error):
+        return None
+
+def build_quality_ladder(max_quality=80, min_quality=30, min_scale=0.5, max_fps=20, min_fps=5, steps=3):
+    """List of (jpeg_quality, scale, fps) rungs, best first: quality drops first, then resolution, then frame rate"""
+    def interpolate(high, low, i):
+        return high - (high - low) * i / (steps - 1)
+
+    ladder = [(round(interpolate(max_quality, min_quality, i)), 1.0, max_fps) for i in range(steps)]
+    ladder += [(min_quality, interpolate(1.0, min_scale, i), max_fps) for i in range(1, steps)]
+    ladder += [(min_quality, min_scale, round(interpolate(max_fps, min_fps, i))) for i in range(1, steps)]
+    return ladder
+
+class AdaptiveQuality:
+    """Moves one client up and down the quality ladder based on its send time, RTT and dropped frames"""
+    def __init__(self, ladder, rtt_limit_ms=150, downgrade_interval=1.0, upgrade_interval=3.0):
+        self.ladder = ladder
+        self.rung = 0
+        self.rtt_limit_ms = rtt_limit_ms
+        self.downgrade_interval = downgrade_interval
+        self.upgrade_interval = upgrade_interval
+        self.last_change = time.monotonic()
+        self.healthy_since = self.last_change
+
+        # Smoothed measurements
+        self.send_seconds = 0.0
+        self.rtt_ms = None
+        self.drops = 0
+
+    @property
+    def profile(self):
+        return self.ladder[self.rung]
+
+    def record_send(self, seconds, rtt_ms):
+        # Send time already reflects frame size over link rate, so no separate throughput estimate is kept
+        self.send_seconds += 0.2 * (seconds - self.send_seconds)
+        if rtt_ms is not None:
+            self.rtt_ms = rtt_ms
+        self.update()
+
+    def record_drop(self):
+        self.drops += 1
+
+    def update(self):
+        now = time.monotonic()
+        frame_budget = 1.0 / self.profile[2]
+        congested = (self.drops > 0
+                     or self.send_seconds > 0.8 * frame_budget
+                     or (self.rtt_ms is not None and self.rtt_ms > self.rtt_limit_ms))
+        self.drops = 0
+
+        if congested:
+            self.healthy_since = now
+            if self.rung < len(self.ladder) - 1 and now - self.last_change >= self.downgrade_interval:
+                self.set_rung(self.rung + 1, now)
+        elif self.send_seconds < 0.3 * frame_budget and (self.rtt_ms is None or self.rtt_ms < self.rtt_limit_ms / 2):
+            if self.rung > 0 and now - max(self.healthy_since, self.last_change) >= self.upgrade_interval:
+                self.set_rung(self.rung - 1, now)
+        else:
+            self.healthy_since = now
+
+    def set_rung(self, rung, now):
+        self.rung = rung
+        self.last_change = now
+        self.send_seconds = 0.0
+
+class H264Encoder:
+    """Inter-frame encoder shared by all H.264 clients: Pi hardware encoder first, libx264 as software fallback"""
+    CODECS = ('h264_v4l2m2m', 'libx264')
+
+    def __init__(self, fps=20, bit_rate=1_000_000, gop_size=None):
+        self.fps = fps
+        self.bit_rate = bit_rate
+        self.gop_size = gop_size or fps * 2
+        self.context = None
+        self.name = None
+        self.size = None
+        self.pts = 0
+
+    def open(self, width, height):
+        for name in self.CODECS:
+            try:
+                context = av.CodecContext.create(name, 'w')
+                context.width = width
+                context.height = height
+                context.pix_fmt = 'yuv420p'
+                context.time_base = Fraction(1, self.fps)
+                context.framerate = Fraction(self.fps, 1)
+                context.bit_rate = self.bit_rate
+                context.gop_size = self.gop_size
+                if name == 'libx264':
+                    context.options = {'preset': 'ultrafast', 'tune': 'zerolatency'}
+                context.open()
+            except Exception as e:
+                print(f"H.264 encoder {name} unavailable: {e}")
+                continue
+            self.context = context
+            self.name = name
+            self.size = (width, height)
+            self.pts = 0
+            print(f"H.264 encoder: {name} {width}x{height}")
+            return True
+        return False
+
+    def encode(self, frame, force_keyframe=False):
+        """Encode one BGR frame, returning a list of (packet_bytes, is_keyframe)"""
+        height, width = frame.shape[:2]
+        if self.size != (width, height) and not self.open(width, height):
+            return []
+
+        video_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+        video_frame.pts = self.pts
+        self.pts += 1
+        if force_keyframe:
+            try:
+                video_frame.pict_type = av.video.frame.PictureType.I
+            except AttributeError:
+                video_frame.pict_type = 'I'
+        return [(bytes(packet), packet.is_keyframe) for packet in self.context.encode(video_frame)]
+
+class FramePacer:
+    """Paces a loop to a target FPS on monotonic deadlines, skipping deadlines rather than bursting when behind"""
+    def __init__(self, target_fps):
+        self.next_deadline = None  # Only touched by the thread calling wait()
+        self.set_target(target_fps)
+        self.last_tick = None
+        self.frames_skipped = 0
+
+        # Smoothed measurements
+        self.achieved_fps = 0.0
+        self.jitter_ms = 0.0
+
+    def set_target(self, fps):
+        # Called from control threads: only publish the new period; wait() restarts its schedule on its next tick
+        target_fps = min(max(float(fps), 1.0), 60.0)
+        self.period = 1.0 / target_fps
+        self.target_fps = target_fps
+        self.restart = True
+
+    def wait(self):
+        """Sleep until the next deadline; the time already spent on work this period is not slept again"""
+        now = time.monotonic()
+        period = self.period
+        if self.next_deadline is None or self.restart:
+            self.restart = False
+            self.next_deadline = now
+        else:
+            self.next_deadline += period
+            late = now - self.next_deadline
+            if late > 0:
+                # Missed whole periods are dropped instead of being made up with back-to-back frames
+                skipped = int(late / period)
+                self.frames_skipped += skipped
+                self.next_deadline += skipped * period
+            else:
+                time.sleep(-late)
+
+        tick = time.monotonic()
+        if self.last_tick is not None:
+            interval = tick - self.last_tick
+            if interval > 0:
+                self.achieved_fps += 0.1 * (1.0 / interval - self.achieved_fps)
+            self.jitter_ms += 0.1 * (abs(interval - period) * 1000 - self.jitter_ms)
+        self.last_tick = tick
+
+    def stats(self):
+        return {
+            "target_fps": round(self.target_fps, 2),
+            "achieved_fps": round(self.achieved_fps, 2),
+            "jitter_ms": round(self.jitter_ms, 2),
+            "frames_skipped": self.frames_skipped,
+        }
+
+class VideoClient:
+    """Bounded per-client send queue: stale frames are dropped, the newest is always sent"""
+    def __init__(self, client_socket, addr, max_queued_frames=1, profile=(70, 1.0, 20), adaptive=None,
+                 codec='mjpeg'):
+        self.socket = client_socket
+        self.addr = addr
+        self.codec = codec
+        self.max_queued_frames = max(1, max_queued_frames)
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # Fixed (quality, scale, fps) profile, or an AdaptiveQuality controller choosing one
+        self.fixed_profile = profile
+        self.adaptive = adaptive
+        self.last_offer_time = 0.0
+
+        # H.264 packets depend on their predecessors, so after any drop we resync on a keyframe
+        self.awaiting_keyframe = codec == 'h264'
+
+        # Negotiated: prefix each payload with FRAME_TIMESTAMPS
+        self.timestamps = False
+
+        # Counters
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+
+    def offer(self, data, keyframe=True, times=None):
+        # times is (capture, encoded) wall-clock time, sent along when the client asked for timestamps
+        with self.condition:
+            if self.closed:
+                return
+            if self.awaiting_keyframe:
+                if not keyframe:
+                    self.frames_dropped += 1
+                    return
+                self.awaiting_keyframe = False
+            if self.codec == 'h264' and len(self.frames) >= self.max_queued_frames:
+                # Drop the whole backlog; the next keyframe restarts decoding at the newest picture
+                self.frames_dropped += len(self.frames) + 1
+                self.frames.clear()
+                self.awaiting_keyframe = True
+                return
+            while len(self.frames) >= self.max_queued_frames:
+                self.frames.popleft()
+                self.frames_dropped += 1
+                if self.adaptive:
+                    self.adaptive.record_drop()
+            self.frames.append((data, times))
+            self.condition.notify()
+
+    def packet(self, data, times):
+        # Length-prefixed wire form of a queued frame
+        if not self.timestamps:
+            return struct.pack("!I", len(data)) + data
+        capture, encoded = times or (0.0, 0.0)
+        return (struct.pack("!I", FRAME_TIMESTAMPS.size + len(data)) +
+                FRAME_TIMESTAMPS.pack(capture, encoded, time.time()) + data)
+
+    @property
+    def profile(self):
+        return self.adaptive.profile if self.adaptive else self.fixed_profile
+
+    def wants_frame(self, now):
+        # Per-client frame rate cap on top of the capture rate (H.264 needs every packet)
+        fps = self.profile[2]
+        if self.codec == 'h264' or fps is None:
+            return True
+        if now - self.last_offer_time < 0.9 / fps:
+            return False
+        self.last_offer_time = now
+        return True
+
+    def next_frame(self, timeout=1.0):
+        # Returns the oldest queued (data, times), or None on timeout/close
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames or self.closed, timeout)
+            if self.closed or not self.frames:
+                return None
+            return self.frames.popleft()
+
+    def pop_frame(self):
+        # Non-blocking next_frame
+        with self.condition:
+            return self.frames.popleft() if self.frames else None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify_all()
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class ServerMetrics:
+    """Live counters and system readings, served as JSON over HTTP and as the control channel's get_stats reply.
+    Temperature and vcgencmd are read by a sampler thread, so a snapshot never waits on sysfs or a subprocess."""
+    # vcgencmd get_throttled bits: low nibble is "now", the same bits << 16 mean "since boot"
+    THROTTLE_FLAGS = {0: "under-voltage", 1: "arm frequency capped", 2: "throttled", 3: "soft temperature limit"}
+
+    def __init__(self, server, rate_interval=1.0, vcgencmd_interval=5.0):
+        self.server = server
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.encode_ms = None  # EMA of encode time per captured frame, all profiles together
+        self.rate_interval = rate_interval
+        self.rates = {}  # id(client) -> (time, frames_sent, bytes_sent, fps, bytes/s)
+        self.cpu_sample = (time.monotonic(), sum(os.times()[:2]), 0.0)
+        self.vcgencmd_interval = vcgencmd_interval
+        self.throttled = (float('-inf'), None)  # (checked at, value)
+        self.system_readings = (None, None)  # (cpu temperature, throttle state), replaced whole by the sampler
+
+    def start(self):
+        threading.Thread(target=self.sampler_loop, daemon=True).start()
+
+    def sampler_loop(self):
+        while self.server.running:
+            self.system_readings = (self.cpu_temperature(), self.throttle_state(time.monotonic()))
+            time.sleep(self.rate_interval)
+
+    def record_encode(self, seconds):
+        with self.lock:
+            ms = seconds * 1000
+            self.encode_ms = ms if self.encode_ms is None else 0.9 * self.encode_ms + 0.1 * ms
+
+    def client_rates(self, client, now):
+        # Rates over at least rate_interval, so frequent readers don't see noisy numbers
+        previous = self.rates.get(id(client))
+        if previous is None or now - previous[0] >= self.rate_interval:
+            fps = bytes_per_s = None  # Unknown until the second look
+            if previous is not None:
+                elapsed = now - previous[0]
+                fps = (client.frames_sent - previous[1]) / elapsed
+                bytes_per_s = (client.bytes_sent - previous[2]) / elapsed
+            self.rates[id(client)] = (now, client.frames_sent, client.bytes_sent, fps, bytes_per_s)
+        return self.rates[id(client)][3:]
+
+    def cpu_percent(self, now):
+        # Process CPU use (all threads) over at least rate_interval
+        started, cpu, percent = self.cpu_sample
+        if now - started >= self.rate_interval:
+            total = sum(os.times()[:2])
+            percent = 100 * (total - cpu) / (now - started)
+            self.cpu_sample = (now, total, percent)
+        return percent
+
+    @staticmethod
+    def cpu_temperature():
+        try:
+            with open("/sys/class/thermal/thermal_zone0/temp") as f:
+                return int(f.read()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    def throttle_state(self, now):
+        # vcgencmd only exists on a Raspberry Pi, and is slow enough to cache
+        checked, value = self.throttled
+        if now - checked >= self.vcgencmd_interval:
+            try:
+                output = subprocess.run(['vcgencmd', 'get_throttled'], capture_output=True, text=True,
+                                        timeout=1).stdout
+                value = int(output.strip().split('=')[1], 16)
+            except (OSError, subprocess.SubprocessError, IndexError, ValueError):
+                value = None
+            self.throttled = (now, value)
+        if value is None:
+            return None
+        return {"raw": hex(value),
+                "now": [name for bit, name in self.THROTTLE_FLAGS.items() if value & (1 << bit)],
+                "since_boot": [name for bit, name in self.THROTTLE_FLAGS.items() if value & (1 << (bit + 16))]}
+
+    def snapshot(self):
+        server = self.server
+        now = time.monotonic()
+        # Only the counters are read under the lock; record_encode on the capture thread shares it
+        with self.lock:
+            encode_ms = self.encode_ms
+            clients = []
+            for client in server.video_clients[:]:
+                fps, bytes_per_s = self.client_rates(client, now)
+                clients.append({"addr": f"{client.addr[0]}:{client.addr[1]}", "codec": client.codec,
+                                "profile": list(client.profile),
+                                "fps": None if fps is None else round(fps, 1),
+                                "bytes_per_s": None if bytes_per_s is None else round(bytes_per_s), "frames_sent": client.frames_sent,
+                                "frames_dropped": client.frames_dropped, "queued": len(client.frames)})
+            live = {id(client) for client in server.video_clients}
+            self.rates = {key: value for key, value in self.rates.items() if key in live}
+            cpu_percent = self.cpu_percent(now)
+
+        serial_stats = None
+        if server.arduino:
+            serial_stats = {**server.arduino.stats(), **server.arduino_responses.stats()}
+
+        cpu_temp, throttled = self.system_readings
+        return {
+            "uptime_s": round(now - self.started, 1),
+            "capture": server.pacer.stats(),
+            "encode_ms": None if encode_ms is None else round(encode_ms, 2),
+            "video_clients": clients,
+            "control_clients": len(server.control_clients),
+            "serial": serial_stats,
+            "system": {"cpu_percent": round(cpu_percent, 1),
+                       "cpu_temp_c": cpu_temp,
+                       "load_avg": [round(load, 2) for load in os.getloadavg()],
+                       "throttled": throttled},
+        }
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """GET / or /metrics: the ServerMetrics snapshot as JSON"""
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.metrics.snapshot(), indent=2).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep polling out of the server log
 
 class VideoStreamServer:
-    def __init__(self, video_port=8888, control_port=8889, arduino_port='/dev/ttyUSB0'):
+    def __init__(self, video_port=8888, control_port=8889, arduino_port='/dev/ttyUSB0',
+                 max_queued_frames=1, send_buffer_size=64 * 1024, send_timeout=5.0,
+                 jpeg_quality=70, max_fps=20, adaptive=False, quality_ladder=None,
+                 h264=True, h264_bit_rate=1_000_000, h264_max_queued_frames=10, hello_timeout=0.5,
+                 udp_control=True, udp_timeout=0.5, camera=None, serial_baud=115200, serial_binary=True,
+                 metrics_port=8890, metrics_host='127.0.0.1'):
         self.video_port = video_port
         self.control_port = control_port
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host  # Loopback only unless asked; the stats are also available via get_stats
         self.arduino_port = arduino_port
+
+        # Encoding settings; in adaptive mode each client walks quality_ladder instead
+        self.jpeg_quality = jpeg_quality
+        self.max_fps = max_fps
+        self.adaptive = adaptive
+        self.quality_ladder = quality_ladder or build_quality_ladder(max_fps=max_fps)
+
+        # Per-client backpressure: frames waiting in our queue plus what the kernel buffers
+        self.max_queued_frames = max_queued_frames
+        self.send_buffer_size = send_buffer_size
+        self.send_timeout = send_timeout
         
-        # Initialize camera
-        self.camera = cv2.VideoCapture(0)  # USB webcam
+        # Initialize camera (any object with VideoCapture's read/set/release can stand in)
+        self.camera = camera if camera is not None else cv2.VideoCapture(0)  # USB webcam
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
         self.camera.set(cv2.CAP_PROP_FPS, 30)
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # Skipped deadlines shouldn't leave stale frames queued
+
+        # Capture pacing; the target can be changed at runtime from the control channel
+        self.pacer = FramePacer(max_fps)
+
+        # Counters for the metrics endpoint and get_stats
+        self.metrics = ServerMetrics(self)
+        self.metrics_server = None
+
+        # Optional H.264 mode, negotiated per client at connect time
+        self.h264_encoder = None
+        self.h264_max_queued_frames = h264_max_queued_frames
+        self.hello_timeout = hello_timeout
+        if h264 and av is not None:
+            encoder = H264Encoder(fps=max_fps, bit_rate=h264_bit_rate)
+            if encoder.open(640, 480):
+                self.h264_encoder = encoder
         
+        # Arduino replies go back to whoever sent the command; other lines only to subscribers
+        self.arduino_responses = ArduinoResponseRouter()
+
         # Initialize Arduino serial connection
         try:
-            self.arduino = serial.Serial(arduino_port, 9600, timeout=1)
-            time.sleep(2)  # Wait for Arduino to initialize
-            print(f"Arduino connected on {arduino_port}")
+            if not arduino_port:
+                raise ValueError("no Arduino port configured")
+            self.arduino = SerialLink(arduino_port, 9600, on_line=self.handle_arduino_line,
+                                      on_sent=self.arduino_responses.sent)
+            time.sleep(2)  # Wait for Arduino to initialize (it resets when the port opens)
+            if (serial_binary or serial_baud != 9600) and not self.arduino.negotiate(serial_baud, serial_binary):
+                print("Arduino sketch did not answer the protocol request; using text commands at 9600 baud")
+            print(f"Arduino connected on {arduino_port} "
+                  f"({'binary' if self.arduino.binary else 'text'} commands, {self.arduino.serial.baudrate} baud)")
         except Exception as e:
             print(f"Failed to connect to Arduino: {e}")
             self.arduino = None
@@ -35,12 +972,21 @@ class VideoStreamServer:
         # Threading control
         self.running = False
         
-        # Message queue for Arduino responses
-        self.arduino_response_queue = Queue()
+        # Optional UDP key-state transport on the control port number
+        self.udp_control = udp_control
+        self.key_snapshots = KeySnapshotReceiver(udp_timeout)
         
     def start_server(self):
         self.running = True
         
+        # Start capture thread (one camera reader and encoder for every client)
+        capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+        capture_thread.start()
+
+        # Start metrics endpoint and the temperature/throttling sampler behind it
+        self.metrics.start()
+        self.start_metrics_server()
+
         # Start video server
         video_thread = threading.Thread(target=self.video_server, daemon=True)
         video_thread.start()
@@ -49,10 +995,14 @@ class VideoStreamServer:
         control_thread = threading.Thread(target=self.control_server, daemon=True)
         control_thread.start()
         
+        # Start UDP control receiver
+        if self.udp_control:
+            udp_thread = threading.Thread(target=self.udp_control_server, daemon=True)
+            udp_thread.start()
+
         # Start Arduino communication
         if self.arduino:
-            arduino_thread = threading.Thread(target=self.arduino_listener, daemon=True)
-            arduino_thread.start()
+            self.arduino.start()
             
         print("Server started successfully")
         print(f"Video port: {self.video_port}")
@@ -64,6 +1014,19 @@ class VideoStreamServer:
         except KeyboardInterrupt:
             self.stop_server()
             
+    def start_metrics_server(self):
+        if not self.metrics_port:
+            return
+        try:
+            self.metrics_server = ThreadingHTTPServer((self.metrics_host, self.metrics_port), MetricsRequestHandler)
+        except OSError as e:
+            print(f"Metrics endpoint unavailable on port {self.metrics_port}: {e}")
+            return
+        self.metrics_server.daemon_threads = True
+        self.metrics_server.metrics = self.metrics
+        threading.Thread(target=self.metrics_server.serve_forever, daemon=True).start()
+        print(f"Metrics endpoint: http://{self.metrics_host}:{self.metrics_port}/metrics")
+
     def video_server(self):
         video_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         video_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -76,9 +1039,7 @@ class VideoStreamServer:
             try:
                 client_socket, addr = video_socket.accept()
                 print(f"Video client connected: {addr}")
-                
-                self.video_clients.append(client_socket)
-                
+
                 # Start video streaming thread for this client
                 client_thread = threading.Thread(
                     target=self.stream_video_to_client, 
@@ -105,13 +1066,16 @@ class VideoStreamServer:
             try:
                 client_socket, addr = control_socket.accept()
                 print(f"Control client connected: {addr}")
-                
-                self.control_clients.append(client_socket)
+
+                # Key events are tiny; don't let Nagle hold them back
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                client = ControlClient(client_socket, addr)
+                self.control_clients.append(client)
                 
                 # Start control handler thread for this client
                 client_thread = threading.Thread(
                     target=self.handle_control_client,
-                    args=(client_socket, addr),
+                    args=(client,),
                     daemon=True
                 )
                 client_thread.start()
@@ -122,119 +1086,349 @@ class VideoStreamServer:
                     
         control_socket.close()
         
-    def stream_video_to_client(self, client_socket, addr):
+    def udp_control_server(self):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(('0.0.0.0', self.control_port))
+        udp_socket.settimeout(0.1)  # Wake up regularly to release keys of silent senders
+
+        print(f"UDP control listening on port {self.control_port}")
+
+        while self.running:
+            try:
+                try:
+                    data, addr = udp_socket.recvfrom(2048)
+                except socket.timeout:
+                    data, addr = None, None
+
+                self.handle_key_snapshot(data, addr)
+
+            except Exception as e:
+                if self.running:
+                    print(f"UDP control error: {e}")
+
+        udp_socket.close()
+
+    def handle_key_snapshot(self, data, addr):
+        # data is None when called only to expire silent senders
+        now = time.monotonic()
+        if data:
+            try:
+                messages = self.key_snapshots.receive(data, addr, now)
+            except ValueError as e:
+                print(f"Invalid UDP control packet from {addr}: {e}")
+                messages = []
+            for message in messages:
+                self.process_keystroke(message, self.control_client_for(addr))
+
+        for message in self.key_snapshots.expire(now):
+            self.process_keystroke(message, None)
+
+    def control_client_for(self, addr):
+        # UDP key state has no reply path; answer on a control connection from the same host
+        return next((c for c in self.control_clients[:] if c.addr[0] == addr[0]), None)
+
+    @property
+    def supported_codecs(self):
+        return ['h264', 'mjpeg'] if self.h264_encoder else ['mjpeg']
+
+    def negotiate_video(self, hello):
+        """Settle codec and frame timestamps from a client hello line; returns (codec, timestamps, reply)
+        where reply is None for legacy clients"""
         try:
-            while self.running:
+            hello = json.loads(hello.decode('utf-8'))
+            requested = hello.get('codecs', [])
+        except (ValueError, AttributeError):
+            return 'mjpeg', False, None
+        codec = next((c for c in requested if c in self.supported_codecs), 'mjpeg')
+        timestamps = bool(hello.get('timestamps'))
+        return codec, timestamps, (json.dumps({"codec": codec, "timestamps": timestamps}) + "\n").encode('utf-8')
+
+    def read_video_hello(self, client_socket):
+        # Clients that support negotiation send one JSON line right after connecting; legacy clients send nothing
+        hello = b""
+        client_socket.settimeout(self.hello_timeout)
+        try:
+            while not hello.endswith(b"\n") and len(hello) < 1024:
+                chunk = client_socket.recv(1024 - len(hello))
+                if not chunk:
+                    break
+                hello += chunk
+        except socket.timeout:
+            pass
+        return hello
+
+    def new_video_client(self, codec, *client_args, client_class=VideoClient):
+        # client_args are the connection arguments of client_class, ending with the peer address
+        if codec == 'h264':
+            client = client_class(*client_args, self.h264_max_queued_frames, codec='h264')
+        else:
+            adaptive = AdaptiveQuality(self.quality_ladder) if self.adaptive else None
+            client = client_class(*client_args, self.max_queued_frames,
+                                  profile=(self.jpeg_quality, 1.0, None), adaptive=adaptive)
+        print(f"Video client {client.addr} using {codec}")
+        return client
+
+    def encode_frame(self, frame, quality, scale):
+        # Downscale before encoding: cheaper to encode and far fewer bytes on the wire
+        if scale < 1.0:
+            height, width = frame.shape[:2]
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        result, encoded_frame = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+        return encoded_frame.tobytes() if result else None
+
+    def capture_loop(self):
+        """Read each camera frame once, encode it once per profile in use, and fan it out to all clients"""
+        while self.running:
+            try:
                 ret, frame = self.camera.read()
+                capture_time = time.time()
                 if not ret:
                     print("Failed to capture frame")
+                    time.sleep(0.1)
                     continue
-                    
-                # Encode frame as JPEG with optimization for low-power Pi
-                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 70]  # Reduce quality for Pi
-                result, encoded_frame = cv2.imencode('.jpg', frame, encode_param)
-                
-                if not result:
+
+                clients = self.video_clients[:]
+                encode_start = time.perf_counter()
+
+                # One shared H.264 encoder; a keyframe is forced whenever a client joins or has to resync
+                h264_clients = [c for c in clients if c.codec == 'h264']
+                if h264_clients:
+                    force_keyframe = any(c.awaiting_keyframe for c in h264_clients)
+                    packets = self.h264_encoder.encode(frame, force_keyframe)
+                    times = (capture_time, time.time())
+                    for data, keyframe in packets:
+                        for client in h264_clients:
+                            client.offer(data, keyframe, times)
+
+                # Encode once per distinct (quality, scale) so cost scales with profiles, not viewers
+                now = time.monotonic()
+                encoded = {}
+                for client in clients:
+                    if client.codec != 'mjpeg' or not client.wants_frame(now):
+                        continue
+                    quality, scale, _ = client.profile
+                    if (quality, scale) not in encoded:
+                        encoded[(quality, scale)] = (self.encode_frame(frame, quality, scale),
+                                                     (capture_time, time.time()))
+                    data, times = encoded[(quality, scale)]
+                    if data is not None:
+                        client.offer(data, times=times)
+                if clients:
+                    self.metrics.record_encode(time.perf_counter() - encode_start)
+
+                # Control frame rate to reduce Pi load
+                self.pacer.wait()
+
+            except Exception as e:
+                if self.running:
+                    print(f"Capture error: {e}")
+                    time.sleep(1)
+
+    def stream_video_to_client(self, client_socket, addr):
+        codec, timestamps, reply = self.negotiate_video(self.read_video_hello(client_socket))
+
+        # Keep the kernel send buffer small so stale frames queue here, where they can be dropped
+        if self.send_buffer_size:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        client_socket.settimeout(self.send_timeout)
+
+        client = self.new_video_client(codec, client_socket, addr)
+        client.timestamps = timestamps
+
+        try:
+            if reply:
+                client_socket.sendall(reply)
+            self.video_clients.append(client)
+
+            while self.running and not client.closed:
+                frame = client.next_frame()
+                if frame is None:
                     continue
-                    
-                # Send frame size first
-                data = encoded_frame.tobytes()
-                size = len(data)
-                
+
+                # Frame size first (and timestamps, if negotiated), then the frame
+                packet = client.packet(*frame)
+
                 try:
-                    client_socket.sendall(struct.pack("!I", size) + data)
+                    send_start = time.monotonic()
+                    client.socket.sendall(packet)
                 except:
-                    # Client disconnected
+                    # Client disconnected or stalled past send_timeout
                     break
-                    
-                # Control frame rate to reduce Pi load
-                time.sleep(1/20)  # ~20 FPS max
-                
+
+                client.frames_sent += 1
+                client.bytes_sent += len(packet)
+                if client.adaptive:
+                    client.adaptive.record_send(time.monotonic() - send_start, tcp_rtt_ms(client.socket))
+
         except Exception as e:
             print(f"Video streaming error for {addr}: {e}")
         finally:
-            if client_socket in self.video_clients:
-                self.video_clients.remove(client_socket)
-            client_socket.close()
-            print(f"Video client {addr} disconnected")
+            if client in self.video_clients:
+                self.video_clients.remove(client)
+            client.close()
+            print(f"Video client {addr} disconnected "
+                  f"(sent {client.frames_sent}, dropped {client.frames_dropped})")
             
-    def handle_control_client(self, client_socket, addr):
+    def handle_control_client(self, client):
+        addr = client.addr
         try:
             while self.running:
-                data = client_socket.recv(1024)
+                data = client.socket.recv(4096)
                 if not data:
                     break
-                    
-                try:
-                    message = json.loads(data.decode('utf-8'))
-                    self.process_keystroke(message, client_socket)
-                except json.JSONDecodeError:
-                    print(f"Invalid JSON from {addr}: {data}")
+
+                self.handle_control_data(client, data)
                     
         except Exception as e:
             print(f"Control client error for {addr}: {e}")
         finally:
-            if client_socket in self.control_clients:
-                self.control_clients.remove(client_socket)
-            client_socket.close()
+            if client in self.control_clients:
+                self.control_clients.remove(client)
+            self.arduino_responses.forget(client)
+            client.close()
             print(f"Control client {addr} disconnected")
+
+    def handle_control_data(self, client, data):
+        for message in client.decoder.feed(data):
+            if 'hello' in message:
+                client.send_line(self.control_handshake(client, message))
+            else:
+                self.handle_control_message(message, client)
+        for error in client.decoder.drain_errors():
+            print(f"Invalid control data from {client.addr}: {error}")
+
+    def control_handshake(self, client, hello):
+        """Settle the protocol version and encoding for a client hello; returns the reply.
+        A malformed hello gets the most basic answer: version 1, JSON, TCP only."""
+        version = hello.get('version', 1)
+        encodings = hello.get('encodings', [])
+        transports = hello.get('transports', [])
+        if (not isinstance(version, int) or isinstance(version, bool) or version < 1
+                or not isinstance(encodings, list) or not isinstance(transports, list)):
+            print(f"Malformed control hello from {client.addr}: {hello}; using protocol v1 (json)")
+            version, encodings, transports = 1, [], []
+
+        client.version = min(version, CONTROL_VERSION)
+        client.binary = 'binary' in encodings
+        print(f"Control client {client.addr} using protocol v{client.version} "
+              f"({'binary' if client.binary else 'json'})")
+        reply = {"version": client.version, "encoding": 'binary' if client.binary else 'json'}
+        if self.udp_control and 'udp' in transports:
+            reply["udp_port"] = self.control_port
+        return reply
             
-    def process_keystroke(self, message, client_socket):
+    def handle_control_message(self, message, client):
+        message_type = message.get('type')
+        if message_type in ('keydown', 'keyup'):
+            self.process_keystroke(message, client)
+        elif message_type == 'set_fps':
+            fps = message.get('fps')
+            # Only plain finite numbers; anything else is ignored instead of dropping the client
+            if not isinstance(fps, (int, float)) or isinstance(fps, bool) or not math.isfinite(fps):
+                print(f"Ignoring set_fps from {client.addr} with invalid fps: {fps!r}")
+                return
+            self.pacer.set_target(fps)
+            print(f"Target FPS set to {self.pacer.target_fps}")
+            self.send_pacing_stats(client)
+        elif message_type == 'get_pacing':
+            self.send_pacing_stats(client)
+        elif message_type == 'get_serial_stats':
+            self.send_serial_stats(client)
+        elif message_type == 'get_stats':
+            self.send_stats(client)
+        elif message_type == 'ping':
+            # Lets the client estimate the offset between its clock and ours for latency telemetry
+            client.send({"type": "pong", "client_time": message.get('client_time'), "server_time": time.time()})
+        elif message_type in ('subscribe', 'unsubscribe'):
+            topics = message.get('topics', [])
+            # A list of topic names; a bare string would otherwise subscribe to each of its characters
+            if not isinstance(topics, list) or not all(isinstance(topic, str) for topic in topics):
+                print(f"Ignoring {message_type} from {client.addr} with invalid topics: {topics!r}")
+                return
+            topics = set(topics)
+            if message_type == 'subscribe':
+                client.subscriptions |= topics
+            else:
+                client.subscriptions -= topics
+            print(f"Control client {client.addr} subscriptions: {sorted(client.subscriptions)}")
+        else:
+            print(f"Unknown control message: {message}")
+
+    def send_pacing_stats(self, client):
+        try:
+            client.send({"type": "pacing", **self.pacer.stats()})
+        except Exception as e:
+            print(f"Error sending pacing stats: {e}")
+
+    def send_stats(self, client):
+        try:
+            client.send({"type": "stats", **self.metrics.snapshot()})
+        except Exception as e:
+            print(f"Error sending stats: {e}")
+
+    def send_serial_stats(self, client):
+        # Command scheduler queue depth and merged/dropped counts; empty without an Arduino
+        stats = {**self.arduino.stats(), **self.arduino_responses.stats()} if self.arduino else {}
+        try:
+            client.send({"type": "serial", **stats})
+        except Exception as e:
+            print(f"Error sending serial stats: {e}")
+
+    def process_keystroke(self, message, client):
         if not self.arduino:
             return
             
         key_type = message.get('type')
         key = message.get('key')
-        
+        if not isinstance(key, str) or not key:
+            print(f"Ignoring {key_type} from {client.addr if client else 'udp'} with invalid key: {key!r}")
+            return
+
         print(f"Received {key_type}: {key}")
         
-        # Format message for Arduino
-        arduino_message = f"{key_type}:{key}\n"
-        
         try:
-            # Send to Arduino
-            # self.arduino.write(arduino_message.encode('utf-8'))
-            self.arduino.write(f"{arduino_message}\n".encode())
-            time.sleep(0.01) # Saftey
+            # Remember who asked so the Arduino's reply can be routed back, with latency stamps if the client sent any
+            timing = None
+            if message.get('sent') is not None:
+                timing = {"key_sent": message['sent'], "server_received": time.time()}
+            self.arduino_responses.requested(key_type, key, client, timing)
 
-            print(f"Sent to Arduino: {arduino_message.strip()}")
-            
-            # Store client socket for response routing
-            self.arduino_response_queue.put(client_socket)
+            # Queue for the serial writer thread; repeats of the current key state are merged away
+            if self.arduino.send(key_type, key):
+                print(f"Queued for Arduino: {key_type}:{key}")
             
         except Exception as e:
             print(f"Arduino communication error: {e}")
             
-    def arduino_listener(self):
-        """Listen for Arduino responses and forward to clients"""
-        while self.running:
+    def handle_arduino_line(self, response):
+        """Send an Arduino reply to the client whose command caused it; anything else to "arduino" subscribers"""
+        print(f"Arduino response: {response}")
+
+        client, timing = self.arduino_responses.route(response)
+        message = {"type": "arduino", "message": response}
+        if timing:
+            message["timing"] = timing
+        if client is not None:
+            recipients = [client]
+        else:
+            # Ensure the list is copied to avoid issues if a client disconnects during iteration
+            recipients = [c for c in self.control_clients[:] if 'arduino' in c.subscriptions]
+
+        for client in recipients:
             try:
-                if self.arduino.in_waiting > 0:
-                    response = self.arduino.readline().decode('utf-8').strip()
-                    if response:
-                        print(f"Arduino response: {response}")
-
-                        # Broadcast to all control clients
-                        # Ensure the list is copied to avoid issues if a client disconnects during iteration
-                        for client in self.control_clients[:]:
-                            try:
-                                # Prepend a tag to distinguish Arduino messages
-                                tagged_response = f"ARDUINO_MSG:{response}"
-                                client.send(tagged_response.encode('utf-8'))
-                            except Exception as client_e:
-                                print(f"Error sending Arduino response to client: {client_e}. Removing client.")
-                                if client in self.control_clients:
-                                    self.control_clients.remove(client)
-
-                time.sleep(0.01)  # Small delay to prevent busy waiting
+                client.send(message)
+            except Exception as client_e:
+                print(f"Error sending Arduino response to client: {client_e}. Removing client.")
+                if client in self.control_clients:
+                    self.control_clients.remove(client)
 
-            except Exception as e:
-                print(f"Arduino listener error: {e}")
-                time.sleep(1)
-                
     def stop_server(self):
         print("Stopping server...")
         self.running = False
+
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
         
         # Close all client connections
         for client in self.video_clients[:]:
@@ -248,14 +1442,243 @@ class VideoStreamServer:
             
         # Close Arduino connection
         if self.arduino:
+            print(f"Serial link stats: {self.arduino.stats()}")
             self.arduino.close()
             
         print("Server stopped")
 
+class AsyncVideoClient(VideoClient):
+    """VideoClient whose frames are written by an asyncio task instead of a dedicated thread"""
+    def __init__(self, writer, loop, addr, *args, **kwargs):
+        super().__init__(writer.get_extra_info('socket'), addr, *args, **kwargs)
+        self.writer = writer
+        self.loop = loop
+        self.wake = asyncio.Event()
+
+    def offer(self, data, keyframe=True, times=None):
+        # Called from the capture thread; wake the client's writer task on the event loop
+        super().offer(data, keyframe, times)
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+        self.loop.call_soon_threadsafe(self.wake.set)
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+class AsyncControlClient(ControlClient):
+    """ControlClient writing through an asyncio transport; safe to call from any thread"""
+    def __init__(self, writer, loop, addr):
+        super().__init__(writer.get_extra_info('socket'), addr)
+        self.writer = writer
+        self.loop = loop
+
+    def write(self, data):
+        # Transport writes never block; the kernel buffer and the transport absorb bursts
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+class UdpControlProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.handle_key_snapshot(data, addr)
+
+class AsyncVideoStreamServer(VideoStreamServer):
+    """Same ports and wire format as VideoStreamServer, but video fan-out, control messages and the
+    serial link share one asyncio event loop instead of a thread per client.
+    Capture/encode keeps its own thread, and serial writes stay on the SerialLink writer thread."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.stopped = None
+        self.arduino_buffer = b""
+
+    def start_server(self):
+        self.running = True
+
+        # Start capture thread (one camera reader and encoder for every client)
+        capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+        capture_thread.start()
+
+        # Start metrics endpoint and the temperature/throttling sampler behind it
+        self.metrics.start()
+        self.start_metrics_server()
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.running:
+                self.stop_server()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        video_server = await asyncio.start_server(self.serve_video, '0.0.0.0', self.video_port,
+                                                  reuse_address=True)
+        control_server = await asyncio.start_server(self.serve_control, '0.0.0.0', self.control_port,
+                                                    reuse_address=True)
+
+        udp_transport = None
+        if self.udp_control:
+            udp_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: UdpControlProtocol(self), local_addr=('0.0.0.0', self.control_port))
+            self.loop.create_task(self.expire_key_snapshots())
+
+        if self.arduino:
+            # Reads are dispatched by the event loop; only the writer gets a thread
+            self.arduino.start(read=False)
+            self.loop.add_reader(self.arduino.fileno(), self.on_arduino_readable)
+
+        print("Server started successfully (asyncio)")
+        print(f"Video port: {self.video_port}")
+        print(f"Control port: {self.control_port}")
+
+        async with video_server, control_server:
+            await self.stopped.wait()
+
+        if self.arduino:
+            self.loop.remove_reader(self.arduino.fileno())
+        if udp_transport:
+            udp_transport.close()
+
+    async def serve_video(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"Video client connected: {addr}")
+
+        # Clients that support negotiation send one JSON line right after connecting; legacy clients send nothing
+        try:
+            hello = await asyncio.wait_for(reader.readline(), self.hello_timeout)
+        except (asyncio.TimeoutError, ValueError):
+            hello = b""
+        codec, timestamps, reply = self.negotiate_video(hello)
+
+        # Keep both buffers small so stale frames queue in the client, where they can be dropped
+        sock = writer.get_extra_info('socket')
+        if self.send_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+            writer.transport.set_write_buffer_limits(high=self.send_buffer_size)
+
+        client = self.new_video_client(codec, writer, self.loop, addr, client_class=AsyncVideoClient)
+        client.timestamps = timestamps
+
+        try:
+            if reply:
+                writer.write(reply)
+            self.video_clients.append(client)
+
+            while self.running and not client.closed:
+                frame = client.pop_frame()
+                if frame is None:
+                    client.wake.clear()
+                    frame = client.pop_frame()  # A frame may have arrived before the clear
+                    if frame is None:
+                        await client.wake.wait()
+                        continue
+
+                packet = client.packet(*frame)
+                send_start = time.monotonic()
+                writer.write(packet)
+                try:
+                    await asyncio.wait_for(writer.drain(), self.send_timeout)
+                except (asyncio.TimeoutError, ConnectionError):
+                    # Client disconnected or stalled past send_timeout
+                    break
+
+                client.frames_sent += 1
+                client.bytes_sent += len(packet)
+                if client.adaptive:
+                    client.adaptive.record_send(time.monotonic() - send_start, tcp_rtt_ms(sock))
+
+        except Exception as e:
+            print(f"Video streaming error for {addr}: {e}")
+        finally:
+            if client in self.video_clients:
+                self.video_clients.remove(client)
+            client.close()
+            print(f"Video client {addr} disconnected "
+                  f"(sent {client.frames_sent}, dropped {client.frames_dropped})")
+
+    async def serve_control(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"Control client connected: {addr}")
+
+        # Key events are tiny; don't let Nagle hold them back
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = AsyncControlClient(writer, self.loop, addr)
+        self.control_clients.append(client)
+
+        try:
+            while self.running:
+                data = await reader.read(4096)
+                if not data:
+                    break
+
+                self.handle_control_data(client, data)
+
+        except Exception as e:
+            print(f"Control client error for {addr}: {e}")
+        finally:
+            if client in self.control_clients:
+                self.control_clients.remove(client)
+            self.arduino_responses.forget(client)
+            client.close()
+            print(f"Control client {addr} disconnected")
+
+    async def expire_key_snapshots(self):
+        # Release the keys of UDP senders that went quiet
+        while self.running:
+            await asyncio.sleep(0.1)
+            self.handle_key_snapshot(None, None)
+
+    def on_arduino_readable(self):
+        try:
+            self.arduino_buffer += self.arduino.serial.read(self.arduino.serial.in_waiting or 1)
+        except Exception as e:
+            print(f"Arduino listener error: {e}")
+            self.loop.remove_reader(self.arduino.fileno())
+            return
+
+        while b"\n" in self.arduino_buffer:
+            line, self.arduino_buffer = self.arduino_buffer.split(b"\n", 1)
+            self.arduino.handle_line(line)
+
+    def stop_server(self):
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        super().stop_server()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tank Plant video/control server")
     # You may need to change the Arduino port based on your setup
     # Common ports: /dev/ttyUSB0, /dev/ttyACM0, /dev/serial0
-    server = VideoStreamServer(arduino_port='/dev/ttyUSB0')
+    parser.add_argument('--arduino-port', default='/dev/ttyUSB0')
+    parser.add_argument('--adaptive', action='store_true', help="Adapt JPEG quality, resolution and FPS per client")
+    parser.add_argument('--fps', type=int, default=20, help="Capture frame rate")
+    parser.add_argument('--no-h264', action='store_true', help="Only offer MJPEG to clients")
+    parser.add_argument('--no-udp', action='store_true', help="Disable the UDP key-state control transport")
+    parser.add_argument('--serial-baud', type=int, default=115200, choices=SERIAL_BAUD_RATES,
+                        help="Baud rate to ask the Arduino sketch for")
+    parser.add_argument('--text-serial', action='store_true', help="Keep text commands instead of the binary protocol")
+    parser.add_argument('--metrics-port', type=int, default=8890, help="HTTP port for JSON metrics (0 disables)")
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help="Address for the metrics endpoint (0.0.0.0 to expose it on the network)")
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help="Thread per client, or a single asyncio event loop for all clients")
+    args = parser.parse_args()
+
+    server_class = AsyncVideoStreamServer if args.mode == 'async' else VideoStreamServer
+    server = server_class(arduino_port=args.arduino_port, adaptive=args.adaptive,
+                          max_fps=args.fps, h264=not args.no_h264, udp_control=not args.no_udp,
+                          serial_baud=args.serial_baud, serial_binary=not args.text_serial,
+                          metrics_port=args.metrics_port, metrics_host=args.metrics_host)
     
     try:
         server.start_server()
@@ -0,0 +1,70 @@
+"""Wire formats shared by the server (stream.py, deployed as tank_server.py) and the client (main.py).
+
+Deployed next to tank_server.py on the Pi; both sides import it so the two ends can't drift apart.
+"""
+import json
+import struct
+
+# Control protocol: a versioned JSON hello line, then length-prefixed frames in both directions.
+# Each frame payload starts with a kind byte; plain key events have a compact binary form.
+CONTROL_VERSION = 2
+CONTROL_JSON = 0
+CONTROL_KEY_KINDS = {'keydown': 1, 'keyup': 2}
+CONTROL_MAX_BUFFER = 64 * 1024
+
+def encode_control_frame(message, binary=False):
+    kind = CONTROL_KEY_KINDS.get(message.get('type')) if binary and set(message) == {'type', 'key'} else None
+    if kind is not None:
+        payload = bytes([kind]) + str(message['key']).encode('utf-8')
+    else:
+        payload = bytes([CONTROL_JSON]) + json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return struct.pack("!H", len(payload)) + payload
+
+def decode_control_payload(payload):
+    kind = payload[0]
+    if kind == CONTROL_JSON:
+        message = json.loads(bytes(payload[1:]).decode('utf-8'))
+        if not isinstance(message, dict):
+            raise ValueError("Control message is not a JSON object")
+        return message
+    for key_type, key_kind in CONTROL_KEY_KINDS.items():
+        if kind == key_kind:
+            return {'type': key_type, 'key': bytes(payload[1:]).decode('utf-8')}
+    raise ValueError(f"Unknown control frame kind {kind}")
+
+# Optional UDP control transport: each datagram is a full snapshot of the pressed keys, so the newest
+# one always wins and a lost or late packet never has to be retransmitted.
+UDP_CONTROL_MAGIC = b'TKUD'
+UDP_CONTROL_HEADER = struct.Struct("!4sIId")  # magic, session, sequence number, client send time
+
+def encode_key_snapshot(session, seq, keys, sent_time):
+    keys = sorted(keys)
+    payload = bytearray(UDP_CONTROL_HEADER.pack(UDP_CONTROL_MAGIC, session, seq, sent_time))
+    payload.append(len(keys))
+    for key in keys:
+        encoded = key.encode('utf-8')
+        payload.append(len(encoded))
+        payload += encoded
+    return bytes(payload)
+
+def decode_key_snapshot(data):
+    """Returns (session, seq, sent_time, frozenset of keys); raises ValueError for anything malformed"""
+    try:
+        magic, session, seq, sent_time = UDP_CONTROL_HEADER.unpack_from(data)
+        if magic != UDP_CONTROL_MAGIC:
+            raise ValueError("bad magic")
+        offset = UDP_CONTROL_HEADER.size
+        count = data[offset]
+        offset += 1
+        keys = []
+        for _ in range(count):
+            length = data[offset]
+            keys.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed key snapshot: {e}")
+    return session, seq, sent_time, frozenset(keys)
+
+# Optional per-frame timestamps (negotiated in the video hello): capture, encode done and send, as server
+# wall-clock seconds, prepended to the payload inside the length prefix
+FRAME_TIMESTAMPS = struct.Struct("!ddd")